@@ -16,6 +16,7 @@ https://github.com/hbldh/bleak
 
 事前に、bleak ライブラリをインストールします。
 (コマンド例 : pip install bleak)
+リングバッファ受信モードでは numpy も使用します。
 
 ============
 使用例
@@ -40,6 +41,41 @@ async def main_loop():
 # start program
 asyncio.run(main_loop())
 
+============
+リングバッファ受信モード
+============
+6軸IMUデータ (12byte/サンプル) を高レートで受信する場合は、ring_size を指定すると、
+notify データを事前確保した int16 型リングバッファ (ring_size, 6) に直接書き込む。
+受信側は、溜まったサンプルを (k, 6) の np.ndarray (バッファのビュー) でまとめて取り出す。
+バッファが一杯の時は、新しいサンプルを捨てて、その数を数える(BLE側を待たせない)。
+
+async def main_loop():
+    client = BleUartClient("IMU_BASE", ring_size=4096)
+    await client.connect()
+    await client.write(b'b')
+    while True:
+        # 1サンプル以上溜まるまで待ち、連続した (k, 6) のビューを取得
+        # 終端データ(加速度6byteが0)受信後、バッファが空になると長さ0のアレイが返る
+        imu = await client.get_samples()
+        if len(imu) == 0:
+            break
+        print(imu.mean(axis=0))
+    print(client.get_ring_status())
+    await client.disconnect()
+
+シーケンス番号とタイムスタンプ付きのデータ ("t" コマンド) は packet="stamped" を指定する。
+複数サンプルをまとめたデータ ("p" コマンド) は packet="packed" を指定する。notify 毎の
+ヘッダを取り除いて raw と同じ (k, 6) で取り出せ、シーケンス番号の飛びを missing に数える。
+センサの FIFO から最大 1kHz で読み出すデータ ("f" コマンド) も同じ形式で、packet="packed" で受信する。
+FIFO が一杯になってセンサ側で失われたことを示す notify の数は fifo_full に数える。
+マイコン上で積算した姿勢 ("q", "Q" コマンド) は packet="quat" を指定し、get_quaternions で
+(k, 4) の float64 クオータニオンとして取り出す (1行ずつ Quaternion(*q) に、又は QuaternionArray に)。
+
+    client = BleUartClient("IMU_BASE", ring_size=1024, packet="quat")
+    await client.connect()
+    await client.write(b'Q' + bytes([10]))  # 加速度補正付き、10サンプル(100ms) 毎に送信
+    quat = await client.get_quaternions()
+
 ============
 免責
 ============
@@ -47,8 +83,12 @@ asyncio.run(main_loop())
 (2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
 """
 import asyncio
-from bleak import BleakClient, BleakScanner
+import time
+import numpy as np
+import bleak
 from bleak.backends.characteristic import BleakGATTCharacteristic
+from imu_packet import IMU_SAMPLE_BYTES, STAMPED_DTYPE, PACKED_HEADER_BYTES, PACKED_FLAG_FIFO_FULL, QUAT_DTYPE, SEQ_PERIOD, \
+    is_end_data, decode_quat
 
 # Nordic UART サービス UUID
 UART_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"
@@ -60,15 +100,95 @@ class BleUartClient:
     async def _receive_data(self, _: BleakGATTCharacteristic, data: bytearray):
         await self._receive_queue.put(data)
 
-    def __init__(self, device_name: str, address: str=""):
+    def _receive_ring(self, _: BleakGATTCharacteristic, data: bytearray):
+        """notify データをリングバッファに直接書き込む (リングバッファ受信モード)"""
+        now = time.monotonic()
+        # 終端データ(12byte 全て0) は、バッファに入れず受信終了とする
+        if is_end_data(data):
+            self._ring_end = True
+            self._ring_event.set()
+            return
+        if self._packed:
+            data = self._strip_packed(data)
+            if data is None:
+                return
+        record = self._record_bytes
+        rows = len(data) // record
+        if rows * record != len(data):
+            # 1サンプル単位でない端数は破棄
+            self._ring_drop += 1
+        if rows == 0:
+            return
+        if self._quat:
+            self._count_quat(data, rows)
+        free = self._ring_size - (self._ring_write - self._ring_read)
+        if rows > free:
+            self._ring_overflow += 1
+            self._ring_drop += rows - free
+            rows = free
+        pos = self._ring_write % self._ring_size
+        first = min(rows, self._ring_size - pos)
+        nbytes = first * record
+        self._ring_bytes[pos*record:pos*record+nbytes] = data[:nbytes]
+        if rows > first:
+            rest = (rows - first) * record
+            self._ring_bytes[:rest] = data[nbytes:nbytes+rest]
+        self._ring_time[pos:pos+first] = now
+        if rows > first:
+            self._ring_time[:rows-first] = now
+        self._ring_write += rows
+        if rows > 0:
+            self._ring_event.set()
+
+    def _strip_packed(self, data: bytearray):
+        """packed 形式のヘッダを確認して取り除き、IMUデータ部分を返す
+
+        ヘッダとデータ長が合わない notify は破棄して None を返す。
+        """
+        if len(data) < PACKED_HEADER_BYTES or len(data) != PACKED_HEADER_BYTES + data[2]*IMU_SAMPLE_BYTES:
+            self._ring_drop += 1
+            return None
+        seq = data[0] | (data[1] << 8)
+        if self._packed_seq is not None:
+            self._ring_missing += (seq - self._packed_seq) % SEQ_PERIOD
+        self._packed_seq = (seq + data[2]) % SEQ_PERIOD
+        if data[3] & PACKED_FLAG_FIFO_FULL:
+            self._ring_fifo_full += 1
+        return memoryview(data)[PACKED_HEADER_BYTES:]
+
+    def _count_quat(self, data: bytearray, rows: int):
+        """quat 形式のシーケンス番号の飛びを、欠落数に数える"""
+        record = self._record_bytes
+        for row in range(rows):
+            pos = row*record + record - 2
+            seq = data[pos] | (data[pos+1] << 8)
+            if self._packed_seq is not None:
+                self._ring_missing += (seq - self._packed_seq) % SEQ_PERIOD
+            self._packed_seq = (seq + 1) % SEQ_PERIOD
+
+    def __init__(self, device_name: str, address: str="", ring_size: int=0, backend=None, packet: str="raw"):
         """コンストラクタ
 
         parameters
         -----
         device_name: str
             接続するBLEデバイス名。connectメソッドで参照される。
-        address: str, default=""
+        address: str or BLEDevice, default=""
             接続するBLEアドレス。デフォルト空文字の場合、デバイス名からサーチされる。
+            スキャン済みの BLEDevice を渡すと、再スキャンせずに接続できる。
+        ring_size: int, default=0
+            0 の場合、受信データを asyncio.Queue に積む (get_queue で取得)。
+            1以上の場合、リングバッファ受信モードとし、6軸IMUデータを ring_size サンプル分の
+            int16 型リングバッファに直接書き込む (get_samples で取得)。
+        backend: default=None
+            BleakClient, BleakScanner を属性に持つ BLE バックエンド。
+            None の場合は bleak ライブラリ。試験用の模擬バックエンドに差し替えられる。
+        packet: str, default="raw"
+            リングバッファ受信モードでのデータ形式 (imu_packet 参照)
+            "raw" : 12byte/サンプル ("b" コマンド)
+            "stamped" : シーケンス番号とタイムスタンプ付き 18byte/サンプル ("t" コマンド)
+            "packed" : 複数サンプルをまとめた 4+12K byte/notify ("p", "f" コマンド)。raw と同じ形で取り出す
+            "quat" : マイコン上で積算した姿勢 10byte/出力 ("q", "Q" コマンド)。get_quaternions で取り出す
         """
         self._target_address = ""
         self._target_client = None
@@ -77,8 +197,41 @@ class BleUartClient:
         self._queue_size = 128
         self._dev_name = device_name
         self._receive_queue = asyncio.Queue(self._queue_size)
+        self._backend = backend if backend is not None else bleak
         if address:
             self._target_address = address
+        self._ring_size = ring_size
+        if ring_size > 0:
+            if packet == "stamped":
+                self._record_bytes = STAMPED_DTYPE.itemsize
+            elif packet == "quat":
+                self._record_bytes = QUAT_DTYPE.itemsize
+            else:
+                self._record_bytes = IMU_SAMPLE_BYTES
+            # notify データをそのまま書き込むバイト列と、そのビュー
+            self._ring_raw = np.zeros(ring_size * self._record_bytes, dtype=np.uint8)
+            self._ring_bytes = memoryview(self._ring_raw)
+            if packet == "stamped":
+                self._ring = self._ring_raw.view(STAMPED_DTYPE)
+            elif packet == "quat":
+                self._ring = self._ring_raw.view(QUAT_DTYPE)
+            else:
+                self._ring = self._ring_raw.view('<i2').reshape((ring_size, 6))
+            self._ring_time = np.zeros(ring_size)  # 受信時刻 time.monotonic() [sec]
+            self._ring_write = 0    # 書き込み済み総サンプル数
+            self._ring_read = 0     # 読み出し済み総サンプル数
+            self._ring_overflow = 0 # バッファ不足で notify データを書ききれなかった回数
+            self._ring_drop = 0     # 破棄したサンプル数 (端数 notify も1と数える)
+            self._ring_missing = 0  # packed, quat 形式で、シーケンス番号の飛びから数えた欠落サンプル数
+            self._packed = packet == "packed"
+            self._quat = packet == "quat"
+            self._packed_seq = None # packed, quat 形式で、次に期待するシーケンス番号
+            self._ring_fifo_full = 0  # packed 形式で、センサの FIFO が一杯だったことを示す notify の数
+            self._ring_end = False
+            self._ring_event = asyncio.Event()
+            self._notify_callback = self._receive_ring
+        else:
+            self._notify_callback = self._receive_data
 
     async def connect(self, refresh: bool=True)-> bool:
         """BLE接続
@@ -101,10 +254,10 @@ class BleUartClient:
             return False
         # BLEアドレス指定され、refresh = False の場合、直接アドレス指定して接続
         if self._target_address and refresh is False:
-            self._target_client = BleakClient(self._target_address)
+            self._target_client = self._backend.BleakClient(self._target_address)
             ack = await self._target_client.connect()
             if ack:
-                await self._target_client.start_notify(UART_TX_CHAR_UUID, self._receive_data)
+                await self._target_client.start_notify(UART_TX_CHAR_UUID, self._notify_callback)
                 nus = self._target_client.services.get_service(UART_SERVICE_UUID)
                 self._rx_char = nus.get_characteristic(UART_RX_CHAR_UUID)
             else:
@@ -112,13 +265,13 @@ class BleUartClient:
             return ack
         # 新たにスキャンしてデバイス捜索し、接続
         else:
-            ble_device = await BleakScanner.find_device_by_name(self._dev_name, self._scan_sec)
+            ble_device = await self._backend.BleakScanner.find_device_by_name(self._dev_name, self._scan_sec)
             if ble_device:
                 self._target_address = ble_device.address
-                self._target_client = BleakClient(ble_device)
+                self._target_client = self._backend.BleakClient(ble_device)
                 ack = await self._target_client.connect()
                 if ack:
-                    await self._target_client.start_notify(UART_TX_CHAR_UUID, self._receive_data)
+                    await self._target_client.start_notify(UART_TX_CHAR_UUID, self._notify_callback)
                     nus = self._target_client.services.get_service(UART_SERVICE_UUID)
                     self._rx_char = nus.get_characteristic(UART_RX_CHAR_UUID)
                 else:
@@ -139,6 +292,16 @@ class BleUartClient:
         else:
             return False
 
+    def get_address(self)-> str:
+        """接続先(又は接続予定)の BLEアドレスを取得
+
+        returns
+        -----
+        str
+            BLEアドレス。未定の場合は空文字
+        """
+        return getattr(self._target_address, 'address', self._target_address)
+
     async def disconnect(self):
         """BLE接続断"""
         if self._target_client:
@@ -170,3 +333,109 @@ class BleUartClient:
             深さ _queue_size のキュー。一回の受信データ(20byte以内)が、bytes型でスタックされる。
         """
         return self._receive_queue
+
+    async def get_samples(self, max_samples: int=0, with_time: bool=False):
+        """リングバッファから6軸IMUデータをまとめて取得 (リングバッファ受信モード)
+
+        1サンプル以上溜まるまで待ち、溜まっているサンプルを取り出す。
+        返り値はリングバッファのビュー(コピーなし)で、バッファ末尾で折り返す場合は
+        末尾までの分だけが返る(残りは次回の呼び出しで返る)。
+        ビューの内容は、次に await するまで(notify で上書きされるまで)有効。
+        保持する場合は copy() すること。
+
+        parameters
+        -----
+        max_samples: int, default=0
+            取り出す最大サンプル数。0 の場合は制限なし
+        with_time: bool, default=False
+            True の場合、各サンプルの受信時刻も返す
+
+        returns
+        -----
+        np.ndarray
+            shape=(k, 6) の int16 型アレイ。列は xyz加速度、xyz角速度の順
+            packet="stamped" の場合は shape=(k,) の STAMPED_DTYPE 型構造化アレイ
+            (['imu'] が (k, 6) の IMUデータ、['seq'] がシーケンス番号、['tick'] がタイムスタンプ)
+            packet="quat" の場合は shape=(k,) の QUAT_DTYPE 型構造化アレイ
+            (['quat'] が (k, 4) の Q15 クオータニオン、['seq'] がシーケンス番号)
+            終端データ受信後にバッファが空になると k=0 となる
+            with_time=True の場合は、(サンプル, 受信時刻) のタプル。
+            受信時刻は shape=(k,) の time.monotonic() [sec] で、同じ notify のサンプルは同時刻
+        """
+        while self._ring_write == self._ring_read:
+            if self._ring_end:
+                return self.read_samples(max_samples, with_time)
+            self._ring_event.clear()
+            await self._ring_event.wait()
+        return self.read_samples(max_samples, with_time)
+
+    def read_samples(self, max_samples: int=0, with_time: bool=False):
+        """リングバッファから6軸IMUデータを待たずに取得 (リングバッファ受信モード)
+
+        get_samples と同じだが、サンプルが無い場合は待たずに k=0 のアレイを返す。
+
+        parameters
+        -----
+        max_samples: int, default=0
+            取り出す最大サンプル数。0 の場合は制限なし
+        with_time: bool, default=False
+            True の場合、各サンプルの受信時刻も返す
+
+        returns
+        -----
+        np.ndarray
+            shape=(k, 6) の int16 型アレイ (リングバッファのビュー)
+            packet="stamped" の場合は shape=(k,) の STAMPED_DTYPE 型構造化アレイ
+            packet="quat" の場合は shape=(k,) の QUAT_DTYPE 型構造化アレイ
+            with_time=True の場合は、(サンプル, 受信時刻) のタプル
+        """
+        pos = self._ring_read % self._ring_size
+        k = min(self._ring_write - self._ring_read, self._ring_size - pos)
+        if max_samples > 0:
+            k = min(k, max_samples)
+        self._ring_read += k
+        if with_time:
+            return (self._ring[pos:pos+k], self._ring_time[pos:pos+k])
+        return self._ring[pos:pos+k]
+
+    async def get_quaternions(self, max_samples: int=0)-> np.ndarray:
+        """リングバッファからクオータニオンをまとめて取得 (packet="quat" のリングバッファ受信モード)
+
+        get_samples と同様に1出力以上溜まるまで待ち、Q15 を float64 に変換して返す (コピー)。
+
+        parameters
+        -----
+        max_samples: int, default=0
+            取り出す最大出力数。0 の場合は制限なし
+
+        returns
+        -----
+        np.ndarray
+            shape=(k, 4) の float64 クオータニオン (実数部, 虚数部i, 虚数部j, 虚数部k)
+            終端データ受信後にバッファが空になると k=0 となる
+        """
+        return decode_quat(await self.get_samples(max_samples))[1]
+
+    def get_ring_status(self)-> dict:
+        """リングバッファの状態を取得 (リングバッファ受信モード)
+
+        returns
+        -----
+        dict
+            size: バッファサイズ [サンプル]
+            stored: 未読のサンプル数
+            received: 書き込んだ総サンプル数
+            overflow: バッファ不足で notify データを書ききれなかった回数
+            drop: 破棄したサンプル数
+            end: 終端データを受信したか
+            missing: packed, quat 形式で、BLE 側で欠落したサンプル数 (それ以外は 0)
+            fifo_full: packed 形式 ("f" コマンド) で、センサの FIFO が一杯になりサンプルが失われた回数
+        """
+        return {'size': self._ring_size,
+                'stored': self._ring_write - self._ring_read,
+                'received': self._ring_write,
+                'overflow': self._ring_overflow,
+                'drop': self._ring_drop,
+                'end': self._ring_end,
+                'missing': self._ring_missing,
+                'fifo_full': self._ring_fifo_full}
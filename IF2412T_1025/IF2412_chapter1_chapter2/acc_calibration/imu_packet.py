@@ -0,0 +1,312 @@
+""" imu_base 送信データの復号ライブラリ(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+M5Stack ATOM-S3 (imu_base) から notify で送られるデータを、numpy アレイに復号します。
+BLE 通信ライブラリに依存しないので、保存済みデータのオフライン処理にも使えます。
+
+============
+データ形式
+============
+raw     : 12byte / サンプル ("b", "s" コマンド)
+    acc_x acc_y acc_z gyr_x gyr_y gyr_z  (各 signed 16bit little endian)
+stamped : 18byte / サンプル ("t" コマンド)
+    raw の 12byte + seq (unsigned 16bit) + tick (unsigned 32bit, micros() [usec])
+packed  : 4 + 12K byte / notify ("p", "f" コマンド)
+    seq (unsigned 16bit, 先頭サンプルの番号) + K (unsigned 8bit) + flags (unsigned 8bit) + raw の 12byte x K
+    flags の bit0 は、"f" コマンドでセンサの FIFO が一杯になり、サンプルが失われたことを示す
+quat    : 10byte / 出力 ("q", "Q" コマンド、マイコン上で積算した姿勢)
+    q_r q_i q_j q_k (各 signed 16bit little endian, Q15 : 32768 = 1.0) + seq (unsigned 16bit, 出力毎に +1)
+終端データ : 12byte 全て0
+
+============
+使用例
+============
+from imu_packet import *
+
+# 1回の notify データを復号
+imu, seq, tick = decode_stamped(raw_data)
+# 逐次処理では StampTracker で実際のサンプリング間隔と欠落数を得る
+tracker = StampTracker()
+dt, missing = tracker.update(seq[0], tick[0])
+# packed 形式の notify データを (K, 6) に分割
+seq, block = decode_packed(raw_data)
+# 保存済みデータ全体の欠落を補間し、各サンプルの時刻を得る
+imu_f, t, valid = fill_gaps(imu, seq, tick)
+# quat 形式の notify データを (N, 4) のクオータニオンに
+seq, quat = decode_quat(raw_data)
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import numpy as np
+
+# raw 形式 1サンプルのバイト数 (符号付16bit x 6軸)
+IMU_SAMPLE_BYTES = 12
+# stamped 形式 1サンプルの構造 (18byte)
+STAMPED_DTYPE = np.dtype([('imu', '<i2', (6,)), ('seq', '<u2'), ('tick', '<u4')])
+STAMPED_SAMPLE_BYTES = STAMPED_DTYPE.itemsize
+# packed 形式のヘッダのバイト数 (seq 2byte + K 1byte + flags 1byte)
+PACKED_HEADER_BYTES = 4
+# packed 形式の flags : センサの FIFO が一杯になり、サンプルが失われた ("f" コマンド)
+PACKED_FLAG_FIFO_FULL = 0x01
+# "f" コマンドの FIFO サンプリング周波数 = FIFO_BASE_RATE / (分周値 + 1) [Hz]
+FIFO_BASE_RATE = 1000.0
+# quat 形式 1出力の構造 (10byte)
+QUAT_DTYPE = np.dtype([('quat', '<i2', (4,)), ('seq', '<u2')])
+QUAT_SAMPLE_BYTES = QUAT_DTYPE.itemsize
+# quat 形式の Q15 固定小数点の 1.0
+QUAT_ONE = 1 << 15
+
+# シーケンス番号、タイムスタンプの周期
+SEQ_PERIOD = 1 << 16
+TICK_PERIOD = 1 << 32
+# タイムスタンプの単位 [sec]
+TICK_SEC = 1e-6
+
+def is_end_data(data)-> bool:
+    """終端データ(12byte 全て0) か判定
+
+    Parameters
+    -----
+    data: bytes or bytearray 1回の notify データ
+
+    Returns
+    -----
+    bool 終端データなら True
+    """
+    return len(data) == IMU_SAMPLE_BYTES and data[:6] == b'\x00'*6
+
+def decode_raw(data)-> np.ndarray:
+    """raw 形式のデータ列を復号
+
+    Parameters
+    -----
+    data: bytes or bytearray 12byte の整数倍のデータ列
+
+    Returns
+    -----
+    np.ndarray shape=(サンプル点数, 6) の int16 アレイ
+    """
+    return np.frombuffer(data, dtype='<i2').reshape((-1, 6))
+
+def decode_stamped(data)-> tuple:
+    """stamped 形式のデータ列を復号
+
+    Parameters
+    -----
+    data: bytes or bytearray or np.ndarray
+        18byte の整数倍のデータ列、または shape=(サンプル点数, 9) の int16 アレイ
+        (stamped 形式をそのまま保存したもの)
+
+    Returns
+    -----
+    (np.ndarray, np.ndarray, np.ndarray)
+        shape=(サンプル点数, 6) の int16 IMUデータ
+        shape=(サンプル点数,) の uint16 シーケンス番号
+        shape=(サンプル点数,) の uint32 タイムスタンプ [usec]
+    """
+    if isinstance(data, np.ndarray):
+        data = np.ascontiguousarray(data)
+    rec = np.frombuffer(data, dtype=STAMPED_DTYPE)
+    return (rec['imu'], rec['seq'], rec['tick'])
+
+def packed_samples(mtu: int)-> int:
+    """MTU から、packed 形式の 1回の notify に入るサンプル数 K を得る
+
+    Parameters
+    -----
+    mtu: int 接続の ATT MTU [byte]
+
+    Returns
+    -----
+    int K (1 以上)
+    """
+    return max(1, (mtu - 3 - PACKED_HEADER_BYTES) // IMU_SAMPLE_BYTES)
+
+def decode_packed(data)-> tuple:
+    """packed 形式の 1回の notify データを復号
+
+    Parameters
+    -----
+    data: bytes or bytearray 4 + 12K byte の notify データ
+
+    Returns
+    -----
+    (int, np.ndarray)
+        先頭サンプルのシーケンス番号 (16bit)
+        shape=(K, 6) の int16 IMUデータ
+
+    Raises
+    -----
+    ValueError
+        データ長がヘッダの K と一致しない場合
+    """
+    count = data[2] if len(data) >= PACKED_HEADER_BYTES else -1
+    if len(data) != PACKED_HEADER_BYTES + count*IMU_SAMPLE_BYTES:
+        raise ValueError("packed data size mismatch: %d byte" % len(data))
+    seq = data[0] | (data[1] << 8)
+    return (seq, np.frombuffer(data, dtype='<i2', offset=PACKED_HEADER_BYTES).reshape((-1, 6)))
+
+def decode_quat(data)-> tuple:
+    """quat 形式のデータ列を復号
+
+    Parameters
+    -----
+    data: bytes or bytearray or np.ndarray
+        10byte の整数倍のデータ列、又は QUAT_DTYPE 型構造化アレイ
+
+    Returns
+    -----
+    (np.ndarray, np.ndarray)
+        shape=(出力数,) の uint16 シーケンス番号
+        shape=(出力数, 4) の float64 クオータニオン (実数部, 虚数部i, 虚数部j, 虚数部k)
+        Q15 で丸めているので、norm は 1 から 1e-4 程度ずれる
+    """
+    if isinstance(data, np.ndarray) and data.dtype == QUAT_DTYPE:
+        rec = data
+    else:
+        rec = np.frombuffer(data, dtype=QUAT_DTYPE)
+    return (rec['seq'], rec['quat'].astype(np.float64)/QUAT_ONE)
+
+def unwrap_counter(counter, period: int)-> np.ndarray:
+    """周期的に一周するカウンタ値を、一周分を足しこんで単調増加する値に変換
+
+    隣り合う値の差は 0～period-1 とみなす (period 以上の飛びは検出できない)。
+
+    Parameters
+    -----
+    counter: array like カウンタ値の系列
+    period: int カウンタの周期
+
+    Returns
+    -----
+    np.ndarray int64 型の単調増加する系列 (先頭は counter[0])
+    """
+    counter = np.asarray(counter, dtype=np.int64)
+    if len(counter) == 0:
+        return counter
+    step = np.diff(counter) % period
+    return counter[0] + np.concatenate(([0], np.cumsum(step)))
+
+def fill_gaps(imu, seq, tick, interpolate: bool=True)-> tuple:
+    """シーケンス番号の飛びから欠落サンプルを検出し、補間する
+
+    重複したシーケンス番号のサンプルは取り除く。
+    interpolate=True の場合、欠落したシーケンス番号の位置に、前後のサンプルから
+    線形補間した IMUデータと時刻を挿入する。False の場合は挿入せず、欠落の直後の
+    サンプルを valid=False とする。
+
+    Parameters
+    -----
+    imu: array like shape=(サンプル点数, 6) の IMUデータ
+    seq: array like shape=(サンプル点数,) のシーケンス番号 (16bit)
+    tick: array like shape=(サンプル点数,) のタイムスタンプ (32bit) [usec]
+    interpolate: bool, default True
+        欠落サンプルを補間して挿入するか?
+
+    Returns
+    -----
+    (np.ndarray, np.ndarray, np.ndarray)
+        shape=(M, 6) の float64 IMUデータ
+        shape=(M,) の先頭サンプルからの時刻 [sec]
+        shape=(M,) の bool 配列。interpolate=True では受信サンプルなら True、補間値なら False
+        interpolate=False では欠落の直後のサンプルが False
+    """
+    imu = np.asarray(imu, dtype=np.float64).reshape((-1, 6))
+    seq_u = unwrap_counter(seq, SEQ_PERIOD)
+    tick_u = unwrap_counter(tick, TICK_PERIOD)
+    if len(seq_u) == 0:
+        return (imu, np.zeros(0), np.zeros(0, dtype=bool))
+    # 重複サンプルを除く (BLE の再送などで同じ番号が続いた場合)
+    keep = np.concatenate(([True], np.diff(seq_u) > 0))
+    imu, seq_u, tick_u = imu[keep], seq_u[keep], tick_u[keep]
+    t = (tick_u - tick_u[0]) * TICK_SEC
+    if not interpolate:
+        valid = np.concatenate(([True], np.diff(seq_u) == 1))
+        return (imu, t, valid)
+    full = np.arange(seq_u[0], seq_u[-1] + 1)
+    valid = np.zeros(len(full), dtype=bool)
+    valid[seq_u - seq_u[0]] = True
+    imu_full = np.empty((len(full), 6))
+    for axis in range(6):
+        imu_full[:, axis] = np.interp(full, seq_u, imu[:, axis])
+    return (imu_full, np.interp(full, seq_u, t), valid)
+
+def sample_intervals(t, nominal: float)-> np.ndarray:
+    """各サンプルの時刻から、各サンプルの積算に使う周期時間 dt を得る
+
+    n 番目の dt は t[n] - t[n-1]。先頭サンプルは nominal とする。
+
+    Parameters
+    -----
+    t: array like shape=(サンプル点数,) の時刻 [sec]
+    nominal: float 公称サンプリング間隔 [sec]
+
+    Returns
+    -----
+    np.ndarray shape=(サンプル点数,) の dt [sec]
+    """
+    t = np.asarray(t, dtype=np.float64)
+    return np.concatenate(([nominal], np.diff(t)))[:len(t)]
+
+class StampTracker:
+    """stamped 形式の逐次受信で、サンプル毎の実際の周期時間と欠落数を得る
+
+    提供メソッド
+    -----
+    update(seq, tick)
+        1サンプル分のシーケンス番号とタイムスタンプを与え、前回からの dt と欠落数を得る
+    get_missing()
+        累計の欠落サンプル数
+    """
+    def __init__(self, nominal: float=0.01):
+        """コンストラクタ
+
+        Parameters
+        -----
+        nominal: float, default 0.01
+            公称サンプリング間隔 [sec]。初回サンプルの dt に使う
+        """
+        self._nominal = nominal
+        self._seq = None
+        self._tick = None
+        self._missing = 0
+
+    def update(self, seq: int, tick: int)-> tuple:
+        """1サンプル分のシーケンス番号とタイムスタンプから、前回からの dt と欠落数を得る
+
+        Parameters
+        -----
+        seq: int シーケンス番号 (16bit)
+        tick: int タイムスタンプ (32bit) [usec]
+
+        Returns
+        -----
+        (float, int)
+            前回サンプルからの経過時間 [sec] (初回は nominal)
+            前回サンプルとの間で欠落したサンプル数 (重複サンプルの場合は -1)
+        """
+        seq = int(seq)
+        tick = int(tick)
+        if self._seq is None:
+            dt, missing = self._nominal, 0
+        else:
+            missing = (seq - self._seq) % SEQ_PERIOD - 1
+            if missing < 0:
+                return (0.0, -1)
+            dt = ((tick - self._tick) % TICK_PERIOD) * TICK_SEC
+        self._seq = seq
+        self._tick = tick
+        self._missing += missing
+        return (dt, missing)
+
+    def get_missing(self)-> int:
+        """累計の欠落サンプル数"""
+        return self._missing
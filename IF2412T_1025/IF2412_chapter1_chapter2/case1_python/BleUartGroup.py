@@ -0,0 +1,272 @@
+""" 複数 BLE デバイスの同時データ取得ライブラリ(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+同じデバイス名 (例 "IMU_BASE") の複数の M5Stack ATOM-S3 を、1回のスキャンで見つけて
+同時に接続し、1つの asyncio ループ上でまとめてデータ取得するライブラリです。
+各デバイスは BleUartClient のリングバッファ受信モードで受信します。
+
+  - コマンド (b / e / s) は全デバイスに並列に送信
+  - 受信データは、PC 側の受信時刻とデバイス番号付きで、時刻順に1つのアレイに統合
+  - デバイス毎のサンプリングレート、欠落数を集計
+
+============
+使用例
+============
+from BleUartGroup import BleUartGroup
+
+async def main_loop():
+    group = BleUartGroup("IMU_BASE")
+    await group.connect()          # 1回スキャンして、見つかった全デバイスに並列接続
+    await group.start()            # 全デバイスに b 送信し、受信開始
+    await asyncio.sleep(10)
+    await group.stop()             # 全デバイスに e 送信し、終端データまで受信
+    await group.disconnect()
+    merged = group.get_merged()    # 時刻順に統合した構造化アレイ
+    print(group.get_stats())
+
+試験時は backend に fake_bleak.FakeBleakBackend を渡すと、.npy ファイルを再生する
+模擬デバイスで動作する。
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import asyncio
+import time
+import numpy as np
+import bleak
+from BleUart import BleUartClient
+
+# 統合データの構造化アレイ型
+#   time   : 受信開始からの PC 側受信時刻 [sec]
+#   device : デバイス番号 (get_addresses() の順番)
+#   imu    : 6軸IMUデータ (xyz加速度、xyz角速度) int16
+MERGED_DTYPE = np.dtype([('time', np.float64), ('device', np.int16), ('imu', np.int16, (6,))])
+
+class BleUartGroup:
+    """複数 BLE デバイスの同時データ取得
+
+    提供メソッド
+    -----
+    connect()
+        1回のスキャンで見つけた複数デバイスに並列接続
+    write(data)
+        全デバイスに並列にデータ送信
+    start()
+        全デバイスに連続送信開始コマンド b を送り、受信開始
+    stop()
+        全デバイスに連続送信停止コマンド e を送り、終端データまで受信
+    disconnect()
+        全デバイスを接続断
+    get_addresses()
+        接続デバイスの BLEアドレスのリスト
+    get_data(index)
+        デバイス毎の受信データと受信時刻
+    get_merged()
+        全デバイスの受信データを時刻順に統合
+    get_aligned(interval)
+        全デバイスの受信データを共通の時刻格子に揃える
+    get_stats()
+        デバイス毎のサンプリングレート、欠落数
+    """
+    def __init__(self, device_name: str="IMU_BASE", max_devices: int=8, ring_size: int=4096,
+                 interval: float=0.01, backend=None):
+        """コンストラクタ
+
+        parameters
+        -----
+        device_name: str, default="IMU_BASE"
+            接続する BLEデバイス名。この名前の全デバイスに接続する
+        max_devices: int, default=8
+            接続する最大デバイス数
+        ring_size: int, default=4096
+            デバイス毎の受信リングバッファのサンプル数
+        interval: float, default=0.01
+            デバイスのサンプリング間隔 [sec]。欠落数の推定に使う
+        backend: default=None
+            BLE バックエンド。None の場合は bleak ライブラリ
+        """
+        self._dev_name = device_name
+        self._max_devices = max_devices
+        self._ring_size = ring_size
+        self._interval = interval
+        self._backend = backend if backend is not None else bleak
+        self._scan_sec = 6
+        self._clients = []
+        self._tasks = []
+        self._blocks = []   # デバイス毎の受信データブロックのリスト
+        self._times = []    # デバイス毎の受信時刻ブロックのリスト
+        self._start_time = 0.0
+
+    async def connect(self)-> int:
+        """1回のスキャンで見つけた複数デバイスに並列接続
+
+        returns
+        -----
+        int
+            接続できたデバイス数
+        """
+        devices = await self._backend.BleakScanner.discover(timeout=self._scan_sec)
+        devices = sorted([d for d in devices if d.name == self._dev_name], key=lambda d: d.address)
+        clients = [BleUartClient(self._dev_name, d, self._ring_size, self._backend)
+                   for d in devices[:self._max_devices]]
+        acks = await asyncio.gather(*[c.connect(False) for c in clients], return_exceptions=True)
+        self._clients = [c for c, ack in zip(clients, acks) if ack is True]
+        self._blocks = [[] for _ in self._clients]
+        self._times = [[] for _ in self._clients]
+        return len(self._clients)
+
+    async def write(self, data: bytearray):
+        """全デバイスに並列にデータ送信
+
+        parameters
+        -----
+        data: bytearray
+            送信データ
+        """
+        await asyncio.gather(*[c.write(data) for c in self._clients])
+
+    async def start(self):
+        """全デバイスに連続送信開始コマンド b を送り、受信開始"""
+        self._start_time = time.monotonic()
+        self._tasks = [asyncio.ensure_future(self._collect(n)) for n in range(len(self._clients))]
+        await self.write(b'b')
+
+    async def stop(self, timeout: float=1.0):
+        """全デバイスに連続送信停止コマンド e を送り、終端データまで受信
+
+        parameters
+        -----
+        timeout: float, default=1.0
+            終端データを待つ時間 [sec]。過ぎたら受信を打ち切る
+        """
+        await self.write(b'e')
+        if self._tasks:
+            done, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks = []
+
+    async def disconnect(self):
+        """全デバイスを接続断"""
+        await asyncio.gather(*[c.disconnect() for c in self._clients])
+
+    async def _collect(self, index: int):
+        """デバイス1台分の受信タスク。終端データまでリングバッファから取り出して蓄積"""
+        client = self._clients[index]
+        while True:
+            imu, stamp = await client.get_samples(with_time=True)
+            if len(imu) == 0:
+                break
+            self._blocks[index].append(imu.copy())
+            self._times[index].append(stamp - self._start_time)
+
+    def get_addresses(self)-> list:
+        """接続デバイスの BLEアドレスのリスト (デバイス番号順)"""
+        return [c.get_address() for c in self._clients]
+
+    def get_data(self, index: int)-> tuple:
+        """デバイス毎の受信データと受信時刻
+
+        parameters
+        -----
+        index: int
+            デバイス番号
+
+        returns
+        -----
+        (np.ndarray, np.ndarray)
+            第一要素は shape=(サンプル点数, 6) の int16 アレイ
+            第二要素は shape=(サンプル点数,) の受信開始からの受信時刻 [sec]
+        """
+        if not self._blocks[index]:
+            return (np.zeros((0, 6), dtype=np.int16), np.zeros(0))
+        # 以後の呼び出しのため、ブロックを1つに結合しておく
+        self._blocks[index] = [np.concatenate(self._blocks[index])]
+        self._times[index] = [np.concatenate(self._times[index])]
+        return (self._blocks[index][0], self._times[index][0])
+
+    def get_merged(self)-> np.ndarray:
+        """全デバイスの受信データを時刻順に統合
+
+        returns
+        -----
+        np.ndarray
+            MERGED_DTYPE 型 (time, device, imu) の構造化アレイ。受信時刻順
+            (同時刻はデバイス番号順、同じデバイス内は受信順)
+        """
+        parts = []
+        for n in range(len(self._clients)):
+            imu, stamp = self.get_data(n)
+            part = np.empty(len(imu), dtype=MERGED_DTYPE)
+            part['time'] = stamp
+            part['device'] = n
+            part['imu'] = imu
+            parts.append(part)
+        if not parts:
+            return np.zeros(0, dtype=MERGED_DTYPE)
+        merged = np.concatenate(parts)
+        return merged[np.argsort(merged['time'], kind='stable')]
+
+    def get_aligned(self, interval: float=0.0)-> tuple:
+        """全デバイスの受信データを共通の時刻格子に揃える
+
+        各格子時刻で、各デバイスのその時刻以前の最新サンプルを採る(サンプルホールド)。
+        格子は、全デバイスがデータを受信し始めた時刻から、最初に受信を終えた時刻まで。
+
+        parameters
+        -----
+        interval: float, default=0.0
+            格子の間隔 [sec]。0 の場合はコンストラクタの interval
+
+        returns
+        -----
+        (np.ndarray, np.ndarray)
+            第一要素は shape=(格子点数,) の格子時刻 [sec]
+            第二要素は shape=(格子点数, デバイス数, 6) の int16 アレイ
+        """
+        interval = interval if interval > 0 else self._interval
+        data = [self.get_data(n) for n in range(len(self._clients))]
+        if not data or min(len(d[1]) for d in data) == 0:
+            return (np.zeros(0), np.zeros((0, len(data), 6), dtype=np.int16))
+        t0 = max(d[1][0] for d in data)
+        t1 = min(d[1][-1] for d in data)
+        grid = np.arange(t0, t1 + interval/2, interval)
+        aligned = np.empty((len(grid), len(data), 6), dtype=np.int16)
+        for n, (imu, stamp) in enumerate(data):
+            aligned[:, n] = imu[np.searchsorted(stamp, grid, side='right') - 1]
+        return (grid, aligned)
+
+    def get_stats(self)-> list:
+        """デバイス毎のサンプリングレート、欠落数
+
+        returns
+        -----
+        list
+            デバイス番号順の dict のリスト
+            address: BLEアドレス
+            samples: 受信サンプル数
+            rate: 受信データの平均サンプリングレート [Hz]
+            drop: リングバッファが一杯で破棄したサンプル数
+            missing: 受信期間と interval から推定した、受信できなかったサンプル数
+            max_gap: 受信時刻の最大間隔 [sec]
+        """
+        stats = []
+        for n, client in enumerate(self._clients):
+            imu, stamp = self.get_data(n)
+            duration = stamp[-1] - stamp[0] if len(stamp) > 1 else 0.0
+            expected = int(round(duration / self._interval)) + 1 if len(stamp) > 0 else 0
+            stats.append({'address': client.get_address(),
+                          'samples': len(imu),
+                          'rate': float((len(imu) - 1) / duration) if duration > 0 else 0.0,
+                          'drop': client.get_ring_status()['drop'],
+                          'missing': max(0, expected - len(imu)),
+                          'max_gap': float(np.max(np.diff(stamp))) if len(stamp) > 1 else 0.0})
+        return stats
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import math
+import os
+import time
+import numpy as np
+
+""" 静置データのアラン分散による、センサのバイアスと雑音の評価
+
+長時間の静置データから、6軸それぞれのオーバーラップ・アラン偏差を計算し、
+ランダムウォーク (角速度は ARW : Angle Random Walk)、バイアス不安定性、バイアス推定値を表示する。
+角速度のバイアス推定値は _BIAS_FILE に保存し、print_euler.py などの積算で、
+時刻ゼロの1サンプルの代わりにオフセット補正に使う (load_bias)。
+
+_CAPTURE_FILE が無い場合は、sampling.py と同じ手順で _CAPTURE_SEC [sec] の静置データを取得してから計算する。
+M5Stack ATOM-S3 は、取得中に動かないよう固定しておく。
+
+アラン分散は、積算値 (累積和) θ の2階差分から
+    σ^2(τ) = Σ(θ[k+2m] - 2θ[k+m] + θ[k])^2 / (2 τ^2 (N+1-2m)),  τ = m x 周期時間
+で計算する。m は対数間隔に num 個とるので、計算量は O(N num)。
+データはメモリマップで読み、累積和もファイル (work_file) に置けるので、数時間分のデータも扱える。
+"""
+
+_CAPTURE_FILE = "static.npy"      # 静置データファイル
+_CAPTURE_SEC = 3*3600             # 静置データの取得時間 [sec]
+_INTERVAL = 0.01                  # データサンプリング間隔 [sec]
+_BIAS_FILE = "gyro_bias.json"     # 角速度バイアス推定値の保存ファイル
+
+# 加速度バイナリを m/sec^2 に変換するゲイン (+-2g full scale)
+ACC_SCALE = 2*9.80665/65536
+# 角速度バイナリを rad/sec に変換するゲイン (+-250dps full scale)
+GYR_SCALE = 2*250/65536/180*math.pi
+# バイアス不安定性 = アラン偏差の最小値 / sqrt(2 ln2 / π)
+_BIAS_INSTABILITY_FACTOR = math.sqrt(2*math.log(2)/math.pi)
+
+def estimate_bias(data, chunk_size: int=1 << 20)-> np.ndarray:
+    """各列の平均値 (バイアス推定値)
+
+    Parameters
+    -----
+    data: array like shape=(サンプル点数, 列数) のデータ (メモリマップ可)
+    chunk_size: int, default 1<<20
+        一度に読み出す行数
+
+    Returns
+    -----
+    np.ndarray shape=(列数,) の float64 平均値
+    """
+    n = len(data)
+    total = np.zeros(data.shape[1])
+    for start in range(0, n, chunk_size):
+        total += np.sum(np.asarray(data[start:start+chunk_size], dtype=np.float64), axis=0)
+    return total/n
+
+def allan_deviation(data, interval: float, num: int=64, chunk_size: int=1 << 20, work_file: str=None)-> tuple:
+    """オーバーラップ・アラン偏差
+
+    Parameters
+    -----
+    data: array like
+        shape=(サンプル点数,) 又は (サンプル点数, 列数) の静置データ (メモリマップ可)
+    interval: float
+        データサンプリング間隔 [sec]
+    num: int, default 64
+        τ の点数 (1 周期 ～ データ長の 1/2 を対数間隔で。重複は除く)
+    chunk_size: int, default 1<<20
+        一度に処理する行数
+    work_file: str, default None
+        累積和を置くファイル名。None の場合はメモリ上に置く (サンプル点数 x 8byte)
+
+    Returns
+    -----
+    (np.ndarray, np.ndarray)
+        shape=(M,) の τ [sec]
+        shape=(M, 列数) のアラン偏差 (data と同じ単位)
+    """
+    if not isinstance(data, np.ndarray):
+        data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape((-1, 1))
+    n, columns = data.shape
+    if n < 3:
+        raise ValueError("at least 3 samples are required")
+    m = np.unique(np.round(np.logspace(0, math.log10((n - 1)//2), num)).astype(np.int64))
+    taus = m*interval
+    adev = np.empty((len(m), columns))
+    # 平均値を引いてから積算し、累積和の桁落ちを抑える (アラン分散は定数オフセットに依らない)
+    mean = estimate_bias(data, chunk_size)
+    if work_file is None:
+        theta = np.empty(n + 1)
+    else:
+        theta = np.memmap(work_file, dtype=np.float64, mode='w+', shape=(n + 1,))
+    try:
+        for axis in range(columns):
+            theta[0] = 0.0
+            carry = 0.0
+            for start in range(0, n, chunk_size):
+                x = (np.asarray(data[start:start+chunk_size, axis], dtype=np.float64) - mean[axis])*interval
+                c = np.cumsum(x)
+                c += carry
+                theta[start+1:start+1+len(c)] = c
+                carry = c[-1]
+            for j, mm in enumerate(m):
+                count = n + 1 - 2*mm
+                total = 0.0
+                for start in range(0, count, chunk_size):
+                    stop = min(start + chunk_size, count)
+                    d = theta[start+2*mm:stop+2*mm] - 2*theta[start+mm:stop+mm] + theta[start:stop]
+                    total += float(d @ d)
+                adev[j, axis] = math.sqrt(total/(2*taus[j]*taus[j]*count))
+    finally:
+        if work_file is not None:
+            del theta
+            os.remove(work_file)
+    return (taus, adev)
+
+def noise_parameters(taus, adev)-> dict:
+    """アラン偏差から雑音パラメータを読み取る
+
+    ランダムウォークは、アラン偏差の傾きが -1/2 に最も近い点を通る傾き -1/2 の直線の τ=1 での値。
+    バイアス不安定性は、アラン偏差の最小値 / 0.664。
+
+    Parameters
+    -----
+    taus: array like shape=(M,) の τ [sec]
+    adev: array like shape=(M, 列数) のアラン偏差
+
+    Returns
+    -----
+    dict
+        random_walk: shape=(列数,) ランダムウォーク [単位 x sqrt(sec)]
+        bias_instability: shape=(列数,) バイアス不安定性 [データと同じ単位]
+        tau_min: shape=(列数,) アラン偏差が最小になる τ [sec]
+    """
+    taus = np.asarray(taus, dtype=np.float64)
+    adev = np.asarray(adev, dtype=np.float64).reshape((len(taus), -1))
+    log_t = np.log10(taus)
+    log_a = np.log10(adev)
+    slope = np.gradient(log_a, log_t, axis=0) if len(taus) > 1 else np.full(adev.shape, -0.5)
+    i_rw = np.argmin(np.abs(slope + 0.5), axis=0)
+    i_min = np.argmin(adev, axis=0)
+    cols = np.arange(adev.shape[1])
+    return {'random_walk': adev[i_rw, cols]*np.sqrt(taus[i_rw]),
+            'bias_instability': adev[i_min, cols]/_BIAS_INSTABILITY_FACTOR,
+            'tau_min': taus[i_min]}
+
+def save_bias(file_name: str, gyr_bias, **info):
+    """角速度バイアス推定値を JSON ファイルに保存
+
+    Parameters
+    -----
+    file_name: str 保存ファイル名
+    gyr_bias: array like 3要素の角速度バイアス [バイナリ値]
+    info: 併せて保存する値 (JSON に変換できるもの)
+    """
+    value = {'gyr_bias': [float(v) for v in gyr_bias], 'updated': time.strftime("%Y-%m-%d %H:%M:%S")}
+    value.update(info)
+    with open(file_name, "w", encoding="utf-8") as f:
+        json.dump(value, f, indent=2)
+
+def load_bias(file_name: str, default=None):
+    """save_bias で保存した角速度バイアス推定値を読み出し
+
+    Parameters
+    -----
+    file_name: str 保存ファイル名
+    default: default None
+        ファイルが無い場合の戻り値
+
+    Returns
+    -----
+    np.ndarray or default 3要素の角速度バイアス [バイナリ値]
+    """
+    if not os.path.exists(file_name):
+        return default
+    with open(file_name, "r", encoding="utf-8") as f:
+        return np.array(json.load(f)['gyr_bias'], dtype=np.float64)
+
+
+if __name__ == '__main__':
+    if not os.path.exists(_CAPTURE_FILE):
+        # sampling.py と同じ手順で静置データを取得
+        import sampling
+        asyncio.run(sampling.main_loop(_CAPTURE_FILE, _CAPTURE_SEC))
+    # 6軸データをメモリマップで読み込む (タイムスタンプ付き (N, 9) の場合も先頭6列)
+    imu = np.load(_CAPTURE_FILE, mmap_mode='r')[:, :6]
+    print("samples : {} ({:.1f} sec)".format(len(imu), len(imu)*_INTERVAL))
+    taus, adev = allan_deviation(imu, _INTERVAL)
+    bias = estimate_bias(imu)
+    scale = np.array([ACC_SCALE]*3 + [GYR_SCALE]*3)
+    param = noise_parameters(taus, adev*scale)
+    names = ("acc_x", "acc_y", "acc_z", "gyr_x", "gyr_y", "gyr_z")
+    for axis in range(6):
+        if axis < 3:
+            # 速度ランダムウォーク [m/sec/sqrt(h)]、バイアス不安定性 [m/sec^2]
+            print("{} : VRW {:.4g} m/s/sqrt(h), bias instability {:.4g} m/s^2 (tau {:.3g} s), mean {:.1f} LSB".format(
+                names[axis], param['random_walk'][axis]*60, param['bias_instability'][axis], param['tau_min'][axis], bias[axis]))
+        else:
+            # 角度ランダムウォーク [deg/sqrt(h)]、バイアス不安定性 [deg/h]
+            print("{} : ARW {:.4g} deg/sqrt(h), bias instability {:.4g} deg/h (tau {:.3g} s), bias {:.2f} LSB".format(
+                names[axis], math.degrees(param['random_walk'][axis])*60, math.degrees(param['bias_instability'][axis])*3600,
+                param['tau_min'][axis], bias[axis]))
+    save_bias(_BIAS_FILE, bias[3:], samples=len(imu), interval=_INTERVAL,
+              arw_deg_per_sqrt_h=[math.degrees(v)*60 for v in param['random_walk'][3:]],
+              bias_instability_deg_per_h=[math.degrees(v)*3600 for v in param['bias_instability'][3:]])
+    print("gyro bias saved : {}".format(_BIAS_FILE))
@@ -0,0 +1,187 @@
+""" 6軸IMUデータの逐次ファイル保存ライブラリ(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+BLE で受信した 6軸IMUデータを、受信の都度 numpy 形式(.npy) のファイルに追記保存します。
+受信データをメモリに溜め込まず、取得中のファイルも常に np.load で読める状態に保ちます。
+
+.npy ファイルのヘッダは固定長(128byte) で書き、サンプル点数は一定点数毎とクローズ時に
+書き換えます。ヘッダの点数より後ろの書きかけのデータは np.load では無視されるので、
+途中で異常終了しても、ファイルは取得データの先頭部分として読み込めます。
+
+in_memory=True の場合はファイルに逐次書かず、bytearray に追記して、クローズ時に保存します。
+
+============
+使用例
+============
+from capture_writer import CaptureWriter
+
+with CaptureWriter("sampling.npy") as writer:
+    # 12byte の bytes/bytearray, または shape=(k, 6) の int16 アレイを追記
+    writer.append(raw_data)
+# クローズ後は、通常の np.load で読み込める
+imu = np.load("sampling.npy")
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import struct
+import numpy as np
+
+# .npy ヘッダの固定長 [byte] (マジック文字列、バージョン、ヘッダ長を含む)
+_HEADER_BYTES = 128
+
+def _npy_header(descr: str, rows: int, columns: int)-> bytes:
+    """固定長の .npy ヘッダ (format version 1.0) を作成
+
+    Parameters
+    -----
+    descr: str
+        データ型の記述子 (例 '<i2')
+    rows: int
+        サンプル点数
+    columns: int
+        1サンプルのデータ数
+
+    Returns
+    -----
+    bytes: _HEADER_BYTES 長のヘッダ
+    """
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({}, {}), }}".format(descr, rows, columns)
+    header = header.ljust(_HEADER_BYTES - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+class CaptureWriter:
+    """6軸IMUデータを .npy ファイルに逐次追記する
+
+    提供メソッド
+    -----
+    append(data)
+        データ追記
+    flush()
+        書き込み済みデータをファイルに反映し、ヘッダのサンプル点数を更新
+    close()
+        ファイルを閉じる
+    get_rows()
+        追記済みサンプル点数
+    get_array()
+        追記済みデータを np.ndarray で取得
+    """
+    def __init__(self, file_name: str, columns: int=6, dtype=np.int16, in_memory: bool=False, flush_rows: int=100):
+        """コンストラクタ
+
+        Parameters
+        -----
+        file_name: str
+            保存ファイル名 (.npy)
+        columns: int, default 6
+            1サンプルのデータ数
+        dtype: default np.int16
+            データ型
+        in_memory: bool, default False
+            True の場合、bytearray に追記してクローズ時にファイル保存する
+        flush_rows: int, default 100
+            ファイル追記時、この点数毎にヘッダのサンプル点数を更新する
+        """
+        self._file_name = file_name
+        self._columns = columns
+        self._dtype = np.dtype(dtype)
+        self._row_bytes = columns * self._dtype.itemsize
+        self._in_memory = in_memory
+        self._flush_rows = flush_rows
+        self._bytes = 0           # 追記済みバイト数
+        self._header_rows = 0     # ヘッダに書かれたサンプル点数
+        self._buf = bytearray()
+        self._file = None
+        if not in_memory:
+            self._file = open(file_name, 'wb')
+            self._file.write(_npy_header(np.lib.format.dtype_to_descr(self._dtype), 0, columns))
+            self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, data):
+        """データ追記
+
+        Parameters
+        -----
+        data: bytes or bytearray or np.ndarray
+            バイナリデータ列、または shape=(k, columns) のアレイ
+            バイナリデータ列がサンプル途中で切れていても、続きの追記で補われる
+        """
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data, dtype=self._dtype)
+        if self._in_memory:
+            self._buf += data
+            self._bytes = len(self._buf)
+        else:
+            self._file.write(data)
+            self._bytes += memoryview(data).nbytes
+            if self.get_rows() - self._header_rows >= self._flush_rows:
+                self.flush()
+
+    def flush(self):
+        """書き込み済みデータをファイルに反映し、ヘッダのサンプル点数を更新
+
+        データを先にファイルに反映してからヘッダを書き換えるので、
+        ファイルは常に np.load で読める状態になる。
+        """
+        if self._file is None:
+            return
+        self._file.flush()
+        rows = self.get_rows()
+        self._file.seek(0)
+        self._file.write(_npy_header(np.lib.format.dtype_to_descr(self._dtype), rows, self._columns))
+        self._file.seek(0, 2)
+        self._file.flush()
+        self._header_rows = rows
+
+    def close(self):
+        """ファイルを閉じる
+
+        in_memory=True の場合は、ここでファイル保存する。
+        サンプル途中で切れた末尾のデータは破棄される。
+        """
+        if self._in_memory:
+            if self._file_name:
+                np.save(self._file_name, self.get_array())
+                self._file_name = ""
+        elif self._file is not None:
+            self.flush()
+            self._file.truncate(_HEADER_BYTES + self.get_rows() * self._row_bytes)
+            self._file.close()
+            self._file = None
+
+    def get_rows(self)-> int:
+        """追記済みサンプル点数
+
+        Returns
+        -----
+        int サンプル点数
+        """
+        return self._bytes // self._row_bytes
+
+    def get_array(self)-> np.ndarray:
+        """追記済みデータを取得
+
+        Returns
+        -----
+        np.ndarray
+            shape=(サンプル点数, columns) のアレイ。
+            ファイル追記の場合は、ファイルを読み出し専用でメモリマップしたもの
+        """
+        rows = self.get_rows()
+        if self._in_memory:
+            return np.frombuffer(self._buf, dtype=self._dtype, count=rows*self._columns).reshape((rows, self._columns)).copy()
+        self.flush()
+        return np.load(self._file_name, mmap_mode='r')
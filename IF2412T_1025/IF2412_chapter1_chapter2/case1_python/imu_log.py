@@ -0,0 +1,405 @@
+""" チャンク分割・圧縮した IMUログファイルの読み書きライブラリ(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+6軸IMUデータを、取得中に一定サンプル数 (チャンク) 毎に圧縮して追記するログ形式 (.imulog) です。
+デバイス名、BLEアドレス、サンプリングレート、フルスケール、校正値などのメタデータを先頭に持ち、
+末尾のチャンク索引 (各チャンクの位置と時刻範囲) から、任意の時間範囲だけを読み出せます。
+読み出しはファイルをメモリマップし、必要なチャンクだけを展開するので、長時間のログでも
+全体を読み込む必要はありません。
+
+取得途中で中断して末尾の索引が無いファイルも、チャンクを先頭から辿って読み出せます。
+
+============
+ファイル形式
+============
+ヘッダ   : "IMULOG\\x00\\x01" (8byte) + メタデータ長 (uint32) + メタデータ (JSON, UTF-8)
+チャンク : "CHNK" + 行数 (uint32) + 圧縮後バイト数 (uint32) + 先頭行番号 (uint64)
+           + 先頭時刻 (float64) + 末尾時刻 (float64) + 圧縮データ (zlib)
+    圧縮データは列毎に並べ替えたデータ (整数型は列毎に差分をとったもの)。
+    メタデータの timed が true なら、その後に各行の時刻 (float64) が続く。
+索引     : チャンク毎の (位置, 行数, 先頭行番号, 先頭時刻, 末尾時刻) の配列
+           + "IMULOGIX" + 索引の位置 (uint64) + チャンク数 (uint64)
+時刻は先頭サンプルを 0 とした [sec]。timed が false の場合は 行番号 / rate。
+
+============
+使用例
+============
+from imu_log import ImuLogWriter, ImuLogReader, convert_npy
+
+# 取得中に追記
+with ImuLogWriter("sampling.imulog", {'device_name': "IMU_BASE", 'rate': 100.0}) as writer:
+    writer.append(arr_imu)
+# 5秒～6秒の範囲だけ読み出す
+with ImuLogReader("sampling.imulog") as reader:
+    print(reader.get_metadata())
+    imu, t = reader.read_time(5.0, 6.0)
+# 既存の .npy を変換 (コマンドでは python imu_log.py sampling.npy 100)
+convert_npy("sampling.npy", "sampling.imulog", rate=100.0)
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import json
+import mmap
+import struct
+import sys
+import time
+import zlib
+import numpy as np
+from imu_packet import decode_stamped, unwrap_counter, TICK_PERIOD, TICK_SEC
+
+_MAGIC = b'IMULOG\x00\x01'
+_INDEX_MAGIC = b'IMULOGIX'
+_CHUNK_MAGIC = b'CHNK'
+_CHUNK_HEADER = struct.Struct('<4sIIQdd')
+_TRAILER = struct.Struct('<8sQQ')
+_INDEX_DTYPE = np.dtype([('offset', '<u8'), ('rows', '<u4'), ('first', '<u8'), ('t_first', '<f8'), ('t_last', '<f8')])
+
+# imu_base の既定のメタデータ (MPU6886 のフルスケール設定)
+DEFAULT_METADATA = {
+    'device_name': "IMU_BASE",
+    'address': "",
+    'rate': 100.0,          # サンプリングレート [Hz] (0 は一定レートでない)
+    'acc_range_g': 2.0,     # 加速度フルスケール [g]
+    'gyr_range_dps': 250.0, # 角速度フルスケール [deg/sec]
+    'columns': ["acc_x", "acc_y", "acc_z", "gyr_x", "gyr_y", "gyr_z"],
+}
+
+class ImuLogWriter:
+    """IMUログファイルへのチャンク単位の追記
+
+    提供メソッド
+    -----
+    append(data, t=None)
+        データを追記 (chunk_rows 行溜まる毎に圧縮してファイルに書く)
+    flush()
+        溜まっているデータを、chunk_rows 未満でもチャンクとして書く
+    close()
+        残りのデータと索引を書いて閉じる
+    get_rows()
+        追記済みの行数
+    """
+    def __init__(self, file_name: str, metadata: dict=None, columns: int=6, dtype=np.int16,
+                 chunk_rows: int=1024, timed: bool=False, level: int=6):
+        """コンストラクタ
+
+        Parameters
+        -----
+        file_name: str
+            保存ファイル名 (既存のファイルは上書き)
+        metadata: dict, default None
+            メタデータ。DEFAULT_METADATA に上書きして保存する (JSON に変換できる値)
+        columns: int, default 6
+            1行の要素数
+        dtype: default np.int16
+            データ型
+        chunk_rows: int, default 1024
+            1チャンクの行数
+        timed: bool, default False
+            True の場合、append の t で与えた各行の時刻を保存する。
+            False の場合、時刻は 行番号 / rate とする
+        level: int, default 6
+            zlib の圧縮レベル (0～9)
+        """
+        self._columns = columns
+        self._dtype = np.dtype(dtype).newbyteorder('<')
+        self._chunk_rows = chunk_rows
+        self._timed = timed
+        self._level = level
+        self._metadata = dict(DEFAULT_METADATA)
+        if metadata:
+            self._metadata.update(metadata)
+        self._metadata.update({'dtype': self._dtype.str, 'ncols': columns, 'timed': timed,
+                               'chunk_rows': chunk_rows, 'created': time.strftime("%Y-%m-%d %H:%M:%S")})
+        self._rate = float(self._metadata.get('rate') or 0.0)
+        self._buf = np.empty((chunk_rows, columns), dtype=self._dtype)
+        self._time = np.empty(chunk_rows)
+        self._pending = 0
+        self._rows = 0
+        self._index = []
+        self._file = open(file_name, "wb")
+        meta = json.dumps(self._metadata).encode('utf-8')
+        self._file.write(_MAGIC + struct.pack('<I', len(meta)) + meta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, data, t=None):
+        """データを追記
+
+        Parameters
+        -----
+        data: bytes or array like
+            shape=(行数, columns) のアレイ、又は dtype の生データ列
+        t: array like, default None
+            timed=True の場合の、各行の時刻 [sec] shape=(行数,)
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = np.frombuffer(data, dtype=self._dtype)
+        data = np.asarray(data, dtype=self._dtype).reshape((-1, self._columns))
+        if self._timed:
+            if t is None:
+                raise ValueError("t is required for a timed log")
+            t = np.asarray(t, dtype=np.float64).reshape(-1)
+        pos = 0
+        while pos < len(data):
+            n = min(len(data) - pos, self._chunk_rows - self._pending)
+            self._buf[self._pending:self._pending+n] = data[pos:pos+n]
+            if self._timed:
+                self._time[self._pending:self._pending+n] = t[pos:pos+n]
+            self._pending += n
+            pos += n
+            if self._pending == self._chunk_rows:
+                self.flush()
+
+    def flush(self):
+        """溜まっているデータを、chunk_rows 未満でもチャンクとして書く"""
+        if self._pending == 0 or self._file is None:
+            return
+        rows = self._pending
+        block = self._buf[:rows]
+        if self._dtype.kind in 'iu':
+            # 列毎の差分 (整数型は桁あふれしても、累積和で元に戻る)
+            block = np.diff(block, axis=0, prepend=np.zeros((1, self._columns), dtype=self._dtype))
+        payload = np.ascontiguousarray(block.T).tobytes()
+        if self._timed:
+            t = self._time[:rows]
+            payload += t.tobytes()
+        else:
+            t = (self._rows + np.array([0, rows - 1]))/self._rate if self._rate > 0 else np.array([self._rows, self._rows + rows - 1], dtype=np.float64)
+        data = zlib.compress(payload, self._level)
+        offset = self._file.tell()
+        self._file.write(_CHUNK_HEADER.pack(_CHUNK_MAGIC, rows, len(data), self._rows, float(t[0]), float(t[-1])))
+        self._file.write(data)
+        self._file.flush()
+        self._index.append((offset, rows, self._rows, float(t[0]), float(t[-1])))
+        self._rows += rows
+        self._pending = 0
+
+    def close(self):
+        """残りのデータと索引を書いて閉じる"""
+        if self._file is None:
+            return
+        self.flush()
+        offset = self._file.tell()
+        self._file.write(np.array(self._index, dtype=_INDEX_DTYPE).tobytes())
+        self._file.write(_TRAILER.pack(_INDEX_MAGIC, offset, len(self._index)))
+        self._file.close()
+        self._file = None
+
+    def get_rows(self)-> int:
+        """追記済みの行数"""
+        return self._rows + self._pending
+
+class ImuLogReader:
+    """IMUログファイルの読み出し (メモリマップ)
+
+    提供メソッド
+    -----
+    get_metadata()
+        メタデータ
+    get_rows()
+        全行数
+    get_duration()
+        先頭から末尾サンプルまでの時間 [sec]
+    read_rows(start=0, stop=None)
+        行番号の範囲を読み出し
+    read_time(t_start, t_stop)
+        時刻の範囲を読み出し
+    close()
+        ファイルを閉じる
+    """
+    def __init__(self, file_name: str):
+        """コンストラクタ
+
+        Parameters
+        -----
+        file_name: str 読み出すファイル名
+        """
+        self._file = open(file_name, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("not an imu log file: {}".format(file_name))
+        meta_len = struct.unpack_from('<I', self._map, len(_MAGIC))[0]
+        start = len(_MAGIC) + 4
+        self._metadata = json.loads(bytes(self._map[start:start+meta_len]).decode('utf-8'))
+        self._dtype = np.dtype(self._metadata['dtype'])
+        self._columns = self._metadata['ncols']
+        self._timed = self._metadata['timed']
+        self._rate = float(self._metadata.get('rate') or 0.0)
+        self._index = self._read_index(start + meta_len)
+        self._first = self._index['first'].astype(np.int64)
+        self._rows = int(self._first[-1] + self._index['rows'][-1]) if len(self._index) else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _read_index(self, data_start: int)-> np.ndarray:
+        """末尾の索引を読む。索引が無い (取得途中で中断した) 場合は、チャンクを辿って作る"""
+        size = len(self._map)
+        if size >= data_start + _TRAILER.size:
+            magic, offset, count = _TRAILER.unpack_from(self._map, size - _TRAILER.size)
+            if magic == _INDEX_MAGIC and offset + count*_INDEX_DTYPE.itemsize == size - _TRAILER.size:
+                return np.frombuffer(self._map, dtype=_INDEX_DTYPE, count=count, offset=offset).copy()
+        index = []
+        pos = data_start
+        while pos + _CHUNK_HEADER.size <= size:
+            magic, rows, nbytes, first, t_first, t_last = _CHUNK_HEADER.unpack_from(self._map, pos)
+            if magic != _CHUNK_MAGIC or pos + _CHUNK_HEADER.size + nbytes > size:
+                break
+            index.append((pos, rows, first, t_first, t_last))
+            pos += _CHUNK_HEADER.size + nbytes
+        return np.array(index, dtype=_INDEX_DTYPE)
+
+    def _read_chunk(self, n: int)-> tuple:
+        """n 番目のチャンクを展開して (データ, 時刻) を得る"""
+        offset, rows = int(self._index['offset'][n]), int(self._index['rows'][n])
+        nbytes = _CHUNK_HEADER.unpack_from(self._map, offset)[2]
+        start = offset + _CHUNK_HEADER.size
+        payload = zlib.decompress(self._map[start:start+nbytes])
+        block = np.frombuffer(payload, dtype=self._dtype, count=rows*self._columns).reshape((self._columns, rows)).T
+        if self._dtype.kind in 'iu':
+            block = np.cumsum(block, axis=0, dtype=self._dtype)
+        if self._timed:
+            t = np.frombuffer(payload, dtype=np.float64, offset=rows*self._columns*self._dtype.itemsize)
+        else:
+            t = self._row_time(self._first[n] + np.arange(rows))
+        return (block, t)
+
+    def _row_time(self, row)-> np.ndarray:
+        return row/self._rate if self._rate > 0 else np.asarray(row, dtype=np.float64)
+
+    def get_metadata(self)-> dict:
+        """メタデータ (デバイス名、サンプリングレート、フルスケール、校正値など)"""
+        return dict(self._metadata)
+
+    def get_rows(self)-> int:
+        """全行数"""
+        return self._rows
+
+    def get_duration(self)-> float:
+        """先頭から末尾サンプルまでの時間 [sec]"""
+        if len(self._index) == 0:
+            return 0.0
+        return float(self._index['t_last'][-1] - self._index['t_first'][0])
+
+    def read_rows(self, start: int=0, stop: int=None)-> tuple:
+        """行番号の範囲 start <= 行番号 < stop を読み出し
+
+        Parameters
+        -----
+        start: int, default 0
+            先頭の行番号
+        stop: int, default None
+            末尾の行番号 + 1。None の場合は最後まで
+
+        Returns
+        -----
+        (np.ndarray, np.ndarray)
+            shape=(行数, 列数) のデータ
+            shape=(行数,) の時刻 [sec]
+        """
+        stop = self._rows if stop is None else min(stop, self._rows)
+        start = max(0, start)
+        if start >= stop:
+            return (np.empty((0, self._columns), dtype=self._dtype), np.empty(0))
+        first = np.searchsorted(self._first, start, side='right') - 1
+        last = np.searchsorted(self._first, stop, side='left')
+        blocks, times = [], []
+        for n in range(first, last):
+            block, t = self._read_chunk(n)
+            lo = max(start - self._first[n], 0)
+            hi = min(stop - self._first[n], len(block))
+            blocks.append(block[lo:hi])
+            times.append(t[lo:hi])
+        return (np.concatenate(blocks), np.concatenate(times))
+
+    def read_time(self, t_start: float, t_stop: float)-> tuple:
+        """時刻の範囲 t_start <= 時刻 < t_stop を読み出し
+
+        チャンク索引の時刻範囲から、該当するチャンクだけを展開する。
+
+        Parameters
+        -----
+        t_start: float 先頭の時刻 [sec]
+        t_stop: float 末尾の時刻 [sec]
+
+        Returns
+        -----
+        (np.ndarray, np.ndarray)
+            shape=(行数, 列数) のデータ
+            shape=(行数,) の時刻 [sec]
+        """
+        # 時刻範囲が重なるチャンクだけを展開
+        hit = np.nonzero((self._index['t_last'] >= t_start) & (self._index['t_first'] < t_stop))[0]
+        blocks, times = [np.empty((0, self._columns), dtype=self._dtype)], [np.empty(0)]
+        for n in hit:
+            block, t = self._read_chunk(n)
+            mask = (t >= t_start) & (t < t_stop)
+            blocks.append(block[mask])
+            times.append(t[mask])
+        return (np.concatenate(blocks), np.concatenate(times))
+
+    def close(self):
+        """ファイルを閉じる"""
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+
+def convert_npy(npy_file: str, log_file: str, rate: float=100.0, chunk_rows: int=1024, **metadata)-> int:
+    """既存の .npy ファイル (sampling.npy, sample_one.npy など) を IMUログファイルに変換
+
+    shape=(N, 9) のタイムスタンプ付きデータは、タイムスタンプから得た時刻を保存する。
+
+    Parameters
+    -----
+    npy_file: str 変換元の .npy ファイル名
+    log_file: str 変換先の IMUログファイル名
+    rate: float, default 100.0
+        サンプリングレート [Hz]。sample_one.npy のように一定レートでない場合は 0
+    chunk_rows: int, default 1024
+        1チャンクの行数
+    metadata: メタデータに追加する値 (device_name, address, calibration など)
+
+    Returns
+    -----
+    int 変換した行数
+    """
+    data = np.load(npy_file, mmap_mode='r')
+    metadata = dict(metadata, rate=rate, source=npy_file)
+    timed = data.shape[1] == 9
+    if timed:
+        metadata['columns'] = DEFAULT_METADATA['columns'] + ["seq", "tick_l", "tick_h"]
+    with ImuLogWriter(log_file, metadata, columns=data.shape[1], dtype=data.dtype,
+                      chunk_rows=chunk_rows, timed=timed) as writer:
+        if timed:
+            tick = decode_stamped(data)[2]
+            t = (unwrap_counter(tick, TICK_PERIOD) - int(tick[0]))*TICK_SEC if len(tick) else np.empty(0)
+            writer.append(data, t)
+        else:
+            for start in range(0, len(data), chunk_rows):
+                writer.append(data[start:start+chunk_rows])
+        return writer.get_rows()
+
+
+if __name__ == '__main__':
+    # python imu_log.py [変換元 .npy (既定 sampling.npy)] [サンプリングレート Hz (既定 100)]
+    npy_file = sys.argv[1] if len(sys.argv) > 1 else "sampling.npy"
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 100.0
+    log_file = npy_file.rsplit('.', 1)[0] + ".imulog"
+    rows = convert_npy(npy_file, log_file, rate)
+    print("{} -> {} : {} rows".format(npy_file, log_file, rows))
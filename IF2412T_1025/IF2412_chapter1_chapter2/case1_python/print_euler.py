@@ -2,37 +2,56 @@ import numpy as np
 import matplotlib.pyplot as plt
 # 本誌オリジナルのクオータニオン演算ライブラリ
 from cq_quaternion import *
+from imu_packet import decode_stamped, fill_gaps, sample_intervals
+# 角速度バイアス推定値 (allan.py で長時間の静置データから求めたもの)
+from allan import load_bias
 
 """ 取得した6軸IMUデータからオイラー角を表示
 
 sampling.py により10秒間取得した6軸IMUデータから、
 センサの姿勢を示すオイラー角を計算して表示
+
+シーケンス番号とタイムスタンプ付きで取得したデータ (sampling.py で _STAMPED = True) の場合は、
+欠落サンプルを補間し、タイムスタンプから得た実際のサンプリング間隔で積算する。
+
+allan.py で求めた角速度バイアス推定値 (_BIAS_FILE) があれば、時刻ゼロの角速度の代わりに
+オフセット補正に使う。
 """
 
 # numpy形式データファイル
 _SAVE_FILE = "sampling.npy"
 # データサンプリング間隔 [sec]
 _INTERVAL = 0.01
+# 角速度バイアス推定値ファイル
+_BIAS_FILE = "gyro_bias.json"
 
 # sampling.py で収集した6軸慣性センサバイナリデータ
 # imu.shape -> (サンプル点, 6) の次元
 # 6 の要素は、x,y,z加速度、x,y,z角速度の順
-imu = np.load(_SAVE_FILE).astype('float64')
+imu = np.load(_SAVE_FILE)
+if imu.shape[1] == 9:
+    # タイムスタンプ付き (サンプル点, 9) は、欠落を補間して各サンプルの時刻を得る
+    imu, t, valid = fill_gaps(*decode_stamped(imu))
+    print("interpolated samples : {}".format(np.count_nonzero(~valid)))
+    interval = sample_intervals(t, _INTERVAL)
+else:
+    imu = imu.astype('float64')
+    interval = _INTERVAL
 # 基準座標系は時刻ゼロ時の機体座標とする。
 # 機体座標 = 基準座標 = 回転ゼロ の回転クオータニオンは 1
 q = Quaternion(1,0,0,0)
-# 各時刻のオイラー角格納データ
-euler = []
 # 時刻ゼロの角速度データは、静置とみなし、オフセット補正
+# (バイアス推定値ファイルがあれば、1サンプルよりも精度の良いその値で補正)
 # ゲインは理論値(±250dpsフルレンジ)を、[rad/sec] に変換
-gyr = (2*250/65536*np.pi/180)*(imu[:, 3:] - imu[0, 3:])
-for i in range(gyr.shape[0]):
-    # 角速度[rad/sec] から、式(15) で回転クオータニオン更新
-    q.integralAngleVelocity(gyr[i, :], _INTERVAL)
-    # クオータニオンからオイラー角 [rad]へ変換 式(16-18)
-    euler.append(q.getEuler())
+gyr_bias = load_bias(_BIAS_FILE, imu[0, 3:])
+gyr = (2*250/65536*np.pi/180)*(imu[:, 3:] - gyr_bias)
+# 角速度[rad/sec] から、式(15) で回転クオータニオンを全時刻分まとめて更新し、
+# 各時刻のクオータニオンからオイラー角 [rad]へ変換 式(16-18)
+# method="euler" は q.integralAngleVelocity() を1サンプル毎に呼ぶのと同じ結果になる。
+# method="exp" にすると、1次近似ではない厳密な回転増分で積算する。
+q_track, euler = integralAngleVelocityArray(gyr, interval, q, method="euler")
 # オイラー角の単位をラジアンから度に変換
-euler_arr = (180/np.pi) * np.array(euler)
+euler_arr = (180/np.pi) * euler
 plt.plot(euler_arr[:,0], label='roll')
 plt.plot(euler_arr[:,1], label='pitch')
 plt.plot(euler_arr[:,2], label='yaw')
@@ -1,6 +1,11 @@
 from BleUart import BleUartClient
+from capture_writer import CaptureWriter
+from imu_packet import STAMPED_SAMPLE_BYTES
+from imu_log import ImuLogWriter
+from calibration import CalibrationStore
 import numpy as np
 import asyncio
+import contextlib
 from concurrent.futures import ThreadPoolExecutor
 import time
 
@@ -8,7 +13,8 @@ import time
 
 コンソール画面にキーボード入力が促されたら、何らかのキー入力する。
 以後所定時間 (_TIMEOVER_SEC) [sec] の間 6軸IMU データを取得する。
-最後に numpy形式の所定ファイル名 (_SAVE_FILE) に、データを保存する。
+データは受信の都度 numpy形式の所定ファイル名 (_SAVE_FILE) に追記保存する。
+取得途中のファイルも、その時点までのデータとして np.load で読み込める。
 
 保存ファイルは、int16型で (サンプル点数, 6) サイズの2次元アレイ。
 
@@ -18,11 +24,28 @@ import time
 [:, 3] => x軸角速度バイナリ (-32768～+32767 が -250dps～+250dps に対応)
 [:, 4] => y軸角速度バイナリ (-32768～+32767 が -250dps～+250dps に対応)
 [:, 5] => z軸角速度バイナリ (-32768～+32767 が -250dps～+250dps に対応)
+
+_STAMPED = True の場合は、シーケンス番号とタイムスタンプ付きのデータ("t" コマンド) を取得し、
+受信データ 18byte をそのまま int16型で (サンプル点数, 9) サイズの2次元アレイとして保存する。
+[:, 0:6] は上記と同じで、[:, 6:9] はシーケンス番号とタイムスタンプ (imu_packet.decode_stamped で復号)。
+
+_PACKED = True の場合は、複数サンプルをまとめたデータ("p" コマンド) を取得する。
+保存ファイルは _STAMPED = False の場合と同じ。BLE 側で欠落したサンプル数を表示する。
+
+_LOG_FILE を指定すると、同じデータをチャンク分割・圧縮した IMUログファイル (imu_log.py) にも
+受信の都度保存する。デバイス名、BLEアドレス、サンプリングレート、フルスケールと、
+_CALIBRATION_FILE にある接続デバイスの加速度センサ校正値をメタデータとして記録する。
 """
 
 _TIMEOVER_SEC = 10
 _DEVICE_NAME = "IMU_BASE"
 _SAVE_FILE = "sampling.npy"
+_RING_SIZE = 1024  # 受信リングバッファのサンプル数
+_STAMPED = False   # True: シーケンス番号とタイムスタンプ付きで取得
+_PACKED = False    # True: 複数サンプルをまとめた notify で取得 (_STAMPED = False の場合)
+_LOG_FILE = None   # IMUログファイルにも保存する場合のファイル名 (例 "sampling.imulog")
+_CALIBRATION_FILE = "calibration.json"  # IMUログファイルに記録する加速度センサ校正値ファイル
+_RATE = 100.0      # サンプリングレート [Hz] (IMUログファイルのメタデータ)
 
 async def ainput(prompt: str = "") -> str:
     """非同期でキーボード入力を待つ
@@ -39,24 +62,66 @@ async def ainput(prompt: str = "") -> str:
     with ThreadPoolExecutor(1, "ainput") as executor:
         return await asyncio.get_event_loop().run_in_executor(executor, input, prompt)
 
-async def main_loop():
-    client = BleUartClient(_DEVICE_NAME)
-    receive_queue = client.get_queue()
+async def main_loop(save_file: str=_SAVE_FILE, timeover_sec: float=_TIMEOVER_SEC):
+    """所定時間の 6軸IMUデータを取得して、ファイルに追記保存
+
+    Parameters
+    -----
+    save_file: str, default _SAVE_FILE
+        保存ファイル名
+    timeover_sec: float, default _TIMEOVER_SEC
+        取得時間 [sec] (allan.py の長時間の静置データ取得でも使う)
+    """
+    if _STAMPED:
+        packet, command = "stamped", b't'
+    elif _PACKED:
+        packet, command = "packed", b'p'
+    else:
+        packet, command = "raw", b'b'
+    client = BleUartClient(_DEVICE_NAME, ring_size=_RING_SIZE, packet=packet)
     await client.connect()
     if not client.is_connected():
         return
 
-    data = b''
     key = await ainput("start ok? >>")  # なんらかのキー入力待ち
-    await client.write(b'b')    # IMUデータ連続送信 ON
-    start = time.time()
-    # 所定時間の間の受信バイナリデータを累積
-    while time.time() - start < _TIMEOVER_SEC:
-        data += await receive_queue.get()
-    await client.write(b'e')    # IMUデータ連続送信 OFF
+    columns = STAMPED_SAMPLE_BYTES//2 if _STAMPED else 6
+    if _LOG_FILE:
+        calib = CalibrationStore(_CALIBRATION_FILE).load(client.get_address())
+        metadata = {'device_name': _DEVICE_NAME, 'address': client.get_address(), 'rate': _RATE,
+                    'packet': packet, 'calibration': None if calib is None else calib.to_dict()}
+        log_writer = ImuLogWriter(_LOG_FILE, metadata, columns=columns)
+    else:
+        log_writer = contextlib.nullcontext()
+    with CaptureWriter(save_file, columns=columns) as writer, log_writer:
+        await client.write(command)    # IMUデータ連続送信 ON
+        start = time.time()
+        # 所定時間の間の受信データを、受信の都度ファイルに追記
+        while True:
+            remain = timeover_sec - (time.time() - start)
+            if remain <= 0:
+                break
+            # 次の受信を待たずに所定時間で打ち切れるよう、残り時間でタイムアウトさせる
+            try:
+                arr_imu = await asyncio.wait_for(client.get_samples(), remain)
+            except asyncio.TimeoutError:
+                break
+            # 終端データ受信(ディスプレイボタン長押し) で受信終了
+            if len(arr_imu) == 0:
+                break
+            if _STAMPED:
+                # 18byte の構造化アレイを、int16 x 9 のアレイとして保存
+                arr_imu = arr_imu.view(np.int16).reshape((-1, STAMPED_SAMPLE_BYTES//2))
+            writer.append(arr_imu)
+            if _LOG_FILE:
+                log_writer.append(arr_imu)
+        await client.write(b'e')    # IMUデータ連続送信 OFF
     await client.disconnect()
-    # バイナリデータ列は、符号付16bitリトルエンディアン形式なので、int16型に復元
-    # 行列サイズを (サンプル点数) x 6 に変形
+    status = client.get_ring_status()
+    if status['drop'] > 0:
+        print("dropped samples : {}".format(status['drop']))
+    if status['missing'] > 0:
+        print("missing samples : {}".format(status['missing']))
+    # 受信データは、リングバッファで int16型 (サンプル点数) x 6 に復元済
     #
     # M5Stack Atom S3 から PC に送られるデータは、notify データとして送られる。
     # 1回の notify データは、1回の IMUデータサンプリングに対応する 12byte 。
@@ -69,7 +134,6 @@ async def main_loop():
     # arr_imu[:, 3] => x軸角速度バイナリ (-32768～+32767 が -250dps～+250dps に対応)
     # arr_imu[:, 4] => y軸角速度バイナリ (-32768～+32767 が -250dps～+250dps に対応)
     # arr_imu[:, 5] => z軸角速度バイナリ (-32768～+32767 が -250dps～+250dps に対応)
-    arr_imu = np.frombuffer(data, dtype=np.int16).reshape((-1,6))
-    np.save(_SAVE_FILE, arr_imu)
 
-asyncio.run(main_loop())
\ No newline at end of file
+if __name__ == '__main__':
+    asyncio.run(main_loop())
@@ -0,0 +1,46 @@
+from BleUartGroup import BleUartGroup
+import numpy as np
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+""" 複数台の 6軸IMUデータを同時に所定時間取得して、numpy形式のファイル保存
+
+同じデバイス名 (_DEVICE_NAME) の M5Stack ATOM-S3 を全て(最大 _MAX_DEVICES 台)接続する。
+コンソール画面にキーボード入力が促されたら、何らかのキー入力する。
+以後所定時間 (_TIMEOVER_SEC) [sec] の間、全デバイスから同時に 6軸IMU データを取得する。
+最後に全デバイスのデータを受信時刻順に統合し、numpy形式の所定ファイル名 (_SAVE_FILE) に保存する。
+
+保存ファイルは、BleUartGroup.MERGED_DTYPE 型の構造化アレイ。
+['time']   => 受信開始からの PC 側受信時刻 [sec]
+['device'] => デバイス番号 (起動時に表示される BLEアドレスの順番)
+['imu']    => 6軸IMUデータ int16 (sampling.py の保存データの1行と同じ並び)
+"""
+
+_TIMEOVER_SEC = 10
+_DEVICE_NAME = "IMU_BASE"
+_MAX_DEVICES = 8
+_SAVE_FILE = "sampling_multi.npy"
+
+async def ainput(prompt: str = "") -> str:
+    """非同期でキーボード入力を待つ"""
+    with ThreadPoolExecutor(1, "ainput") as executor:
+        return await asyncio.get_event_loop().run_in_executor(executor, input, prompt)
+
+async def main_loop():
+    group = BleUartGroup(_DEVICE_NAME, _MAX_DEVICES)
+    if await group.connect() == 0:
+        return
+    for n, address in enumerate(group.get_addresses()):
+        print("device {} : {}".format(n, address))
+
+    key = await ainput("start ok? >>")  # なんらかのキー入力待ち
+    await group.start()     # 全デバイスの IMUデータ連続送信 ON
+    await asyncio.sleep(_TIMEOVER_SEC)
+    await group.stop()      # 全デバイスの IMUデータ連続送信 OFF
+    await group.disconnect()
+    for n, stat in enumerate(group.get_stats()):
+        print("device {} : {} samples, {:.1f} Hz, drop {}, missing {}".format(
+            n, stat['samples'], stat['rate'], stat['drop'], stat['missing']))
+    np.save(_SAVE_FILE, group.get_merged())
+
+asyncio.run(main_loop())
@@ -0,0 +1,144 @@
+""" BleUartClient の模擬クライアント(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+実機 M5Stack ATOM-S3 (imu_base) 無しで動く、BleUartClient と同じインターフェースの
+模擬クライアント SimBleUartClient です。保存済みの sampling.npy を再生するか、
+motion profile から合成した 6軸IMUデータを、指定レートで notify データとして受信します。
+imu_base と同じ b/e/s/t/p コマンドに応答し、送信の最後には終端データ(12byte 全て0) が届きます。
+(通信部分は fake_bleak.FakeBleakBackend による)
+
+rate は 100 (実機と同じ 100Hz)、1000 (1kHz) など [Hz] で指定します。
+0 以下を指定すると待ち時間無しで送信し、受信側の処理能力の上限を測れます。
+
+============
+使用例
+============
+from sim_uart import SimBleUartClient, synthesize_imu
+
+async def main_loop():
+    # 保存済みデータを 1kHz で再生
+    client = SimBleUartClient("IMU_BASE", "sampling.npy", rate=1000)
+    # 又は z軸回りに回転する 10秒分のデータを合成して、最速で送信
+    # client = SimBleUartClient("IMU_BASE", synthesize_imu(10.0, profile="spin"), rate=0)
+    receive_queue = client.get_queue()
+    await client.connect()
+    await client.write(b'b')
+    # 以降は BleUartClient と同じ
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import math
+import numpy as np
+from BleUart import BleUartClient
+from fake_bleak import FakeBleakBackend
+from cq_quaternion import integralAngleVelocityArray
+
+# 加速度バイナリの感度 (-32768～+32767 が -2g～+2g) [LSB/g]
+ACC_LSB_PER_G = 32768/2
+# 角速度バイナリの感度 (-32768～+32767 が -250dps～+250dps) [LSB/(rad/sec)]
+GYR_LSB_PER_RAD = 32768/250*180/math.pi
+# 合成できる motion profile
+PROFILES = ("still", "spin", "wobble")
+
+def _angular_velocity(profile: str, t: np.ndarray)-> np.ndarray:
+    """motion profile の角速度 shape=(N, 3) [rad/sec]"""
+    w = np.zeros((len(t), 3))
+    if profile == "still":
+        pass
+    elif profile == "spin":
+        # 1秒静置後、z軸回りに 90度/sec で回転
+        w[t >= 1.0, 2] = math.radians(90)
+    elif profile == "wobble":
+        # 1秒静置後、3軸それぞれ異なる周期で揺動 (振幅 60度/sec)
+        move = t >= 1.0
+        for axis, period in enumerate((2.0, 3.0, 5.0)):
+            w[move, axis] = math.radians(60)*np.sin(2*math.pi*(t[move] - 1.0)/period)
+    else:
+        raise ValueError("profile must be one of {}".format(PROFILES))
+    return w
+
+def synthesize_imu(duration: float=10.0, rate: float=100.0, profile: str="wobble",
+                   acc_noise: float=30.0, gyr_noise: float=5.0, gyr_offset=(20, -15, 10),
+                   seed: int=0)-> np.ndarray:
+    """motion profile から 6軸IMUデータを合成
+
+    機体は z軸を上空に向けて静置した状態から動き出す。加速度は機体座標系で見た
+    重力の逆方向 1g に、角速度は motion profile の角速度にオフセットを加え、
+    それぞれ正規分布の雑音を加えて imu_base と同じバイナリ値にする。
+
+    Parameters
+    -----
+    duration: float, default 10.0
+        データの長さ [sec]
+    rate: float, default 100.0
+        サンプリングレート [Hz]
+    profile: str, default "wobble"
+        "still" : 静置 / "spin" : z軸回りに一定回転 / "wobble" : 3軸揺動
+    acc_noise: float, default 30.0
+        加速度雑音の標準偏差 [LSB]
+    gyr_noise: float, default 5.0
+        角速度雑音の標準偏差 [LSB]
+    gyr_offset: array like, default (20, -15, 10)
+        角速度のオフセット [LSB]
+    seed: int, default 0
+        乱数の種
+
+    Returns
+    -----
+    np.ndarray shape=(サンプル点数, 6) の int16 アレイ (sampling.npy と同じ形式)
+    """
+    n = int(round(duration*rate))
+    t = np.arange(n)/rate
+    w = _angular_velocity(profile, t)
+    # 機体座標系 -> 基準座標系 の姿勢。基準座標の上空方向を機体座標系で見たものが加速度
+    track, _ = integralAngleVelocityArray(w, 1.0/rate)
+    acc = track.conj().rotation((0, 0, 1))
+    rng = np.random.default_rng(seed)
+    imu = np.empty((n, 6))
+    imu[:, :3] = acc*ACC_LSB_PER_G + rng.normal(0.0, acc_noise, (n, 3))
+    imu[:, 3:] = w*GYR_LSB_PER_RAD + np.asarray(gyr_offset) + rng.normal(0.0, gyr_noise, (n, 3))
+    return np.clip(np.round(imu), -32768, 32767).astype(np.int16)
+
+class SimBleUartClient(BleUartClient):
+    """BleUartClient と同じインターフェースの模擬クライアント
+
+    connect, disconnect, write, get_queue, get_samples などは BleUartClient と同じ。
+    """
+    def __init__(self, device_name: str="IMU_BASE", data="sampling.npy", rate: float=100.0,
+                 address: str="00:00:00:00:00:01", ring_size: int=0, packet: str="raw", mtu: int=247):
+        """コンストラクタ
+
+        parameters
+        -----
+        device_name: str, default="IMU_BASE"
+            模擬デバイスの BLEデバイス名
+        data: str or array like, default="sampling.npy"
+            送信する 6軸IMUデータ。.npy ファイル名、又は shape=(サンプル点数, 6) のアレイ
+            (synthesize_imu の戻り値など)
+        rate: float, default=100.0
+            連続送信のレート [Hz]。0 以下は待ち時間無しで送信
+        address: str, default="00:00:00:00:00:01"
+            模擬デバイスの BLEアドレス
+        ring_size: int, default=0
+            BleUartClient と同じ
+        packet: str, default="raw"
+            BleUartClient と同じ
+        mtu: int, default=247
+            模擬接続の ATT MTU [byte] ("p" コマンドで 1回にまとめるサンプル数を決める)
+        """
+        self._sim_backend = FakeBleakBackend()
+        interval = 1.0/rate if rate > 0 else 0.0
+        self._sim_device = self._sim_backend.add_device(device_name, address, data, interval, mtu)
+        super().__init__(device_name, address, ring_size, self._sim_backend, packet)
+
+    def get_sim_data(self)-> np.ndarray:
+        """送信する 6軸IMUデータ shape=(サンプル点数, 6) の int16 アレイ"""
+        return self._sim_device.get_data()
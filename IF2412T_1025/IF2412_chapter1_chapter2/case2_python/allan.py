@@ -0,0 +1,28 @@
+import json
+import os
+import numpy as np
+
+""" 角速度バイアス推定値の読み出し
+
+長時間の静置データのアラン分散による評価と、角速度バイアス推定値の保存 (gyro_bias.json) は、
+case1_python/allan.py で行う。ここには、その保存ファイルを読み出す load_bias だけを置く。
+real_rotation.py、real_madgwick.py は、これを時刻ゼロの角速度の代わりにオフセット補正に使う。
+"""
+
+def load_bias(file_name: str, default=None):
+    """case1_python/allan.py の save_bias で保存した角速度バイアス推定値を読み出し
+
+    Parameters
+    -----
+    file_name: str 保存ファイル名
+    default: default None
+        ファイルが無い場合の戻り値
+
+    Returns
+    -----
+    np.ndarray or default 3要素の角速度バイアス [バイナリ値]
+    """
+    if not os.path.exists(file_name):
+        return default
+    with open(file_name, "r", encoding="utf-8") as f:
+        return np.array(json.load(f)['gyr_bias'], dtype=np.float64)
@@ -0,0 +1,184 @@
+""" 姿勢のリアルタイム表示ライブラリ(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+BLE受信・姿勢計算スレッドから、描画を担うメインスレッドへ姿勢を渡し、3Dグラフに表示します。
+
+LatestValue
+    最新値だけを保持する受け渡し箱。描画が追いつかない場合は古い値を捨てるので、
+    キューのように溜まり続けて表示が遅れていくことがない。
+AttitudeView
+    機体座標系の xyz 軸を 3D グラフに表示する。毎回グラフを消去せず、作成済みの線の
+    座標だけを更新する。描画周期 (frame) と、値を受け取ってから描画するまでの遅れ (lag)、
+    捨てた値の数 (drop) をグラフ上に表示する。
+
+============
+使用例
+============
+from attitude_view import LatestValue, AttitudeView
+
+mailbox = LatestValue()
+# 姿勢計算スレッド側 : 機体座標系 xyz 軸を基準座標系に変換したベクトルを渡す
+mailbox.put((conv_x, conv_y, conv_z))
+mailbox.close()     # 終了時
+# メインスレッド側 : close されるまで表示を更新し続ける
+AttitudeView().run(mailbox)
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import threading
+import time
+import matplotlib.pyplot as plt
+
+class LatestValue:
+    """最新値だけを保持するスレッド間の受け渡し箱
+
+    提供メソッド
+    -----
+    put(value, stamp=None)
+        値を渡す (未取得の値があれば上書きして捨てる)
+    get(timeout=None)
+        新しい値が来るまで待って取得
+    close()
+        終了を通知 (以降 get は None を返す)
+    get_dropped()
+        上書きで捨てた値の数
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._value = None
+        self._stamp = 0.0
+        self._fresh = False
+        self._closed = False
+        self._dropped = 0
+
+    def put(self, value, stamp: float=None):
+        """値を渡す
+
+        Parameters
+        -----
+        value: 渡す値。未取得の値があれば上書きして捨てる
+        stamp: float, default None
+            値の元になったデータの時刻 time.monotonic() [sec] (BLE の受信時刻など)。
+            None の場合は put した時刻
+        """
+        if stamp is None:
+            stamp = time.monotonic()
+        with self._cond:
+            if self._fresh:
+                self._dropped += 1
+            self._value = value
+            self._stamp = stamp
+            self._fresh = True
+            self._cond.notify()
+
+    def get(self, timeout: float=None)-> tuple:
+        """新しい値が来るまで待って取得
+
+        Parameters
+        -----
+        timeout: float, default None
+            待ち時間の上限 [sec]。None は無制限
+
+        Returns
+        -----
+        (value, float) or None
+            値と、その値の時刻 time.monotonic() [sec] (put の stamp、省略時は put した時刻)
+            close 後に新しい値が無い場合、又はタイムアウトの場合は None
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._fresh or self._closed, timeout):
+                return None
+            if not self._fresh:
+                return None
+            self._fresh = False
+            return (self._value, self._stamp)
+
+    def close(self):
+        """終了を通知。get を待っているスレッドは None で戻る"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get_dropped(self)-> int:
+        """上書きで捨てた値の数"""
+        with self._cond:
+            return self._dropped
+
+class AttitudeView:
+    """機体座標系 xyz 軸の 3D 表示
+
+    提供メソッド
+    -----
+    update(xyz_axis, lag=0.0, dropped=0)
+        表示を更新
+    run(mailbox, interval=0.02, recorder=None)
+        LatestValue から値を受け取って、close されるまで表示を更新し続ける
+    """
+    def __init__(self, title: str=""):
+        """コンストラクタ
+
+        Parameters
+        -----
+        title: str, default ""
+            グラフのタイトル
+        """
+        self._fig = plt.figure()
+        self._ax = self._fig.add_subplot(111, projection='3d')
+        self._ax.grid()
+        self._ax.set_xlim(-1,1);self._ax.set_ylim(-1,1);self._ax.set_zlim(-1,1)
+        if title:
+            self._ax.set_title(title)
+        # 機体座標系 x 軸赤, y 軸青, z 軸緑 (原点からの線分)
+        self._lines = [self._ax.plot([0,0], [0,0], [0,0], color=color)[0] for color in ('r', 'b', 'g')]
+        self._text = self._fig.text(0.02, 0.02, "")
+        self._last = None
+
+    def update(self, xyz_axis, lag: float=0.0, dropped: int=0):
+        """表示を更新
+
+        Parameters
+        -----
+        xyz_axis: tuple
+            機体座標系の x, y, z 軸を基準座標系に変換した 3要素ベクトル 3本
+        lag: float, default 0.0
+            値の時刻から描画するまでの遅れ [sec]
+        dropped: int, default 0
+            描画せずに捨てた値の数
+        """
+        for line, vec in zip(self._lines, xyz_axis):
+            line.set_data([0, vec[0]], [0, vec[1]])
+            line.set_3d_properties([0, vec[2]])
+        now = time.monotonic()
+        frame = 0.0 if self._last is None else now - self._last
+        self._last = now
+        self._text.set_text("frame {:.0f} ms / lag {:.0f} ms / drop {}".format(frame*1000, lag*1000, dropped))
+
+    def run(self, mailbox: LatestValue, interval: float=0.02, recorder=None):
+        """LatestValue から値を受け取って、close されるまで表示を更新し続ける
+
+        Parameters
+        -----
+        mailbox: LatestValue 姿勢計算スレッドから値を受け取る受け渡し箱
+        interval: float, default 0.02
+            描画後、グラフ画面のイベント処理に使う時間 [sec]
+        recorder: LatencyRecorder, default None
+            指定した場合、値の時刻から線の座標を更新するまでの遅れを段階 "draw" に記録する
+            (画面への反映は、直後の plt.pause の中で行われる)
+        """
+        while True:
+            item = mailbox.get()
+            if item is None:
+                break   # exit while
+            xyz_axis, stamp = item
+            self.update(xyz_axis, time.monotonic() - stamp, mailbox.get_dropped())
+            if recorder is not None:
+                recorder.add("draw", stamp)
+            plt.pause(interval)
@@ -0,0 +1,331 @@
+import gc
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from BleUart import BleUartClient
+from imu_packet import decode_packed
+from sim_uart import synthesize_imu, ACC_LSB_PER_G
+from calibration import RlsCalibrator, fit_ellipsoid
+# 本誌提供のクオータニオンライブラリ(cq_quaternion.py)
+from cq_quaternion import *
+
+""" IMU ホスト処理の性能測定 (ベンチマーク)
+
+受信データの復号から姿勢計算、加速度センサ校正までの各処理について、処理能力 [サンプル/sec] と
+ピークメモリ [KiB] を測り、JSON ファイルに保存する。
+各処理は、1回に処理するサンプル数 (batch) と、同時に扱うデバイス数 (devices) を変えて測る。
+batch=1 は real_rotation.py のような 1サンプル毎の逐次処理、batch>1 は同じ処理の一括版
+(QuaternionArray, integralAngleVelocityArray, updateIMUArray など) になる。
+devices 台分のデータは、batch 毎に 1台ずつ順に処理する (複数台を同時接続した PC と同じ)。
+
+入力データ
+    synthetic : sim_uart.synthesize_imu の合成データ (デバイス毎に乱数の種を変える)
+    recorded  : 保存済みデータ _RECORDED を、_SAMPLES になるまで繰り返したもの
+    sphere    : 様々な向きで静置した加速度 (校正の測定専用。姿勢計算には使わない)
+
+処理時間は _REPEAT 回の最小値、ピークメモリは tracemalloc で測った処理中の最大確保量で、
+入力データの準備 (setup) は含まない。保存する JSON には、git のコミット、python と numpy の版、
+実行環境を併せて記録し、別のコミットで測った結果と比べられるようにする。
+
+python benchmark.py               : 測定して表示し、benchmark_<コミット>.json に保存
+python benchmark.py base.json     : さらに base.json の結果に対する比 (処理能力、メモリ) を表示
+"""
+
+_SAMPLES = 10000             # 1台当たりのサンプル数
+_BATCH_SIZES = (1, 20, 256, 4096)
+_NOTIFY_SIZES = (1, 20)      # 復号の測定で 1回の notify に入れるサンプル数 (1 は raw, 2以上は packed)
+_FIT_SIZES = (256, 4096)     # 楕円体フィッティング 1回のサンプル数
+_DEVICES = (1, 4)
+_REPEAT = 3
+_RECORDED = "../case1_python/sampling.npy"  # 無い場合は recorded を測らない
+_INTERVAL = 0.01             # データサンプリング間隔 10msec
+_OUTPUT = "benchmark_{commit}.json"
+
+# 角速度バイナリを rad/sec に変換するゲイン (+-250dps full scale)
+_GYR_SCALE = 2*250/65536/180*math.pi
+
+def _chunks(n: int, batch: int):
+    """0～n を batch 毎に区切った (start, stop) の並び"""
+    return [(start, min(start + batch, n)) for start in range(0, n, batch)]
+
+def _rounds(data: list, batch: int):
+    """batch 毎に、全デバイスを順に処理する (デバイス番号, start, stop) の並び"""
+    return [(dev, start, stop) for start, stop in _chunks(len(data[0]), batch) for dev in range(len(data))]
+
+def _gyr(imu: np.ndarray)-> np.ndarray:
+    """角速度 [rad/sec] (時刻ゼロの値をオフセットとする)"""
+    return (imu[:, 3:].astype(np.float64) - imu[0, 3:])*_GYR_SCALE
+
+def _quaternions(imu: np.ndarray)-> np.ndarray:
+    """姿勢クオータニオンの時系列 shape=(N, 4) (getEuler, 積の入力用)"""
+    track, _ = integralAngleVelocityArray(_gyr(imu), _INTERVAL)
+    return np.asarray(track)
+
+def _notifies(imu: np.ndarray, batch: int)-> list:
+    """imu_base が送る notify データの列 (batch=1 は raw 12byte、2以上は packed 4+12K byte)"""
+    if batch == 1:
+        return [bytearray(row.tobytes()) for row in imu]
+    return [bytearray(struct.pack('<HBB', start & 0xFFFF, stop - start, 0) + imu[start:stop].tobytes())
+            for start, stop in _chunks(len(imu), batch)]
+
+def _notify_rounds(notifies: list):
+    """notify 毎に、全デバイスを順に処理する (デバイス番号, notify 番号) の並び"""
+    return [(dev, n) for n in range(len(notifies[0])) for dev in range(len(notifies))]
+
+def bench_decode_queue(data: list, batch: int):
+    """notify データの復号 (キュー受信モード、real_rotation.py と同じ np.frombuffer)"""
+    notifies = [_notifies(imu, batch) for imu in data]
+    def run()-> int:
+        count = 0
+        for dev, n in _notify_rounds(notifies):
+            raw_data = notifies[dev][n]
+            if batch == 1:
+                imu_data = np.frombuffer(raw_data, dtype=np.int16).astype('float64')
+                count += 1
+            else:
+                _, block = decode_packed(raw_data)
+                imu_data = block.astype('float64')
+                count += len(imu_data)
+        return count
+    return run
+
+def bench_decode_ring(data: list, batch: int):
+    """notify データの復号 (BleUartClient のリングバッファ受信モード、raw 又は packed)"""
+    notifies = [_notifies(imu, batch) for imu in data]
+    clients = [BleUartClient("IMU_BASE", ring_size=4096, packet="raw" if batch == 1 else "packed") for _ in data]
+    def run()-> int:
+        count = 0
+        for dev, n in _notify_rounds(notifies):
+            client = clients[dev]
+            # bleak から notify で呼ばれるコールバックを直接呼ぶ
+            client._receive_ring(None, notifies[dev][n])
+            count += len(client.read_samples())
+        return count
+    return run
+
+def bench_quaternion_mul(data: list, batch: int):
+    """クオータニオンの積 (batch=1 は Quaternion、2以上は QuaternionArray)"""
+    values = [_quaternions(imu) for imu in data]
+    steps = [np.roll(v, 1, axis=0) for v in values]
+    if batch == 1:
+        a = [[Quaternion(*row) for row in v] for v in values]
+        b = [[Quaternion(*row) for row in v] for v in steps]
+    else:
+        a = [[QuaternionArray(v[start:stop]) for start, stop in _chunks(len(v), batch)] for v in values]
+        b = [[QuaternionArray(v[start:stop]) for start, stop in _chunks(len(v), batch)] for v in steps]
+    def run()-> int:
+        count = 0
+        for dev, n in _notify_rounds(a):
+            q = a[dev][n] * b[dev][n]
+            count += 1 if batch == 1 else len(q)
+        return count
+    return run
+
+def bench_integral(data: list, batch: int):
+    """角速度の積算 (batch=1 は integralAngleVelocity、2以上は integralAngleVelocityArray)"""
+    gyr = [_gyr(imu) for imu in data]
+    rows = [list(g) for g in gyr] if batch == 1 else None
+    def run()-> int:
+        q = [Quaternion() for _ in data]
+        for dev, start, stop in _rounds(data, batch):
+            if batch == 1:
+                q[dev].integralAngleVelocity(rows[dev][start], _INTERVAL)
+            else:
+                track, _ = integralAngleVelocityArray(gyr[dev][start:stop], _INTERVAL, q0=q[dev], method="euler")
+                q[dev] = Quaternion(*np.asarray(track)[-1])
+        return len(data)*len(data[0])
+    return run
+
+def bench_euler(data: list, batch: int):
+    """オイラー角への変換 (batch=1 は Quaternion.getEuler、2以上は QuaternionArray.getEuler)"""
+    values = [_quaternions(imu) for imu in data]
+    if batch == 1:
+        items = [[Quaternion(*row) for row in v] for v in values]
+    else:
+        items = [[QuaternionArray(v[start:stop]) for start, stop in _chunks(len(v), batch)] for v in values]
+    def run()-> int:
+        for dev, n in _notify_rounds(items):
+            items[dev][n].getEuler()
+        return len(data)*len(data[0])
+    return run
+
+def bench_madgwick(data: list, batch: int):
+    """Madgwick フィルタの更新 (batch=1 は updateIMU、2以上は updateIMUArray)"""
+    gyr = [_gyr(imu) for imu in data]
+    acc = [imu[:, :3].astype(np.float64) for imu in data]
+    if batch == 1:
+        gyr = [list(g) for g in gyr]
+        acc = [list(a) for a in acc]
+    def run()-> int:
+        filters = [Madgwick(frequency=1/_INTERVAL, beta=0.1) for _ in data]
+        for dev, start, stop in _rounds(data, batch):
+            if batch == 1:
+                filters[dev].updateIMU(gyr[dev][start], acc[dev][start])
+            else:
+                filters[dev].updateIMUArray(gyr[dev][start:stop], acc[dev][start:stop])
+        return len(data)*len(data[0])
+    return run
+
+def bench_calibration_rls(data: list, batch: int):
+    """加速度センサ校正の逐次推定 (RlsCalibrator.update をサンプル毎に)"""
+    acc = [imu[:, :3].astype(np.float64) for imu in data]
+    def run()-> int:
+        calibrators = [RlsCalibrator() for _ in data]
+        for dev, start, _ in _rounds(data, 1):
+            calibrators[dev].update(acc[dev][start])
+        return len(data)*len(data[0])
+    return run
+
+def bench_calibration_fit(data: list, batch: int):
+    """加速度センサ校正の楕円体フィッティング (fit_ellipsoid を batch サンプル毎に)"""
+    acc = [imu[:, :3].astype(np.float64) for imu in data]
+    def run()-> int:
+        for dev, start, stop in _rounds(data, batch):
+            fit_ellipsoid(acc[dev][start:stop])
+        return len(data)*len(data[0])
+    return run
+
+# (名前, 関数, 入力データ, batch の並び)
+_BENCHMARKS = (
+    ("decode_queue", bench_decode_queue, ("synthetic",), _NOTIFY_SIZES),
+    ("decode_ring", bench_decode_ring, ("synthetic",), _NOTIFY_SIZES),
+    ("quaternion_mul", bench_quaternion_mul, ("synthetic",), _BATCH_SIZES),
+    ("integral", bench_integral, ("synthetic", "recorded"), _BATCH_SIZES),
+    ("euler", bench_euler, ("synthetic",), _BATCH_SIZES),
+    ("madgwick", bench_madgwick, ("synthetic", "recorded"), _BATCH_SIZES),
+    ("calibration_rls", bench_calibration_rls, ("sphere",), (1,)),
+    ("calibration_fit", bench_calibration_fit, ("sphere",), _FIT_SIZES),
+)
+
+def make_input(kind: str, devices: int, samples: int=_SAMPLES)-> list:
+    """devices 台分の入力データ (各 shape=(samples, 6) の int16)
+
+    Parameters
+    -----
+    kind: str "synthetic", "recorded", "sphere" のいずれか
+    devices: int デバイス数
+    samples: int, default _SAMPLES
+        1台当たりのサンプル数
+
+    Returns
+    -----
+    list or None devices 個のアレイ。recorded でファイルが無い場合は None
+    """
+    if kind == "synthetic":
+        return [synthesize_imu(samples*_INTERVAL, 1/_INTERVAL, "wobble", seed=dev)[:samples] for dev in range(devices)]
+    if kind == "recorded":
+        if not os.path.exists(_RECORDED):
+            return None
+        imu = np.load(_RECORDED)[:, :6]
+        imu = np.tile(imu, (samples//len(imu) + 1, 1))[:samples]
+        return [imu.copy() for _ in range(devices)]
+    if kind == "sphere":
+        imu = []
+        for dev in range(devices):
+            rng = np.random.default_rng(dev)
+            # 一様な向きの重力加速度に、軸毎のゲイン、オフセットと雑音を加える
+            up = rng.normal(size=(samples, 3))
+            up /= np.linalg.norm(up, axis=1, keepdims=True)
+            acc = up*ACC_LSB_PER_G*(1 + rng.normal(0, 0.01, 3)) + rng.normal(0, 200, 3) + rng.normal(0, 30, (samples, 3))
+            value = np.zeros((samples, 6))
+            value[:, :3] = acc
+            imu.append(np.clip(np.round(value), -32768, 32767).astype(np.int16))
+        return imu
+    raise ValueError("unknown input: %s" % kind)
+
+def measure(bench, data: list, batch: int, repeat: int=_REPEAT)-> dict:
+    """1つの条件で、処理時間 (repeat 回の最小) とピークメモリを測る
+
+    Returns
+    -----
+    dict samples, seconds, samples_per_sec, peak_kib
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        run = bench(data, batch)
+        gc.collect()
+        start = time.perf_counter()
+        samples = run()
+        best = min(best, time.perf_counter() - start)
+    # メモリは tracemalloc で処理が遅くなるので、時間とは別に測る
+    run = bench(data, batch)
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'samples': samples, 'seconds': best, 'samples_per_sec': samples/best, 'peak_kib': peak/1024}
+
+def _git(*args)-> str:
+    try:
+        return subprocess.run(("git",) + args, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def environment()-> dict:
+    """比較の前提になる実行環境 (コミット、版、CPU など)"""
+    return {'commit': _git("rev-parse", "--short", "HEAD") or "unknown",
+            'dirty': bool(_git("status", "--porcelain", "--untracked-files=no", ".")),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'samples': _SAMPLES,
+            'repeat': _REPEAT}
+
+def run_all()-> dict:
+    """全ベンチマークを測定"""
+    results = []
+    for devices in _DEVICES:
+        inputs = {}
+        for name, bench, kinds, batches in _BENCHMARKS:
+            for kind in kinds:
+                if kind not in inputs:
+                    inputs[kind] = make_input(kind, devices)
+                if inputs[kind] is None:
+                    continue
+                for batch in batches:
+                    result = {'name': name, 'input': kind, 'batch': batch, 'devices': devices}
+                    result.update(measure(bench, inputs[kind], batch))
+                    results.append(result)
+                    print("{:16s} {:9s} batch {:5d} devices {:2d} : {:12.0f} samples/s  peak {:10.1f} KiB".format(
+                        name, kind, batch, devices, result['samples_per_sec'], result['peak_kib']))
+    return {'environment': environment(), 'results': results}
+
+def _key(result: dict)-> tuple:
+    return (result['name'], result['input'], result['batch'], result['devices'])
+
+def compare(current: dict, base: dict):
+    """base に対する処理能力とピークメモリの比を表示"""
+    base_results = {_key(r): r for r in base['results']}
+    print("compare with {} ({})".format(base['environment']['commit'], base['environment']['created']))
+    for result in current['results']:
+        ref = base_results.get(_key(result))
+        if ref is None:
+            continue
+        print("{:16s} {:9s} batch {:5d} devices {:2d} : speed x{:6.2f}  memory x{:6.2f}".format(
+            *_key(result), result['samples_per_sec']/ref['samples_per_sec'],
+            result['peak_kib']/ref['peak_kib'] if ref['peak_kib'] > 0 else float('nan')))
+
+
+if __name__ == '__main__':
+    # 比較対象は、同じ名前の結果で上書きされる前に読み込んでおく
+    base = None
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r", encoding="utf-8") as f:
+            base = json.load(f)
+    report = run_all()
+    output = _OUTPUT.format(commit=report['environment']['commit'])
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("saved : {}".format(output))
+    if base is not None:
+        compare(report, base)
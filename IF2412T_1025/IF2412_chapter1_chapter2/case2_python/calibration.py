@@ -0,0 +1,407 @@
+""" 加速度センサの校正ライブラリ(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+静置状態の加速度は、どの向きでも大きさが重力加速度 ACC_G になることを使って、
+加速度センサのゲインとオフセットを推定します。fitting.py の校正を一般化したものです。
+
+RlsCalibrator
+    fitting.py と同じ軸毎のゲイン・オフセット (6パラメータ) のモデルを、逐次最小二乗法 (RLS)
+    で推定する。sample_one.py で 1サンプル取得する毎に推定値が更新される。
+fit_ellipsoid
+    軸間の感度の干渉(直交からのずれ) も含めた楕円体 (9パラメータ) で一括推定する。
+    球面から大きく外れたサンプル(動いていた時のサンプル等) は外れ値として除いて推定し直す。
+AccCalibration
+    推定した校正値。apply で (サンプル点数, 3) 又は (サンプル点数, 6) のアレイをまとめて校正する。
+CalibrationStore
+    校正値を、デバイスの BLEアドレス毎に JSON ファイルに保存・読み出しする。
+
+校正後の加速度は、m/sec^2 単位で
+    acc_cal = matrix @ (acc_raw - offset)
+となる。軸毎のゲイン・オフセットのモデルでは matrix は対角行列。
+
+============
+使用例
+============
+from calibration import *
+
+# 一括推定して、デバイスの BLEアドレス毎に保存
+imu = np.load("sample_one.npy")
+calib, inlier = fit_ellipsoid(imu[:, :3])
+CalibrationStore("calibration.json").save("XX:XX:XX:XX:XX:XX", calib)
+# 読み出して校正 (未校正のデバイスは、default の AccCalibration() で無変換)
+calib = CalibrationStore("calibration.json").load("XX:XX:XX:XX:XX:XX", AccCalibration())
+acc = calib.apply(imu[:, :3])
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import json
+import os
+import time
+import numpy as np
+
+# 重力加速度 [m/sec^2]
+ACC_G = 9.80665
+# 加速度バイナリの 1g 相当値 (-32768～+32767 が -2g～+2g)。推定は 1g 単位に換算して行う
+_ACC_SCALE = 32768/2
+
+class AccCalibration:
+    """加速度センサの校正値
+
+    acc_cal = matrix @ (acc_raw - offset)
+
+    提供メソッド
+    -----
+    apply(acc)
+        加速度をまとめて校正
+    get_gain()
+        各軸のゲイン (matrix の対角要素)
+    get_offset()
+        各軸のオフセット
+    to_dict()
+        JSON 保存用の辞書に変換
+    from_dict(value)
+        to_dict の辞書から生成 (クラスメソッド)
+    """
+    def __init__(self, matrix=None, offset=None, method: str="identity", samples: int=0, rms: float=0.0):
+        """コンストラクタ
+
+        Parameters
+        -----
+        matrix: array like, default None
+            shape=(3, 3) の校正行列 [(m/sec^2)/LSB]。None の場合は単位行列 (無変換)
+        offset: array like, default None
+            3要素のオフセット [LSB]。None の場合は 0
+        method: str, default "identity"
+            推定方法 "identity", "rls", "ellipsoid"
+        samples: int, default 0
+            推定に使ったサンプル点数
+        rms: float, default 0.0
+            推定に使ったサンプルの、校正後の大きさと ACC_G の差の RMS [m/sec^2]
+        """
+        self.matrix = np.eye(3) if matrix is None else np.asarray(matrix, dtype=np.float64).reshape((3, 3))
+        self.offset = np.zeros(3) if offset is None else np.asarray(offset, dtype=np.float64).reshape(3)
+        self.method = method
+        self.samples = samples
+        self.rms = rms
+
+    @classmethod
+    def from_gain_offset(cls, gain, offset, **kwargs)-> 'AccCalibration':
+        """軸毎のゲインとオフセットから生成
+
+        Parameters
+        -----
+        gain: array like 3要素のゲイン [(m/sec^2)/LSB]
+        offset: array like 3要素のオフセット [LSB]
+        kwargs: コンストラクタの method, samples, rms
+
+        Returns
+        -----
+        AccCalibration 対角行列の校正値
+        """
+        return cls(np.diag(np.asarray(gain, dtype=np.float64)), offset, **kwargs)
+
+    def apply(self, acc)-> np.ndarray:
+        """加速度をまとめて校正
+
+        Parameters
+        -----
+        acc: array like
+            shape=(3,) 又は (サンプル点数, 3) の加速度バイナリ、
+            又は (サンプル点数, 6) の 6軸IMUデータ (先頭3列の加速度だけ校正し、角速度はそのまま)
+
+        Returns
+        -----
+        np.ndarray acc と同じ shape の float64 アレイ。加速度は m/sec^2 単位
+        """
+        acc = np.asarray(acc, dtype=np.float64)
+        cal = (acc[..., :3] - self.offset) @ self.matrix.T
+        if acc.shape[-1] == 3:
+            return cal
+        out = acc.copy()
+        out[..., :3] = cal
+        return out
+
+    def get_gain(self)-> np.ndarray:
+        """各軸のゲイン (matrix の対角要素) [(m/sec^2)/LSB]"""
+        return np.diag(self.matrix).copy()
+
+    def get_offset(self)-> np.ndarray:
+        """各軸のオフセット [LSB]"""
+        return self.offset.copy()
+
+    def to_dict(self)-> dict:
+        """JSON 保存用の辞書に変換"""
+        return {'matrix': self.matrix.tolist(), 'offset': self.offset.tolist(),
+                'method': self.method, 'samples': int(self.samples), 'rms': float(self.rms)}
+
+    @classmethod
+    def from_dict(cls, value: dict)-> 'AccCalibration':
+        """to_dict の辞書から生成"""
+        return cls(value['matrix'], value['offset'], value.get('method', ""),
+                   value.get('samples', 0), value.get('rms', 0.0))
+
+    def __repr__(self):
+        return "AccCalibration({}, matrix={}, offset={})".format(self.method, self.matrix.tolist(), self.offset.tolist())
+
+def _residual(matrix: np.ndarray, offset: np.ndarray, acc: np.ndarray)-> np.ndarray:
+    """校正後の加速度の大きさと ACC_G の差 [m/sec^2]"""
+    cal = (acc - offset) @ matrix.T
+    return np.sqrt(np.sum(cal*cal, axis=1)) - ACC_G
+
+def _axis_aligned(k: np.ndarray):
+    """fitting.py と同じ 6パラメータの解 k から、ゲインとオフセットを得る (1g 単位)
+
+    解が楕円体にならない場合は None を返す。
+    """
+    if k[0] <= 0 or k[1] <= 0:
+        return None
+    rmd = -k[5] + k[2]**2/4 + k[3]**2/(4*k[0]) + k[4]**2/(4*k[1])
+    if rmd <= 0:
+        return None
+    gain = ACC_G*np.sqrt(np.array([1.0, k[0], k[1]])/rmd)
+    offset = np.array([-k[2]/2, -k[3]/(2*k[0]), -k[4]/(2*k[1])])
+    return (gain, offset)
+
+class RlsCalibrator:
+    """軸毎のゲイン・オフセットの逐次最小二乗推定
+
+    fitting.py と同じく、静置時の加速度 (x, y, z) について
+        x^2 + k0 y^2 + k1 z^2 + k2 x + k3 y + k4 z + k5 = 0
+    を満たす k を、1サンプル毎に更新する。全サンプルが揃った後の np.linalg.lstsq の解と一致する
+    (forget=1.0 の場合。初期値の影響で僅かに異なる)。
+
+    提供メソッド
+    -----
+    update(acc)
+        1サンプル分の加速度で推定値を更新
+    get_calibration()
+        現在の推定値の校正値
+    get_samples()
+        更新に使ったサンプル点数
+    """
+    def __init__(self, forget: float=1.0, delta: float=1e6):
+        """コンストラクタ
+
+        Parameters
+        -----
+        forget: float, default 1.0
+            忘却係数 (0～1)。1 未満にすると、古いサンプルほど軽く扱う
+        delta: float, default 1e6
+            誤差共分散行列の初期値 (単位行列の倍率)。大きいほど初期値 k=0 の影響が小さい
+        """
+        self._forget = forget
+        self._k = np.zeros(6)
+        self._p = np.eye(6)*delta
+        self._samples = 0
+        self._sum2 = 0.0
+        self._calib = None
+
+    def update(self, acc):
+        """1サンプル分の加速度で推定値を更新
+
+        Parameters
+        -----
+        acc: array like 静置時の加速度バイナリ 3要素 (又は 6軸IMUデータ 6要素)
+
+        Returns
+        -----
+        AccCalibration or None
+            更新後の校正値。推定に必要な 6サンプル未満、又は楕円体にならない場合は None
+        """
+        x, y, z = np.asarray(acc, dtype=np.float64)[:3]/_ACC_SCALE
+        phi = np.array([y*y, z*z, x, y, z, 1.0])
+        target = -x*x
+        p_phi = self._p @ phi
+        gain = p_phi/(self._forget + phi @ p_phi)
+        self._k += gain*(target - phi @ self._k)
+        self._p = (self._p - np.outer(gain, p_phi))/self._forget
+        self._samples += 1
+        self._calib = self._make_calibration()
+        return self._calib
+
+    def _make_calibration(self):
+        if self._samples < 6:
+            return None
+        ans = _axis_aligned(self._k)
+        if ans is None:
+            return None
+        gain, offset = ans
+        return AccCalibration.from_gain_offset(gain/_ACC_SCALE, offset*_ACC_SCALE,
+                                               method="rls", samples=self._samples)
+
+    def get_calibration(self):
+        """現在の推定値の校正値 (推定できていない場合は None)"""
+        return self._calib
+
+    def get_samples(self)-> int:
+        """更新に使ったサンプル点数"""
+        return self._samples
+
+def fit_axis_aligned(acc)-> AccCalibration:
+    """軸毎のゲイン・オフセット (6パラメータ) を一括推定 (fitting.py と同じ計算)
+
+    Parameters
+    -----
+    acc: array like shape=(サンプル点数, 3) 静置時の加速度バイナリ (6列の IMUデータも可)
+
+    Returns
+    -----
+    AccCalibration 対角行列の校正値
+
+    Raises
+    -----
+    ValueError
+        サンプル点数が 6 未満、又は楕円体にならない場合
+    """
+    u = np.asarray(acc, dtype=np.float64)[:, :3]/_ACC_SCALE
+    if len(u) < 6:
+        raise ValueError("at least 6 samples are required")
+    X = np.stack([u[:, 1]**2, u[:, 2]**2, u[:, 0], u[:, 1], u[:, 2], np.ones(len(u))], axis=1)
+    k = np.linalg.lstsq(X, -u[:, 0]**2, rcond=None)[0]
+    ans = _axis_aligned(k)
+    if ans is None:
+        raise ValueError("samples do not fit an ellipsoid")
+    calib = AccCalibration.from_gain_offset(ans[0]/_ACC_SCALE, ans[1]*_ACC_SCALE, method="axis", samples=len(u))
+    calib.rms = float(np.sqrt(np.mean(_residual(calib.matrix, calib.offset, np.asarray(acc, dtype=np.float64)[:, :3])**2)))
+    return calib
+
+def _fit_quadric(u: np.ndarray):
+    """1g 単位の加速度 u に楕円体 (9パラメータ) を当てはめ、校正行列とオフセットを得る"""
+    x, y, z = u[:, 0], u[:, 1], u[:, 2]
+    # a x^2 + b y^2 + c z^2 + 2d xy + 2e xz + 2f yz + 2g x + 2h y + 2i z = 1
+    D = np.stack([x*x, y*y, z*z, 2*x*y, 2*x*z, 2*y*z, 2*x, 2*y, 2*z], axis=1)
+    v = np.linalg.lstsq(D, np.ones(len(u)), rcond=None)[0]
+    A = np.array([[v[0], v[3], v[4]],
+                  [v[3], v[1], v[5]],
+                  [v[4], v[5], v[2]]])
+    center = -np.linalg.solve(A, v[6:])
+    # (u - center)^T A_n (u - center) = 1 となるよう正規化
+    A_n = A/(1.0 + center @ A @ center)
+    w, vec = np.linalg.eigh(A_n)
+    if np.any(w <= 0):
+        raise ValueError("samples do not fit an ellipsoid")
+    # 対称な平方根行列 sqrt(A_n) で、楕円体を半径 ACC_G の球に写す
+    matrix = ACC_G*(vec*np.sqrt(w)) @ vec.T
+    return (matrix, center)
+
+def fit_ellipsoid(acc, reject_sigma: float=3.0, max_iter: int=5)-> tuple:
+    """軸間の干渉を含む楕円体 (9パラメータ) で一括推定し、外れ値を除いて推定し直す
+
+    校正後の大きさと ACC_G の差が、中央値から reject_sigma x (MAD から換算した標準偏差)
+    を超えるサンプルを外れ値とし、外れ値が変わらなくなるまで (最大 max_iter 回) 推定し直す。
+
+    Parameters
+    -----
+    acc: array like shape=(サンプル点数, 3) 静置時の加速度バイナリ (6列の IMUデータも可)
+    reject_sigma: float, default 3.0
+        外れ値判定のしきい値。0 以下の場合は外れ値を除かない
+    max_iter: int, default 5
+        推定し直す最大回数
+
+    Returns
+    -----
+    (AccCalibration, np.ndarray)
+        校正値
+        shape=(サンプル点数,) の bool 配列。推定に使ったサンプルは True、外れ値は False
+
+    Raises
+    -----
+    ValueError
+        外れ値を除いたサンプル点数が 9 未満、又は楕円体にならない場合
+    """
+    raw = np.asarray(acc, dtype=np.float64)[:, :3]
+    u = raw/_ACC_SCALE
+    inlier = np.ones(len(u), dtype=bool)
+    for _ in range(max(1, max_iter)):
+        if np.count_nonzero(inlier) < 9:
+            raise ValueError("at least 9 inlier samples are required")
+        matrix, center = _fit_quadric(u[inlier])
+        if reject_sigma <= 0:
+            break
+        res = _residual(matrix, center, u)
+        med = np.median(res[inlier])
+        sigma = 1.4826*np.median(np.abs(res[inlier] - med))
+        new_inlier = np.abs(res - med) <= reject_sigma*max(sigma, 1e-9*ACC_G)
+        if np.array_equal(new_inlier, inlier):
+            break
+        inlier = new_inlier
+    calib = AccCalibration(matrix/_ACC_SCALE, center*_ACC_SCALE, method="ellipsoid", samples=int(np.count_nonzero(inlier)))
+    calib.rms = float(np.sqrt(np.mean(_residual(calib.matrix, calib.offset, raw[inlier])**2)))
+    return (calib, inlier)
+
+class CalibrationStore:
+    """校正値を、デバイスの BLEアドレス毎に JSON ファイルに保存・読み出し
+
+    提供メソッド
+    -----
+    load(address, default=None)
+        BLEアドレスの校正値を読み出し
+    save(address, calib)
+        BLEアドレスの校正値を保存 (既存の値は上書き)
+    get_addresses()
+        保存済みの BLEアドレスのリスト
+    """
+    def __init__(self, file_name: str="calibration.json"):
+        """コンストラクタ
+
+        Parameters
+        -----
+        file_name: str, default "calibration.json"
+            保存先の JSON ファイル名
+        """
+        self._file_name = file_name
+
+    def _read(self)-> dict:
+        if not os.path.exists(self._file_name):
+            return {}
+        with open(self._file_name, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load(self, address: str, default=None):
+        """BLEアドレスの校正値を読み出し
+
+        Parameters
+        -----
+        address: str BLEアドレス
+        default: default None
+            校正値が無い場合の戻り値
+
+        Returns
+        -----
+        AccCalibration or default
+        """
+        value = self._read().get(str(address).upper())
+        if value is None:
+            return default
+        return AccCalibration.from_dict(value)
+
+    def save(self, address: str, calib: AccCalibration):
+        """BLEアドレスの校正値を保存 (既存の値は上書き)
+
+        書き込み途中で中断しても既存のファイルが壊れないよう、一時ファイルに書いてから置き換える。
+
+        Parameters
+        -----
+        address: str BLEアドレス
+        calib: AccCalibration 校正値
+        """
+        table = self._read()
+        value = calib.to_dict()
+        value['updated'] = time.strftime("%Y-%m-%d %H:%M:%S")
+        table[str(address).upper()] = value
+        tmp_name = self._file_name + ".tmp"
+        with open(tmp_name, "w", encoding="utf-8") as f:
+            json.dump(table, f, indent=2)
+        os.replace(tmp_name, self._file_name)
+
+    def get_addresses(self)-> list:
+        """保存済みの BLEアドレスのリスト"""
+        return list(self._read().keys())
@@ -10,6 +10,11 @@ Interface 2024年12月号付録
 同じインターフェースを持つ Arduino C++版も姉妹ライブラリとして別途提供します。
 PC 上では python 版を使い、マイコン上では C++ 版と、移植しやすくなっています。
 
+長時間のログを一括処理する用途には、NumPy アレイで N 個のクオータニオンを
+まとめて演算する QuaternionArray を用意しています。
+姿勢の時系列を別の時刻列に補間する (複数台の IMU の時刻を揃える等) には、
+QuaternionArray.resample を使います。
+
 ============
 提供API関数
 ============
@@ -24,6 +29,18 @@ class Quaternion
     クオータニオン演算クラス
     メソッド内訳は class Quaternion の docstring を参照
 
+class QuaternionArray
+    N 個のクオータニオンを (N, 4) の NumPy アレイでまとめて演算するクラス
+    メソッド内訳は class QuaternionArray の docstring を参照
+def integralAngleVelocityArray(w, dt, q0=None, method:str="exp", chunk_size:int=4096)-> tuple
+    角速度の時系列から、姿勢クオータニオンとオイラー角の時系列を一括計算
+
+class Madgwick
+    加速度と角速度から姿勢クオータニオンを推定する Madgwick フィルタ
+class Mahony
+    加速度と角速度から姿勢クオータニオンを推定する Mahony フィルタ
+    メソッド内訳は各クラスの docstring を参照
+
 ============
 使用例
 ============
@@ -47,6 +64,7 @@ print('Roll={}, Pitch={}, Yaw={} [rad]'.format(eul[0],eul[1],eul[2]))
 (2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
 """
 import math
+import numpy as np
 
 def innerProduct(a, b)-> float:
     """ベクトル内積 a * b
@@ -130,6 +148,8 @@ class Quaternion():
         共役クオータニオン化
     rotation(vec)
         クオータニオンを適用してベクトル回転
+    toMatrix()
+        クオータニオンを回転行列に変換
     integralAngleVelocity(w, dt:float)
         機体座標(センサ座標)での角速度からクオータニオン積算
     getEuler()
@@ -197,7 +217,9 @@ class Quaternion():
         return self
 
     def __mul__(self, op):
-        if isinstance(op, Quaternion):
+        if isinstance(op, QuaternionArray):
+            return NotImplemented   # QuaternionArray.__rmul__ で演算
+        elif isinstance(op, Quaternion):
             r = op._r
             i = op._i
             j = op._j
@@ -428,18 +450,40 @@ class Quaternion():
 
         Parameters
         -----
-        vec: array like 機体座標系のベクトル3要素 (x座標, y座標, z座標)
+        vec: array like
+            機体座標系のベクトル3要素 (x座標, y座標, z座標)
+            又は shape=(M, 3) の M 本のベクトル (toMatrix の回転行列で一括して変換する)
 
         Returns
         -----
         tuple: 標準座標系のベクトル3要素 (x座標, y座標, z座標)
+            vec が (M, 3) の場合は、shape=(M, 3) の np.ndarray
         """
         if isinstance(vec, Quaternion):
             q = self * vec * self.conj(False)
+        elif hasattr(vec[0], '__len__'):
+            return np.asarray(vec, dtype=np.float64) @ self.toMatrix().T
         else:
             q = self * Quaternion(0, vec[0], vec[1], vec[2]) * self.conj(False)
         return (q._i, q._j, q._k)
 
+    def toMatrix(self)-> np.ndarray:
+        """クオータニオンを回転行列に変換
+
+        rotation と同じ、機体座標系から基準座標系への座標変換を表す 3x3 行列 R を返す。
+        R @ v は rotation(v) と一致し、R の各列は機体座標系の x, y, z 軸を基準座標系に変換したベクトルになる。
+        複数のベクトルを変換する場合は、rotation を繰り返すより、行列を1回求めて掛ける方が速い。
+        単位クオータニオンでないと、rotation と同様に norm の2乗でスケーリングされる。
+
+        Returns
+        -----
+        np.ndarray: shape=(3, 3) の回転行列
+        """
+        r, i, j, k = self._r, self._i, self._j, self._k
+        return np.array([[r*r + i*i - j*j - k*k, (i*j - r*k)*2, (i*k + r*j)*2],
+                         [(i*j + r*k)*2, r*r - i*i + j*j - k*k, (j*k - r*i)*2],
+                         [(i*k - r*j)*2, (j*k + r*i)*2, r*r - i*i - j*j + k*k]])
+
     def integralAngleVelocity(self, w, dt:float)-> 'Quaternion':
         """機体座標(センサ座標)での角速度からクオータニオン積算
         
@@ -503,3 +547,833 @@ class Quaternion():
             x = math.atan2((self._j*self._k + self._r*self._i)*2, self._r*self._r - self._i*self._i - self._j*self._j + self._k*self._k)
             z = math.atan2((self._i*self._j + self._r*self._k)*2, self._r*self._r + self._i*self._i - self._j*self._j - self._k*self._k)
         return (x, y, z)
+
+
+def _element(index:int):
+    """QuaternionView の要素アクセス用プロパティを生成"""
+    def getter(self):
+        return self._buf.item(index)
+    def setter(self, val):
+        self._buf[index] = val
+    return property(getter, setter)
+
+class QuaternionView(Quaternion):
+    """アレイの1行を参照するクオータニオン
+
+    QuaternionArray の1行 (4要素の float64 アレイ) をコピーせずに参照する Quaternion。
+    Quaternion の全メソッドが使え、自身を変更するメソッド (normalize, += 等) の結果は
+    参照元のアレイに直接書き込まれる。新たなクオータニオンを返す演算の結果は Quaternion 型。
+
+    Parameters
+    -----
+    buf: np.ndarray 4要素 float64 アレイ (実数部, 虚数部i, 虚数部j, 虚数部k)
+    """
+    _r = _element(0)
+    _i = _element(1)
+    _j = _element(2)
+    _k = _element(3)
+
+    def __init__(self, buf):
+        self._buf = buf
+
+def _hamilton(a, b):
+    """クオータニオン積 a * b をアレイ一括で計算
+
+    Quaternion.__mul__ と同じ演算順で計算する。
+
+    Parameters
+    -----
+    a: np.ndarray shape=(..., 4)
+    b: np.ndarray shape=(..., 4)
+
+    Returns
+    -----
+    np.ndarray shape=(..., 4) ブロードキャスト後の形状
+    """
+    a_r, a_i, a_j, a_k = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    r, i, j, k = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+    out = np.empty(np.broadcast_shapes(a.shape, b.shape))
+    out[..., 0] = a_r*r - a_i*i - a_j*j - a_k*k
+    out[..., 1] = a_i*r + a_r*i - a_k*j + a_j*k
+    out[..., 2] = a_j*r + a_k*i + a_r*j - a_i*k
+    out[..., 3] = a_k*r - a_j*i + a_i*j + a_r*k
+    return out
+
+def _slerp(a, b, ratio, shortest:bool=True):
+    """単位クオータニオン a から b への球面線形補間をアレイ一括で計算
+
+    Parameters
+    -----
+    a: np.ndarray shape=(..., 4) 補間の始点 (ratio=0)
+    b: np.ndarray shape=(..., 4) 補間の終点 (ratio=1)
+    ratio: float or np.ndarray shape=(...) 補間の割合 0～1
+    shortest: bool, default True
+        True の場合、a と b の内積が負なら b の符号を反転し、回転角の小さい側で補間する
+
+    Returns
+    -----
+    np.ndarray shape=(..., 4) ブロードキャスト後の形状の単位クオータニオン
+    """
+    ratio = np.asarray(ratio, dtype=np.float64)[..., np.newaxis]
+    dot = np.sum(a*b, axis=-1, keepdims=True)
+    if shortest:
+        b = np.where(dot < 0, -b, b)
+        dot = np.abs(dot)
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    # 成す角が小さい場合は、sin(theta) での除算を避けて線形補間 (最後に単位化)
+    small = sin_theta < 1e-6
+    sin_theta = np.where(small, 1.0, sin_theta)
+    wa = np.where(small, 1.0 - ratio, np.sin((1.0 - ratio)*theta)/sin_theta)
+    wb = np.where(small, ratio, np.sin(ratio*theta)/sin_theta)
+    out = wa*a + wb*b
+    return out/np.sqrt(np.sum(out*out, axis=-1, keepdims=True))
+
+def _quatLog(q)-> np.ndarray:
+    """単位クオータニオン (cos(a), n sin(a)) の対数 n*a (shape=(..., 3) のベクトル部) をアレイ一括で計算"""
+    v = q[..., 1:]
+    sin_a = np.sqrt(np.sum(v*v, axis=-1))
+    a = np.arctan2(sin_a, q[..., 0])
+    # a/sin(a) を sin(a)=0 でも計算できるよう、その場合は 1 とする
+    scale = np.where(sin_a < 1e-12, 1.0, a/np.where(sin_a < 1e-12, 1.0, sin_a))
+    return v*scale[..., np.newaxis]
+
+def _quatExp(u)-> np.ndarray:
+    """ベクトル u = n*a (shape=(..., 3)) の指数 (cos(a), n sin(a)) をアレイ一括で計算"""
+    a = np.sqrt(np.sum(u*u, axis=-1))
+    out = np.empty(u.shape[:-1] + (4,))
+    out[..., 0] = np.cos(a)
+    # sin(a)/a を a=0 でも計算できるよう sinc で表す
+    out[..., 1:] = u*np.sinc(a/math.pi)[..., np.newaxis]
+    return out
+
+def _squadControl(q)-> np.ndarray:
+    """SQUAD 補間の制御点 s[n] = q[n] exp(-(log(q[n]^-1 q[n+1]) + log(q[n]^-1 q[n-1]))/4)
+
+    q は符号を揃えた単位クオータニオンの時系列 shape=(N, 4)。先頭と末尾の制御点は q と同じ。
+    """
+    s = q.copy()
+    if len(q) > 2:
+        inv = q[1:-1]*np.array((1.0, -1.0, -1.0, -1.0))
+        u = _quatLog(_hamilton(inv, q[2:])) + _quatLog(_hamilton(inv, q[:-2]))
+        s[1:-1] = _hamilton(q[1:-1], _quatExp(-0.25*u))
+    return s
+
+def _operand(op)-> np.ndarray:
+    """演算対象を shape=(4,) or (N, 4) の float64 アレイに変換"""
+    if isinstance(op, QuaternionArray):
+        return op._q
+    elif isinstance(op, Quaternion):
+        return np.array(op.getValue(), dtype=np.float64)
+    elif isinstance(op, (float, int, np.integer, np.floating)):
+        return np.array((op, 0.0, 0.0, 0.0))
+    else:   # 要素4 のアレイライク or (N, 4) のアレイライク
+        return np.asarray(op, dtype=np.float64)
+
+class QuaternionArray():
+    """回転を表現するクオータニオンの配列
+
+    N 個のクオータニオンを shape=(N, 4) の float64 アレイで保持し、一括演算する。
+    列は順に 実数部, 虚数部i, 虚数部j, 虚数部k 。
+    各演算は Quaternion と同じ式・同じ演算順で要素毎に行うため、結果は Quaternion と一致する。
+    座標系やオイラー角の定義も Quaternion と同じ。
+
+    提供演算子
+    -----
+    2項演算子 + - * (演算対象は int or float or Quaternion型 or QuaternionArray型 or
+        4要素 / (N, 4) のアレイライク型) 4要素のものは N 個全てに適用される
+    単項演算子 + -
+    複合演算子 += -= *=
+    配列形式 [] 整数インデックスでは、行をコピーせずに参照する QuaternionView が返る。
+        スライス等では QuaternionArray が返る
+    len() 要素数 N
+    np.asarray() 内部アレイ (N, 4) を取得
+
+    提供メソッド
+    -----
+    setValue(value)
+        クオータニオン直値設定
+    getValue()
+        クオータニオン直値取得
+    setRotate(vec, radian)
+        回転軸ベクトルと回転角からクオータニオン設定
+    getRotate()
+        回転のクオータニオンと見なして、回転軸単位ベクトルと回転角を取得
+    normalize(change_self:bool=True)
+        単位クオータニオン化
+    abs()
+        norm値取得
+    conj(change_self:bool=True)
+        共役クオータニオン化
+    rotation(vec)
+        クオータニオンを適用してベクトル回転
+    toMatrix()
+        クオータニオンを回転行列に変換
+    getEuler()
+        クオータニオンをオイラー角に変換
+    cumprod(q0=None, chunk_size:int=4096)
+        先頭からの累積クオータニオン積
+    slerp(op, ratio)
+        球面線形補間
+    resample(t, t_new, method:str="slerp")
+        姿勢の時系列を、任意の時刻列に補間して再サンプリング
+    """
+    def __init__(self, value=0):
+        """コンストラクタ
+
+        Parameters
+        -----
+        value: int or array like, default 0
+            int (np.integer を含む) の場合、その個数の単位クオータニオン (1, 0, 0, 0) で初期化
+            (N, 4) のアレイライク、または Quaternion のリストの場合は、その値で初期化
+            float64 型の np.ndarray はコピーせずに参照する
+        """
+        if isinstance(value, (int, np.integer)):
+            self._q = np.zeros((value, 4))
+            self._q[:, 0] = 1.0
+        elif isinstance(value, (list, tuple)) and len(value) > 0 and isinstance(value[0], Quaternion):
+            self._q = np.array([q.getValue() for q in value], dtype=np.float64)
+        else:
+            self._q = np.asarray(value, dtype=np.float64).reshape((-1, 4))
+
+    def __len__(self):
+        return self._q.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self._q
+        return self._q.astype(dtype)
+
+    def __pos__(self):
+        return QuaternionArray(self._q.copy())
+
+    def __neg__(self):
+        return QuaternionArray(-self._q)
+
+    def __abs__(self):
+        return self.abs()
+
+    def __add__(self, op):
+        return QuaternionArray(self._q + _operand(op))
+
+    def __sub__(self, op):
+        return QuaternionArray(self._q - _operand(op))
+
+    def __iadd__(self, op):
+        self._q += _operand(op)
+        return self
+
+    def __isub__(self, op):
+        self._q -= _operand(op)
+        return self
+
+    def __mul__(self, op):
+        return QuaternionArray(_hamilton(self._q, _operand(op)))
+
+    def __rmul__(self, op):
+        return QuaternionArray(_hamilton(_operand(op), self._q))
+
+    def __imul__(self, op):
+        self._q[...] = _hamilton(self._q, _operand(op))
+        return self
+
+    def __getitem__(self, key):
+        """配列形式の取得
+        整数インデックスでは、その行を参照する QuaternionView が返る
+        スライス等では QuaternionArray が返る (スライスは元アレイのビュー)
+        """
+        if isinstance(key, (int, np.integer)):
+            return QuaternionView(self._q[key])
+        return QuaternionArray(self._q[key])
+
+    def __setitem__(self, key, val):
+        """配列形式の設定
+        値は Quaternion型 or QuaternionArray型 or アレイライク
+        """
+        self._q[key] = _operand(val)
+
+    def __repr__(self):
+        return "QuaternionArray({})".format(np.array2string(self._q, separator=', '))
+
+    def setValue(self, value)-> 'QuaternionArray':
+        """クオータニオン直値設定
+
+        Parameters
+        -----
+        value: array like
+            shape=(N, 4) のアレイライク。4要素の場合は全要素に同じ値を設定する
+
+        Returns
+        -----
+        self
+        """
+        self._store(np.asarray(value, dtype=np.float64))
+        return self
+
+    def getValue(self)-> np.ndarray:
+        """クオータニオン直値取得
+
+        Returns
+        -----
+        np.ndarray
+            shape=(N, 4) の内部アレイ (コピーではない) 列は (実数部, 虚数部i, 虚数部j, 虚数部k)
+        """
+        return self._q
+
+    def setRotate(self, vec, radian)-> 'QuaternionArray':
+        """回転軸ベクトルと回転角からクオータニオン設定
+
+        Parameters
+        -----
+        vec: array like
+            回転軸ベクトル 3要素 or shape=(N, 3) のアレイライク 単位ベクトル化して計算される
+        radian: float or array like
+            回転角 [rad] スカラー or shape=(N,) のアレイライク
+
+        Returns
+        -----
+        self
+        """
+        vec = np.asarray(vec, dtype=np.float64)
+        radian = np.asarray(radian, dtype=np.float64)
+        norm = np.sqrt(vec[..., 0]*vec[..., 0]+vec[..., 1]*vec[..., 1]+vec[..., 2]*vec[..., 2])
+        sin_value = np.sin(radian/2) / norm
+        out = np.empty(np.broadcast_shapes(vec.shape[:-1], radian.shape) + (4,))
+        out[..., 0] = np.cos(radian/2)
+        out[..., 1] = sin_value * vec[..., 0]
+        out[..., 2] = sin_value * vec[..., 1]
+        out[..., 3] = sin_value * vec[..., 2]
+        self._store(out)
+        return self
+
+    def getRotate(self)-> tuple:
+        """回転のクオータニオンと見なして、回転軸単位ベクトルと回転角を取得
+
+        Returns
+        -----
+        (np.ndarray, np.ndarray)
+            第一要素は shape=(N, 3) の回転軸単位ベクトル
+            第二要素は shape=(N,) の回転角[rad] (-PI to +PI)
+        """
+        temp = self.normalize(False)._q
+        theta = np.arccos(np.clip(temp[:, 0], -1.0, 1.0))*2
+        sin_value = np.sin(theta/2)
+        small = sin_value < 1e-6
+        vec = temp[:, 1:] / np.where(small, 1.0, sin_value)[:, np.newaxis]
+        vec[small] = (1, 0, 0)
+        theta = np.where(small, 0.0, theta)
+        theta = np.where(theta > math.pi, theta-2*math.pi, theta)
+        return (vec, theta)
+
+    def normalize(self, change_self:bool=True)-> 'QuaternionArray':
+        """単位クオータニオン化
+
+        norm が 1e-6 未満の要素は (1, 0, 0, 0) とする。
+
+        Parameters
+        -----
+        change_self: bool , default True
+            自身の値を更新するか?
+
+        Returns
+        -----
+        QuaternionArray 単位化されたクオータニオン
+        """
+        q = self._q
+        norm = np.sqrt(q[:, 0]**2+q[:, 1]**2+q[:, 2]**2+q[:, 3]**2)
+        small = norm < 1e-6
+        out = q / np.where(small, 1.0, norm)[:, np.newaxis]
+        out[small] = (1.0, 0.0, 0.0, 0.0)
+        if change_self:
+            q[...] = out
+            return self
+        else:
+            return QuaternionArray(out)
+
+    def abs(self)-> np.ndarray:
+        """norm値取得
+
+        Returns
+        -----
+        np.ndarray shape=(N,) の norm値
+        """
+        q = self._q
+        return np.sqrt(q[:, 0]*q[:, 0]+q[:, 1]*q[:, 1]+q[:, 2]*q[:, 2]+q[:, 3]*q[:, 3])
+
+    def conj(self, change_self:bool=True)-> 'QuaternionArray':
+        """共役クオータニオン化
+
+        Parameters
+        -----
+        change_self: bool , default True
+            自身の値を更新するか?
+
+        Returns
+        -----
+        QuaternionArray 共役クオータニオン
+        """
+        if change_self:
+            self._q[:, 1:] *= -1
+            return self
+        else:
+            out = self._q.copy()
+            out[:, 1:] *= -1
+            return QuaternionArray(out)
+
+    def rotation(self, vec)-> np.ndarray:
+        """クオータニオンを適用してベクトル回転
+
+        各クオータニオンにより、機体座標系から基準座標系に座標変換をする。
+        単位クオータニオンでないと、ベクトル長がスケーリングされる。
+
+        Parameters
+        -----
+        vec: array like
+            機体座標系のベクトル 3要素 or shape=(N, 3) のアレイライク
+            3要素の場合は、全クオータニオンで同じベクトルを回転する
+
+        Returns
+        -----
+        np.ndarray: shape=(N, 3) の標準座標系のベクトル
+        """
+        vec = np.asarray(vec, dtype=np.float64)
+        p = np.zeros(vec.shape[:-1] + (4,))
+        p[..., 1:] = vec
+        q = _hamilton(_hamilton(self._q, p), self.conj(False)._q)
+        return q[:, 1:]
+
+    def toMatrix(self)-> np.ndarray:
+        """クオータニオンを回転行列に変換
+
+        Quaternion.toMatrix と同じ定義で、各要素を回転行列に変換する。
+        姿勢の時系列を、回転行列を使う他のツールに渡す場合などに、Python のループなしで変換できる。
+
+        Returns
+        -----
+        np.ndarray: shape=(N, 3, 3) の回転行列。[n] が n 番目のクオータニオンの回転行列
+        """
+        r, i, j, k = self._q[:, 0], self._q[:, 1], self._q[:, 2], self._q[:, 3]
+        m = np.empty((len(self), 3, 3))
+        m[:, 0, 0] = r*r + i*i - j*j - k*k
+        m[:, 0, 1] = (i*j - r*k)*2
+        m[:, 0, 2] = (i*k + r*j)*2
+        m[:, 1, 0] = (i*j + r*k)*2
+        m[:, 1, 1] = r*r - i*i + j*j - k*k
+        m[:, 1, 2] = (j*k - r*i)*2
+        m[:, 2, 0] = (i*k - r*j)*2
+        m[:, 2, 1] = (j*k + r*i)*2
+        m[:, 2, 2] = r*r - i*i - j*j + k*k
+        return m
+
+    def getEuler(self)-> np.ndarray:
+        """クオータニオンをオイラー角に変換
+
+        Quaternion.getEuler と同じ定義で、各要素をオイラー角に変換する。
+        ジンバルロック時は(ピッチ角 +PI/2 or -PI/2)、ヨー角を 0 とする。
+
+        Returns
+        -----
+        np.ndarray: shape=(N, 3) 列は (ロール角, ピッチ角, ヨー角) [rad]
+        """
+        r, i, j, k = self._q[:, 0], self._q[:, 1], self._q[:, 2], self._q[:, 3]
+        norm2 = r*r+i*i+j*j+k*k
+        sy = (r*j - i*k)*2
+        sy = np.where(np.abs(norm2-1) > 1e-6, sy/np.where(norm2 < 1e-12, 1.0, norm2), sy)
+        upper = sy > 1-1e-6
+        lower = sy < -1+1e-6
+        cx = r*r - i*i + j*j - k*k
+        x = np.arctan2((j*k + r*i)*2, r*r - i*i - j*j + k*k)
+        x = np.where(upper, np.arctan2((i*j - r*k)*2, cx), x)
+        x = np.where(lower, np.arctan2((r*k - i*j)*2, cx), x)
+        y = np.arcsin(np.clip(sy, -1.0, 1.0))
+        y = np.where(upper, math.pi/2, y)
+        y = np.where(lower, -math.pi/2, y)
+        z = np.arctan2((i*j + r*k)*2, r*r + i*i - j*j - k*k)
+        z = np.where(upper | lower, 0.0, z)
+        euler = np.stack([x, y, z], axis=1)
+        euler[norm2 < 1e-12] = 0.0
+        return euler
+
+    def cumprod(self, q0=None, chunk_size:int=4096)-> 'QuaternionArray':
+        """先頭からの累積クオータニオン積
+
+        n 番目の要素が q0 * self[0] * self[1] * ... * self[n] となる QuaternionArray を返す。
+        chunk_size 毎に区切り、区間内は倍々に積を取る並列プレフィックス積
+        (log2(chunk_size) 回のアレイ演算) で計算し、区間末尾の値を次の区間に引き継ぐ。
+
+        Parameters
+        -----
+        q0: Quaternion or array like, default None
+            積の先頭に掛けるクオータニオン。None の場合は (1, 0, 0, 0)
+        chunk_size: int, default 4096
+            一度に処理する要素数
+
+        Returns
+        -----
+        QuaternionArray 累積積
+        """
+        out = np.empty_like(self._q)
+        carry = None if q0 is None else _operand(q0)
+        for start in range(0, len(self), chunk_size):
+            p = self._q[start:start+chunk_size].copy()
+            step = 1
+            while step < p.shape[0]:
+                p[step:] = _hamilton(p[:-step], p[step:])
+                step *= 2
+            if carry is not None:
+                p = _hamilton(carry, p)
+            out[start:start+chunk_size] = p
+            carry = p[-1]
+        return QuaternionArray(out)
+
+    def slerp(self, op, ratio)-> 'QuaternionArray':
+        """球面線形補間
+
+        各要素について、self (ratio=0) から op (ratio=1) へ一定の角速度で回転する姿勢を求める。
+        内積が負の場合は op の符号を反転し、回転角の小さい側で補間する。
+        どちらも単位クオータニオンであること。
+
+        Parameters
+        -----
+        op: Quaternion or QuaternionArray or array like
+            補間の終点。4要素のものは N 個全てに適用される
+        ratio: float or array like
+            補間の割合 0～1。スカラー or shape=(N,) のアレイライク
+
+        Returns
+        -----
+        QuaternionArray 補間した単位クオータニオン
+        """
+        return QuaternionArray(_slerp(self._q, _operand(op), ratio))
+
+    def resample(self, t, t_new, method:str="slerp")-> 'QuaternionArray':
+        """姿勢の時系列を、任意の時刻列に補間して再サンプリング
+
+        self を時刻 t の姿勢の時系列とみなし、時刻 t_new の姿勢を補間で求める。
+        各 t_new を挟む区間は np.searchsorted で一括して求めるので、大量の時刻も1回で処理できる。
+        q と -q は同じ回転を表すため、隣り合う要素の内積が負にならないよう符号を揃えてから補間する。
+        t の範囲外の時刻は、先頭又は末尾の姿勢になる。
+
+        Parameters
+        -----
+        t: array like shape=(N,) 各要素の時刻 [sec] (単調増加)
+        t_new: array like shape=(M,) 補間する時刻 [sec] (順不同)
+        method: str, default "slerp"
+            "slerp" : 球面線形補間 (区間内は一定の角速度で回転)
+            "squad" : 球面四角形補間 (区間の境目でも角速度が滑らかに変わる)
+
+        Returns
+        -----
+        QuaternionArray shape=(M, 4) の補間した姿勢 (単位クオータニオン)
+        """
+        if method not in ("slerp", "squad"):
+            raise ValueError("method must be 'slerp' or 'squad'")
+        t = np.asarray(t, dtype=np.float64)
+        t_new = np.asarray(t_new, dtype=np.float64).reshape(-1)
+        q = self._q/self.abs()[:, np.newaxis]
+        if len(q) == 1:
+            return QuaternionArray(np.repeat(q, len(t_new), axis=0))
+        # 隣り合う要素の内積が負なら、それ以降の符号を反転する
+        flip = np.where(np.sum(q[:-1]*q[1:], axis=1) < 0, -1.0, 1.0)
+        q = q*np.concatenate(([1.0], np.cumprod(flip)))[:, np.newaxis]
+        # t_new を挟む区間 t[n] <= t_new < t[n+1] と、区間内の割合
+        n = np.clip(np.searchsorted(t, t_new, side='right') - 1, 0, len(t) - 2)
+        span = t[n+1] - t[n]
+        ratio = np.clip((t_new - t[n])/np.where(span > 0, span, 1.0), 0.0, 1.0)
+        if method == "slerp":
+            return QuaternionArray(_slerp(q[n], q[n+1], ratio))
+        # squad(q[n], q[n+1], s[n], s[n+1], h) = slerp(slerp(q[n], q[n+1], h), slerp(s[n], s[n+1], h), 2h(1-h))
+        s = _squadControl(q)
+        return QuaternionArray(_slerp(_slerp(q[n], q[n+1], ratio, False), _slerp(s[n], s[n+1], ratio, False),
+                                      2*ratio*(1 - ratio), False))
+
+    def _store(self, value):
+        """内部アレイに値を設定。形状が同じなら既存アレイに書き込み、ビューを保つ"""
+        if value.shape == self._q.shape or value.shape == (4,):
+            self._q[...] = value
+        else:
+            self._q = np.array(value, dtype=np.float64).reshape((-1, 4))
+
+def integralAngleVelocityArray(w, dt, q0=None, method:str="exp", chunk_size:int=4096)-> tuple:
+    """角速度の時系列から、姿勢クオータニオンとオイラー角の時系列を一括計算
+
+    各時刻の角速度で Quaternion.integralAngleVelocity を順に呼び出すのと同じ積算を、
+    各時刻の回転増分クオータニオンの累積積 (QuaternionArray.cumprod) として一括で計算する。
+    n 番目の結果は、0～n 番目の角速度まで積算した姿勢になる。
+
+    method="exp" の場合、各周期の角速度を一定とみなした厳密な回転増分
+        dq = (cos(|w|dt/2), w/|w| sin(|w|dt/2))
+    を使う。method="euler" の場合、Quaternion.integralAngleVelocity と同じ1次近似の
+    更新式(15) + 単位化 と等価な増分 dq = normalize(1, w dt/2) を使い、
+    逐次計算と丸め誤差の範囲で一致する。
+
+    Parameters
+    -----
+    w: array like
+        shape=(N, 3) 機体座標系で観測される角速度 (x軸角速度, y軸角速度, z軸角速度) [rad/sec]
+    dt: float or array like
+        1データ周期時間 [sec] スカラー or 各時刻毎の shape=(N,) のアレイライク
+    q0: Quaternion or array like, default None
+        積算開始前の初期クオータニオン。None の場合は (1, 0, 0, 0)
+    method: str, default "exp"
+        "exp" : 厳密な回転増分 / "euler" : 1次近似 (integralAngleVelocity 互換)
+    chunk_size: int, default 4096
+        累積積を一度に処理する要素数
+
+    Returns
+    -----
+    (QuaternionArray, np.ndarray)
+        第一要素は shape=(N, 4) の各時刻の姿勢クオータニオン
+        第二要素は shape=(N, 3) の各時刻のオイラー角 (ロール角, ピッチ角, ヨー角) [rad]
+    """
+    w = np.asarray(w, dtype=np.float64).reshape((-1, 3))
+    dt = np.asarray(dt, dtype=np.float64)
+    dq = np.empty((w.shape[0], 4))
+    if method == "exp":
+        w_norm = np.sqrt(w[:, 0]*w[:, 0]+w[:, 1]*w[:, 1]+w[:, 2]*w[:, 2])
+        half = 0.5*w_norm*dt
+        dq[:, 0] = np.cos(half)
+        # sin(|w|dt/2)/|w| を |w|=0 でも計算できるよう sinc で表す
+        dq[:, 1:] = w * (0.5*dt*np.sinc(half/math.pi))[:, np.newaxis]
+    elif method == "euler":
+        dq[:, 0] = 1.0
+        dq[:, 1:] = 0.5*w*dt[..., np.newaxis]
+        dq /= np.sqrt(np.sum(dq*dq, axis=1))[:, np.newaxis]
+    else:
+        raise ValueError("method must be 'exp' or 'euler'")
+    track = QuaternionArray(dq).cumprod(q0, chunk_size).normalize()
+    return (track, track.getEuler())
+
+
+def _madgwickStep(qw:float, qx:float, qy:float, qz:float, gx:float, gy:float, gz:float,
+                  ax:float, ay:float, az:float, dt:float, gain:float)-> tuple:
+    """Madgwick フィルタの1サンプル分の更新 (ahrs.filters.Madgwick.updateIMU と同じ式)"""
+    if gx == 0 and gy == 0 and gz == 0:
+        return (qw, qx, qy, qz)
+    # 角速度によるクオータニオンの変化率 qDot = 0.5 q * (0, g)
+    dw = 0.5*(-qx*gx - qy*gy - qz*gz)
+    dx = 0.5*( qw*gx + qy*gz - qz*gy)
+    dy = 0.5*( qw*gy - qx*gz + qz*gx)
+    dz = 0.5*( qw*gz + qx*gy - qy*gx)
+    a_norm = math.sqrt(ax*ax + ay*ay + az*az)
+    if a_norm > 0:
+        ax /= a_norm; ay /= a_norm; az /= a_norm
+        n = math.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+        w, x, y, z = qw/n, qx/n, qy/n, qz/n
+        # 推定姿勢で見た重力方向と、加速度の差 (目的関数)
+        f0 = 2.0*(x*z - w*y) - ax
+        f1 = 2.0*(w*x + y*z) - ay
+        f2 = 2.0*(0.5 - x*x - y*y) - az
+        if f0 != 0 or f1 != 0 or f2 != 0:
+            # 目的関数の勾配 (ヤコビアンの転置 x 目的関数)
+            s0 = -2.0*y*f0 + 2.0*x*f1
+            s1 =  2.0*z*f0 + 2.0*w*f1 - 4.0*x*f2
+            s2 = -2.0*w*f0 + 2.0*z*f1 - 4.0*y*f2
+            s3 =  2.0*x*f0 + 2.0*y*f1
+            s_norm = math.sqrt(s0*s0 + s1*s1 + s2*s2 + s3*s3)
+            if s_norm > 0:
+                k = gain/s_norm
+                dw -= k*s0; dx -= k*s1; dy -= k*s2; dz -= k*s3
+    qw += dw*dt; qx += dx*dt; qy += dy*dt; qz += dz*dt
+    n = math.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+    return (qw/n, qx/n, qy/n, qz/n)
+
+def _mahonyStep(qw:float, qx:float, qy:float, qz:float, gx:float, gy:float, gz:float,
+                ax:float, ay:float, az:float, dt:float, k_p:float, k_i:float, bias:list)-> tuple:
+    """Mahony フィルタの1サンプル分の更新 (ahrs.filters.Mahony.updateIMU と同じ式)
+
+    bias は角速度バイアスの推定値3要素のリストで、その場で更新される。
+    """
+    if gx == 0 and gy == 0 and gz == 0:
+        return (qw, qx, qy, qz)
+    a_norm = math.sqrt(ax*ax + ay*ay + az*az)
+    if a_norm > 0:
+        ax /= a_norm; ay /= a_norm; az /= a_norm
+        n = math.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+        w, x, y, z = qw/n, qx/n, qy/n, qz/n
+        # 推定姿勢で見た重力方向
+        vx = 2.0*(x*z - w*y)
+        vy = 2.0*(w*x + y*z)
+        vz = 1.0 - 2.0*(x*x + y*y)
+        # 加速度と推定重力方向の外積が誤差
+        ex = ay*vz - az*vy
+        ey = az*vx - ax*vz
+        ez = ax*vy - ay*vx
+        bias[0] -= k_i*ex*dt; bias[1] -= k_i*ey*dt; bias[2] -= k_i*ez*dt
+        gx = gx - bias[0] + k_p*ex
+        gy = gy - bias[1] + k_p*ey
+        gz = gz - bias[2] + k_p*ez
+    qw, qx, qy, qz = (qw + 0.5*(-qx*gx - qy*gy - qz*gz)*dt,
+                      qx + 0.5*( qw*gx + qy*gz - qz*gy)*dt,
+                      qy + 0.5*( qw*gy - qx*gz + qz*gx)*dt,
+                      qz + 0.5*( qw*gz + qx*gy - qy*gx)*dt)
+    n = math.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+    return (qw/n, qx/n, qy/n, qz/n)
+
+class _AttitudeFilter():
+    """Madgwick, Mahony フィルタの共通部分"""
+    def __init__(self, q0=None, frequency:float=100.0):
+        self._q = Quaternion()
+        if q0 is not None:
+            self.setQuaternion(q0)
+        self._dt = 1.0/frequency
+
+    def setQuaternion(self, q)-> None:
+        """現在の姿勢クオータニオン設定
+
+        Parameters
+        -----
+        q: Quaternion or array like 機体座標から基準座標へ変換するクオータニオン (4要素)
+        """
+        self._q.setValue(float(q[0]), float(q[1]), float(q[2]), float(q[3]))
+
+    def getQuaternion(self)-> Quaternion:
+        """現在の姿勢クオータニオン取得 (コピー)
+
+        Returns
+        -----
+        Quaternion 機体座標から基準座標へ変換するクオータニオン
+        """
+        return Quaternion(self._q._r, self._q._i, self._q._j, self._q._k)
+
+    def updateIMU(self, gyr, acc, dt:float=None)-> Quaternion:
+        """1サンプル分の角速度と加速度で姿勢を更新
+
+        戻り値は内部の Quaternion そのもので、以降の更新でも同じオブジェクトが更新される。
+
+        Parameters
+        -----
+        gyr: array like 機体座標系の角速度3要素 [rad/sec]
+        acc: array like 機体座標系の加速度3要素 (単位不問)
+        dt: float, default None
+            1データ周期時間 [sec]。None の場合は 1/frequency
+
+        Returns
+        -----
+        Quaternion 更新後の、機体座標から基準座標へ変換するクオータニオン
+        """
+        q = self._q
+        q._r, q._i, q._j, q._k = self._step(q._r, q._i, q._j, q._k,
+            float(gyr[0]), float(gyr[1]), float(gyr[2]), float(acc[0]), float(acc[1]), float(acc[2]),
+            self._dt if dt is None else dt)
+        return q
+
+    def updateIMUArray(self, gyr, acc, dt=None)-> QuaternionArray:
+        """N サンプル分の角速度と加速度で、順に姿勢を更新
+
+        updateIMU を N 回呼び出すのと同じ結果を、まとめて計算する。
+        最後のサンプルで更新した姿勢が、以降の updateIMU の初期値になる。
+
+        Parameters
+        -----
+        gyr: array like shape=(N, 3) 機体座標系の角速度 [rad/sec]
+        acc: array like shape=(N, 3) 機体座標系の加速度 (単位不問)
+        dt: float or array like, default None
+            1データ周期時間 [sec] スカラー or 各時刻毎の shape=(N,) のアレイライク。
+            None の場合は 1/frequency
+
+        Returns
+        -----
+        QuaternionArray shape=(N, 4) 各サンプル更新後の姿勢クオータニオン
+        """
+        gyr = np.asarray(gyr, dtype=np.float64).reshape((-1, 3))
+        acc = np.asarray(acc, dtype=np.float64).reshape((-1, 3))
+        n = len(gyr)
+        dt = np.broadcast_to(np.asarray(self._dt if dt is None else dt, dtype=np.float64), (n,))
+        step = self._step
+        q = self._q
+        qw, qx, qy, qz = q._r, q._i, q._j, q._k
+        out = [None]*n
+        # numpy の要素アクセスを避け、Python の float のリストで回す
+        for m, (g, a, h) in enumerate(zip(gyr.tolist(), acc.tolist(), dt.tolist())):
+            qw, qx, qy, qz = step(qw, qx, qy, qz, g[0], g[1], g[2], a[0], a[1], a[2], h)
+            out[m] = (qw, qx, qy, qz)
+        q._r, q._i, q._j, q._k = qw, qx, qy, qz
+        return QuaternionArray(np.array(out, dtype=np.float64).reshape((n, 4)))
+
+class Madgwick(_AttitudeFilter):
+    """加速度と角速度から姿勢クオータニオンを推定する Madgwick フィルタ
+
+    ahrs ライブラリ (ahrs.filters.Madgwick) の updateIMU と同じ式で計算する。
+    角速度の積算に、加速度から見た重力方向との誤差を、勾配降下法で gain(beta) だけ
+    戻す補正を加える。
+
+    提供メソッド
+    -----
+    setQuaternion(q)
+        現在の姿勢クオータニオン設定
+    getQuaternion()
+        現在の姿勢クオータニオン取得
+    updateIMU(gyr, acc, dt:float=None)
+        1サンプル分の角速度と加速度で姿勢を更新 (逐次処理用)
+    updateIMUArray(gyr, acc, dt=None)
+        N サンプル分の角速度と加速度で、順に姿勢を更新 (一括処理用)
+    """
+    def __init__(self, q0=None, frequency:float=100.0, beta:float=0.1):
+        """コンストラクタ
+
+        Parameters
+        -----
+        q0: Quaternion or array like, default None
+            初期姿勢クオータニオン。None の場合は (1, 0, 0, 0)
+        frequency: float, default 100.0
+            更新周波数 [Hz] (dt 省略時の周期時間は 1/frequency)
+        beta: float, default 0.1
+            補正のゲイン。角速度を重視(小) ---> 加速度を重視(大)
+        """
+        super().__init__(q0, frequency)
+        self._gain = beta
+
+    def _step(self, qw, qx, qy, qz, gx, gy, gz, ax, ay, az, dt)-> tuple:
+        return _madgwickStep(qw, qx, qy, qz, gx, gy, gz, ax, ay, az, dt, self._gain)
+
+class Mahony(_AttitudeFilter):
+    """加速度と角速度から姿勢クオータニオンを推定する Mahony フィルタ
+
+    ahrs ライブラリ (ahrs.filters.Mahony) の updateIMU と同じ式で計算する。
+    加速度から見た重力方向との誤差を、比例(k_P) 積分(k_I) で角速度に帰還する。
+    積分値は角速度バイアスの推定値になる。
+
+    提供メソッド
+    -----
+    setQuaternion(q)
+        現在の姿勢クオータニオン設定
+    getQuaternion()
+        現在の姿勢クオータニオン取得
+    getBias()
+        角速度バイアスの推定値取得
+    updateIMU(gyr, acc, dt:float=None)
+        1サンプル分の角速度と加速度で姿勢を更新 (逐次処理用)
+    updateIMUArray(gyr, acc, dt=None)
+        N サンプル分の角速度と加速度で、順に姿勢を更新 (一括処理用)
+    """
+    def __init__(self, q0=None, frequency:float=100.0, k_P:float=1.0, k_I:float=0.3):
+        """コンストラクタ
+
+        Parameters
+        -----
+        q0: Quaternion or array like, default None
+            初期姿勢クオータニオン。None の場合は (1, 0, 0, 0)
+        frequency: float, default 100.0
+            更新周波数 [Hz] (dt 省略時の周期時間は 1/frequency)
+        k_P: float, default 1.0
+            比例ゲイン
+        k_I: float, default 0.3
+            積分ゲイン
+        """
+        super().__init__(q0, frequency)
+        self._k_p = k_P
+        self._k_i = k_I
+        self._bias = [0.0, 0.0, 0.0]
+
+    def getBias(self)-> tuple:
+        """角速度バイアスの推定値取得
+
+        Returns
+        -----
+        tuple: 3要素 (x軸, y軸, z軸) [rad/sec]
+        """
+        return tuple(self._bias)
+
+    def _step(self, qw, qx, qy, qz, gx, gy, gz, ax, ay, az, dt)-> tuple:
+        return _mahonyStep(qw, qx, qy, qz, gx, gy, gz, ax, ay, az, dt, self._k_p, self._k_i, self._bias)
@@ -0,0 +1,444 @@
+""" クオータニオンの固定小数点演算ライブラリ(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+cq_quaternion.py の姿勢積算 (Quaternion.integralAngleVelocity) を、マイコン上で動かす
+整数演算だけで再現するライブラリです。各要素は小数部 frac_bits ビットの固定小数点数
+(Q30 なら 1.0 = 2^30、Q15 なら 1.0 = 2^15) で、途中の積は 64bit 整数に収まります。
+演算は C++ の int32_t / int64_t でそのまま書ける手順 (積、丸め付き右シフト、加算) だけを使い、
+PC 上でマイコンと同じ計算結果を検証できます。
+
+角速度は imu_base が送る角速度バイナリ値 (オフセット補正後) をそのまま与え、
+rad/sec への変換ゲインと周期時間は、コンストラクタで1つの固定小数点定数にまとめます。
+単位化は、平方根と除算の代わりに 1/sqrt(x) のニュートン法1回 (x はほぼ1) で行います。
+k_P を指定すると、Mahony フィルタの比例項と同じく、加速度と推定した重力方向の外積で角速度を補正します。
+
+imu_base の "q" / "Q" コマンド (姿勢ストリーミング) は、streamAttitude と同じ整数演算を
+マイコン上で行い、同じ値を送信します。
+
+============
+提供API
+============
+class FixedQuaternion
+    固定小数点のクオータニオン
+class FixedIntegrator
+    角速度バイナリ値から固定小数点クオータニオンを積算
+    update(w) で逐次、updateArray(w) で時系列をまとめて積算
+def fixedFromAcc(acc, frac_bits)-> FixedQuaternion
+    静置時の加速度から、初期姿勢の固定小数点クオータニオンを求める
+def streamAttitude(imu, interval, decimation, k_P)-> np.ndarray
+    imu_base の姿勢ストリーミングと同じ Q15 クオータニオン系列を求める
+def quaternionToQ15(q)-> np.ndarray
+    クオータニオンを Q15 の int16 に変換 (姿勢ストリーミングの送信形式)
+def q15ToQuaternion(q15)-> np.ndarray
+    Q15 の int16 をクオータニオンに戻す
+def errorReport(imu, interval, frac_bits)-> dict
+    float64 版 (cq_quaternion) との誤差を評価
+
+python cq_quaternion_fixed.py で、sampling.npy に対する Q30, Q15 の誤差を表示します。
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import math
+import numpy as np
+from cq_quaternion import Quaternion, QuaternionArray, integralAngleVelocityArray
+
+# 角速度バイナリを rad/sec に変換するゲイン (+-250dps full scale)
+GYR_SCALE = 2*250/65536/180*math.pi
+# 積算定数の追加の小数部ビット数 (角速度バイナリ x 定数 の積を、この分だけ右シフトする)
+_GAIN_EXTRA_BITS = 16
+# 加速度補正の定数 (k_P x dt / 2) の小数部ビット数
+_KP_BITS = 30
+
+def _shift(x: int, bits: int)-> int:
+    """丸め付き算術右シフト (C++ では (x + (1 << (bits-1))) >> bits)"""
+    return (x + (1 << (bits - 1))) >> bits
+
+def _isqrt(x):
+    """整数平方根 (切り捨て)。Python の int でも、NumPy の int64 アレイ (2^52 未満) でも同じ結果"""
+    if isinstance(x, np.ndarray):
+        r = np.floor(np.sqrt(x.astype(np.float64))).astype(np.int64)
+        r -= (r*r > x)
+        r += ((r + 1)*(r + 1) <= x)
+        return r
+    return math.isqrt(x)
+
+def _divTrunc(a, b):
+    """0方向に丸める整数除算 (C++ の / と同じ。b > 0)"""
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.sign(a)*(np.abs(a)//b)
+    return -(-a//b) if a < 0 else a//b
+
+class FixedQuaternion():
+    """固定小数点のクオータニオン
+
+    実数部、虚数部 i, j, k を、小数部 frac_bits ビットの整数で保持する。
+
+    提供メソッド
+    -----
+    fromQuaternion(q, frac_bits:int=30)
+        Quaternion (又は4要素アレイライク) から生成 (クラスメソッド)
+    toQuaternion()
+        Quaternion に変換
+    getValue()
+        整数値4要素を取得
+    normalize()
+        単位クオータニオン化 (ニュートン法1回の近似)
+    """
+    def __init__(self, r:int=None, i:int=0, j:int=0, k:int=0, frac_bits:int=30):
+        """コンストラクタ
+
+        Parameters
+        -----
+        r, i, j, k: int
+            各要素の整数値。r=None の場合は 1.0 (= 1 << frac_bits)
+        frac_bits: int, default 30
+            小数部ビット数 (Q30 なら 30、Q15 なら 15)
+        """
+        self.frac_bits = frac_bits
+        self._r = (1 << frac_bits) if r is None else int(r)
+        self._i = int(i)
+        self._j = int(j)
+        self._k = int(k)
+
+    @classmethod
+    def fromQuaternion(cls, q, frac_bits:int=30)-> 'FixedQuaternion':
+        """Quaternion (又は4要素アレイライク) から生成"""
+        one = 1 << frac_bits
+        return cls(*[int(round(float(q[n])*one)) for n in range(4)], frac_bits=frac_bits)
+
+    def toQuaternion(self)-> Quaternion:
+        """Quaternion に変換"""
+        one = float(1 << self.frac_bits)
+        return Quaternion(self._r/one, self._i/one, self._j/one, self._k/one)
+
+    def getValue(self)-> tuple:
+        """整数値4要素を取得
+
+        Returns
+        -----
+        tuple: (実数部, 虚数部i, 虚数部j, 虚数部k) の整数値
+        """
+        return (self._r, self._i, self._j, self._k)
+
+    def __getitem__(self, key):
+        return self.getValue()[key]
+
+    def __repr__(self):
+        return "FixedQuaternion({}, {}, {}, {}, frac_bits={})".format(self._r, self._i, self._j, self._k, self.frac_bits)
+
+    def normalize(self)-> 'FixedQuaternion':
+        """単位クオータニオン化
+
+        norm^2 = x がほぼ 1 の時の 1/sqrt(x) を、初期値 1 のニュートン法1回 (3 - x)/2 で近似する。
+        積算1回分の変化 (x - 1 が 1e-6 程度) では、誤差は (x - 1)^2 程度になる。
+        """
+        f = self.frac_bits
+        norm2 = _shift(self._r*self._r + self._i*self._i + self._j*self._j + self._k*self._k, f)
+        inv = ((3 << f) - norm2) >> 1
+        self._r = _shift(self._r*inv, f)
+        self._i = _shift(self._i*inv, f)
+        self._j = _shift(self._j*inv, f)
+        self._k = _shift(self._k*inv, f)
+        return self
+
+class FixedIntegrator():
+    """角速度バイナリ値から、固定小数点クオータニオンを積算
+
+    Quaternion.integralAngleVelocity と同じ1次近似の更新式(15) + 単位化を、整数演算で行う。
+        h = 角速度バイナリ値 x gain  (gain = GYR_SCALE x dt / 2 を 小数部 frac_bits+16 ビットで表した定数)
+        q <- q + (h の純虚クオータニオンとの積)
+        q <- normalize(q)
+
+    提供メソッド
+    -----
+    update(w)
+        1サンプル分の角速度バイナリ値で積算 (逐次処理用)
+    updateArray(w)
+        時系列の角速度バイナリ値でまとめて積算 (一括処理用)
+    getQuaternion()
+        現在の固定小数点クオータニオン
+    getGain()
+        積算定数 (整数値)
+
+    k_P を指定した場合は、update, updateArray に加速度も与えると、Mahony フィルタの比例項と
+    同じく、加速度 a と推定した重力方向 v の外積 a x v の k_P 倍を角速度に加えてから積算する。
+    """
+    def __init__(self, dt:float, q0=None, frac_bits:int=30, gyr_scale:float=GYR_SCALE, k_P:float=0.0):
+        """コンストラクタ
+
+        Parameters
+        -----
+        dt: float
+            1データ周期時間 [sec]
+        q0: Quaternion or FixedQuaternion or array like, default None
+            初期クオータニオン。None の場合は (1, 0, 0, 0)
+        frac_bits: int, default 30
+            小数部ビット数 (Q30 なら 30、Q15 なら 15)
+        gyr_scale: float, default GYR_SCALE
+            角速度バイナリを rad/sec に変換するゲイン
+        k_P: float, default 0.0
+            加速度による補正の比例ゲイン (Mahony フィルタの k_P と同じ)。0 は補正なし
+        """
+        self.frac_bits = frac_bits
+        self._gain = int(round(0.5*gyr_scale*dt*(1 << (frac_bits + _GAIN_EXTRA_BITS))))
+        self._kp_gain = int(round(0.5*k_P*dt*(1 << _KP_BITS)))
+        if q0 is None:
+            self._q = FixedQuaternion(frac_bits=frac_bits)
+        elif isinstance(q0, FixedQuaternion):
+            self._q = FixedQuaternion(*q0.getValue(), frac_bits=frac_bits)
+        else:
+            self._q = FixedQuaternion.fromQuaternion(q0, frac_bits)
+
+    def getGain(self)-> int:
+        """積算定数 (GYR_SCALE x dt / 2 の、小数部 frac_bits+16 ビットの整数値)"""
+        return self._gain
+
+    def getQuaternion(self)-> FixedQuaternion:
+        """現在の固定小数点クオータニオン"""
+        return self._q
+
+    def update(self, w, acc=None)-> FixedQuaternion:
+        """1サンプル分の角速度バイナリ値で積算
+
+        Parameters
+        -----
+        w: array like 機体座標系の角速度バイナリ値3要素 (オフセット補正後の整数)
+        acc: array like, default None
+            機体座標系の加速度バイナリ値3要素 (k_P を指定した場合の補正用。単位不問の整数)
+
+        Returns
+        -----
+        FixedQuaternion 更新後のクオータニオン
+        """
+        q = self._q
+        if acc is None or self._kp_gain == 0:
+            acc, kp_gain = (0, 0, 0), 0
+        else:
+            kp_gain = self._kp_gain
+        q._r, q._i, q._j, q._k = _fixedStep(q._r, q._i, q._j, q._k, int(w[0]), int(w[1]), int(w[2]),
+                                            int(acc[0]), int(acc[1]), int(acc[2]),
+                                            self._gain, kp_gain, self.frac_bits)
+        return q
+
+    def updateArray(self, w, acc=None)-> np.ndarray:
+        """時系列の角速度バイナリ値でまとめて積算
+
+        update を各時刻で呼ぶのと、ビット単位で同じ結果になる。
+        w が (N, M, 3) の場合は、M 本の系列 (複数デバイスや条件違い) を NumPy の int64 演算で
+        同時に積算する (初期値は M 本とも共通)。
+
+        Parameters
+        -----
+        w: array like
+            shape=(N, 3) 又は (N, M, 3) の角速度バイナリ値 (オフセット補正後の整数)
+        acc: array like, default None
+            w と同じ shape の加速度バイナリ値 (k_P を指定した場合の補正用)
+
+        Returns
+        -----
+        np.ndarray shape=(N, 4) 又は (N, M, 4) の各時刻のクオータニオン (int64 の整数値)
+            最後の値が、以降の update の初期値になる (M 本の場合は先頭の系列)
+        """
+        w = np.asarray(w, dtype=np.int64)
+        f = self.frac_bits
+        gain = self._gain
+        q = self._q
+        if acc is None or self._kp_gain == 0:
+            acc, kp_gain = np.zeros_like(w), 0
+        else:
+            acc, kp_gain = np.asarray(acc, dtype=np.int64), self._kp_gain
+        if w.ndim == 2:
+            # 1系列は Python の整数で回すほうが速い
+            qr, qi, qj, qk = q._r, q._i, q._j, q._k
+            out = [None]*len(w)
+            for n, (wx, wy, wz, ax, ay, az) in enumerate(np.hstack((w, acc)).tolist()):
+                qr, qi, qj, qk = _fixedStep(qr, qi, qj, qk, wx, wy, wz, ax, ay, az, gain, kp_gain, f)
+                out[n] = (qr, qi, qj, qk)
+            q._r, q._i, q._j, q._k = qr, qi, qj, qk
+            return np.array(out, dtype=np.int64).reshape((len(w), 4))
+        count = w.shape[1]
+        state = [np.full(count, v, dtype=np.int64) for v in q.getValue()]
+        out = np.empty((w.shape[0], count, 4), dtype=np.int64)
+        for n in range(w.shape[0]):
+            state = _fixedStep(*state, w[n, :, 0], w[n, :, 1], w[n, :, 2],
+                               acc[n, :, 0], acc[n, :, 1], acc[n, :, 2], gain, kp_gain, f)
+            out[n] = np.stack(state, axis=-1)
+        if w.shape[0] > 0:
+            q._r, q._i, q._j, q._k = [int(v) for v in out[-1, 0]]
+        return out
+
+def _fixedStep(qr, qi, qj, qk, wx, wy, wz, ax, ay, az, gain:int, kp_gain:int, f:int):
+    """固定小数点の積算1回分 (Python の int でも、NumPy の int64 アレイでも同じ結果)"""
+    # 回転増分の半角 h [小数部 f ビット]
+    hx = _shift(wx*gain, _GAIN_EXTRA_BITS)
+    hy = _shift(wy*gain, _GAIN_EXTRA_BITS)
+    hz = _shift(wz*gain, _GAIN_EXTRA_BITS)
+    if kp_gain != 0:
+        # 加速度の単位ベクトル u (加速度0 の場合は u=0 で補正なし)
+        n = _isqrt(ax*ax + ay*ay + az*az)
+        n = np.maximum(n, 1) if isinstance(n, np.ndarray) else max(n, 1)
+        ux = _divTrunc(ax << f, n)
+        uy = _divTrunc(ay << f, n)
+        uz = _divTrunc(az << f, n)
+        # 推定した重力方向 v (基準座標系の z軸を機体座標系で表したもの)
+        vx = _shift(2*(qi*qk - qr*qj), f)
+        vy = _shift(2*(qr*qi + qj*qk), f)
+        vz = _shift(qr*qr - qi*qi - qj*qj + qk*qk, f)
+        # 補正量 (k_P dt / 2) x (u x v)
+        hx += _shift(_shift(uy*vz - uz*vy, f)*kp_gain, _KP_BITS)
+        hy += _shift(_shift(uz*vx - ux*vz, f)*kp_gain, _KP_BITS)
+        hz += _shift(_shift(ux*vy - uy*vx, f)*kp_gain, _KP_BITS)
+    # 式(15) q <- q + q * (0, h)
+    rr = qr + _shift(          - hx*qi - hy*qj - hz*qk, f)
+    ii = qi + _shift( hx*qr            + hz*qj - hy*qk, f)
+    jj = qj + _shift( hy*qr - hz*qi            + hx*qk, f)
+    kk = qk + _shift( hz*qr + hy*qi - hx*qj, f)
+    # 単位化 (1/sqrt のニュートン法1回)
+    norm2 = _shift(rr*rr + ii*ii + jj*jj + kk*kk, f)
+    inv = ((3 << f) - norm2) >> 1
+    return (_shift(rr*inv, f), _shift(ii*inv, f), _shift(jj*inv, f), _shift(kk*inv, f))
+
+def fixedFromAcc(acc, frac_bits:int=30)-> FixedQuaternion:
+    """静置時の加速度から、初期姿勢の固定小数点クオータニオンを求める
+
+    加速度ベクトル a を基準座標系の z軸 (上空) に重ねる回転
+    (real_rotation.py の outerProduct, crossAngle による setRotate と同じ姿勢) を、
+    (|a| + a_z, a_y, -a_x, 0) の単位化として整数演算で求める。
+    a が真下 (-z) 向きの場合は x軸周りの 180度回転とする。
+
+    Parameters
+    -----
+    acc: array like 機体座標系の加速度バイナリ値3要素 (整数)
+    frac_bits: int, default 30
+        小数部ビット数
+
+    Returns
+    -----
+    FixedQuaternion 初期姿勢
+    """
+    ax, ay, az = [int(v) for v in acc[:3]]
+    r = _isqrt(ax*ax + ay*ay + az*az) + az
+    i, j = ay, -ax
+    n = _isqrt(r*r + i*i + j*j)
+    if n == 0:
+        return FixedQuaternion(0, 1 << frac_bits, 0, 0, frac_bits=frac_bits)
+    # 整数平方根の切り捨て分 (相対 1/n 程度) の norm のずれを、normalize で除く
+    q = FixedQuaternion(_divTrunc(r << frac_bits, n), _divTrunc(i << frac_bits, n),
+                        _divTrunc(j << frac_bits, n), 0, frac_bits=frac_bits)
+    return q.normalize()
+
+def streamAttitude(imu, interval:float=0.01, decimation:int=10, k_P:float=0.0)-> np.ndarray:
+    """imu_base の姿勢ストリーミング ("q" / "Q" コマンド) と同じ Q15 クオータニオン系列を求める
+
+    先頭サンプルを静置状態とし、その加速度から初期姿勢 (fixedFromAcc) を、角速度をオフセットとする。
+    以降のサンプルで Q30 の積算 (k_P > 0 なら加速度補正付き) を行い、先頭を含めて decimation サンプル毎に、
+    Q30 を丸め付きで 15bit 右シフトし、int16 に飽和させた値を出力する。
+
+    Parameters
+    -----
+    imu: array like shape=(サンプル点数, 6) の 6軸IMUデータ (バイナリ値)
+    interval: float, default 0.01
+        データサンプリング間隔 [sec]
+    decimation: int, default 10
+        出力する間隔 [サンプル]
+    k_P: float, default 0.0
+        加速度による補正の比例ゲイン。0 は補正なし ("q" コマンド)
+
+    Returns
+    -----
+    np.ndarray shape=(ceil(サンプル点数 / decimation), 4) の int16 (Q15 の実数部, 虚数部i, j, k)
+    """
+    imu = np.asarray(imu, dtype=np.int64).reshape((-1, 6))
+    if len(imu) == 0:
+        return np.zeros((0, 4), dtype=np.int16)
+    integrator = FixedIntegrator(interval, fixedFromAcc(imu[0, :3]), frac_bits=30, k_P=k_P)
+    track = np.empty((len(imu), 4), dtype=np.int64)
+    track[0] = integrator.getQuaternion().getValue()
+    track[1:] = integrator.updateArray(imu[1:, 3:] - imu[0, 3:], imu[1:, :3])
+    return np.clip(_shift(track[::decimation], 15), -32768, 32767).astype(np.int16)
+
+def quaternionToQ15(q)-> np.ndarray:
+    """クオータニオンを Q15 の int16 に変換
+
+    Parameters
+    -----
+    q: array like
+        shape=(4,) 又は (N, 4) のクオータニオン (単位クオータニオン)
+
+    Returns
+    -----
+    np.ndarray 同じ shape の int16 (1.0 は 32767 に飽和)
+    """
+    q = np.asarray(q, dtype=np.float64)
+    return np.clip(np.round(q*32768), -32768, 32767).astype(np.int16)
+
+def q15ToQuaternion(q15)-> np.ndarray:
+    """Q15 の int16 をクオータニオンに戻す
+
+    Parameters
+    -----
+    q15: array like shape=(4,) 又は (N, 4) の int16
+
+    Returns
+    -----
+    np.ndarray 同じ shape の float64
+    """
+    return np.asarray(q15, dtype=np.float64)/32768
+
+def _angleError(a: np.ndarray, b: np.ndarray)-> np.ndarray:
+    """2つの単位クオータニオン系列の成す回転角 [rad]"""
+    dot = np.abs(np.sum(a*b, axis=-1))/np.sqrt(np.sum(a*a, axis=-1)*np.sum(b*b, axis=-1))
+    return 2*np.arccos(np.clip(dot, 0.0, 1.0))
+
+def errorReport(imu, interval:float, frac_bits:int=30)-> dict:
+    """float64 版 (cq_quaternion) との誤差を評価
+
+    print_euler.py と同じく、時刻ゼロの角速度をオフセットとして補正し、
+    integralAngleVelocityArray(method="euler") と FixedIntegrator で積算した結果を比べる。
+
+    Parameters
+    -----
+    imu: array like shape=(サンプル点数, 6) の 6軸IMUデータ (バイナリ値)
+    interval: float データサンプリング間隔 [sec]
+    frac_bits: int, default 30
+        小数部ビット数
+
+    Returns
+    -----
+    dict
+        angle_max, angle_rms : 姿勢の差の回転角の最大値、RMS [deg]
+        euler_max : オイラー角 (ロール, ピッチ, ヨー) 毎の差の最大値 [deg]
+        norm_max : 固定小数点クオータニオンの norm と 1 の差の最大値
+        q15_max : float64 版を Q15 で送った場合の回転角の差の最大値 [deg]
+    """
+    imu = np.asarray(imu)
+    w = imu[:, 3:].astype(np.int64) - imu[0, 3:].astype(np.int64)
+    track, euler = integralAngleVelocityArray(w*GYR_SCALE, interval, method="euler")
+    ref = np.asarray(track)
+    fixed = FixedIntegrator(interval, frac_bits=frac_bits).updateArray(w)/float(1 << frac_bits)
+    angle = np.degrees(_angleError(fixed, ref))
+    euler_fixed = QuaternionArray(fixed).getEuler()
+    diff = np.angle(np.exp(1j*(euler_fixed - euler)))
+    return {'angle_max': float(angle.max()),
+            'angle_rms': float(np.sqrt(np.mean(angle**2))),
+            'euler_max': np.degrees(np.abs(diff).max(axis=0)),
+            'norm_max': float(np.abs(np.sqrt(np.sum(fixed*fixed, axis=1)) - 1).max()),
+            'q15_max': float(np.degrees(_angleError(q15ToQuaternion(quaternionToQ15(ref)), ref)).max())}
+
+
+if __name__ == '__main__':
+    imu = np.load("sampling.npy")[:, :6]
+    for frac_bits in (30, 15):
+        report = errorReport(imu, 0.01, frac_bits)
+        print("Q{} : angle error max {:.3e} deg, rms {:.3e} deg, norm error max {:.3e}".format(
+            frac_bits, report['angle_max'], report['angle_rms'], report['norm_max']))
+        print("      euler error max roll {:.3e}, pitch {:.3e}, yaw {:.3e} deg".format(*report['euler_max']))
+    print("Q15 transfer of float64 attitude : angle error max {:.3e} deg".format(report['q15_max']))
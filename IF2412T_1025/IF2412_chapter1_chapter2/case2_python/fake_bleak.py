@@ -0,0 +1,295 @@
+""" bleak ライブラリの模擬バックエンド(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+BleUartClient から bleak の代わりに使う、模擬 BLE バックエンドです。
+実機 M5Stack ATOM-S3 (imu_base) の代わりに、保存済みの 6軸IMUデータ (.npy) を
+notify データとして送り返します。実機が無くても、受信側のプログラムを試験できます。
+
+imu_base と同じコマンドに応答します。
+  b : 以降、interval [sec] 間隔で 1サンプル(12byte) ずつ連続送信
+  e : 連続送信を停止し、終端データ(12byte 全て0) を送信
+  s : 1サンプルだけ送信
+  t : b と同様だが、シーケンス番号とタイムスタンプ付き(18byte) で送信
+  p : b と同様だが、MTU に収まる K サンプルずつまとめて(4+12K byte) 送信
+  f : p と同様 (センサ FIFO 読み出し)。続く1byte は分周値だが、送信間隔は interval のまま
+  q : 姿勢を積算し、D サンプル毎に Q15 クオータニオン(10byte) を送信 (続く1byte が D。無ければ 10)
+  Q : q と同様だが、加速度で補正する
+      (積算は cq_quaternion_fixed.streamAttitude で、imu_base と同じ整数演算)
+ファイルの最後まで送信すると、ボタン長押しと同様に終端データを送って停止します。
+
+============
+使用例
+============
+from BleUart import BleUartClient
+from fake_bleak import FakeBleakBackend
+
+backend = FakeBleakBackend()
+backend.add_device("IMU_BASE", "00:00:00:00:00:01", "sampling.npy")
+client = BleUartClient("IMU_BASE", backend=backend)
+# 以降は実機と同様に connect, write, get_queue/get_samples が使える
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import asyncio
+import inspect
+import struct
+import numpy as np
+from imu_packet import packed_samples
+from cq_quaternion_fixed import streamAttitude
+
+# 終端データ 12byte 全て0
+_END_DATA = b'\x00'*12
+# 姿勢ストリーミングの既定の間引き数と、"Q" コマンドの加速度補正ゲイン (imu_base と同じ)
+_ATTITUDE_DECIMATION = 10
+_ATTITUDE_KP = 1.0
+# 姿勢積算のサンプリング周期 [sec] (imu_base の ATT_DT と同じ。再生速度 rate とは無関係)
+_ATTITUDE_DT = 0.01
+
+class FakeBLEDevice:
+    """模擬 BLE デバイス (bleak.backends.device.BLEDevice 相当)"""
+    def __init__(self, name: str, address: str, data, interval: float=0.01, mtu: int=247):
+        self.name = name
+        self.address = address
+        self.interval = interval
+        self.mtu = mtu
+        if isinstance(data, str):
+            data = np.load(data, mmap_mode='r')
+        self._data = np.asarray(data, dtype=np.int16).reshape((-1, 6))
+
+    def get_data(self)-> np.ndarray:
+        """送信する 6軸IMUデータ shape=(サンプル点数, 6) の int16 アレイ"""
+        return self._data
+
+    def __repr__(self):
+        return "FakeBLEDevice({}, {})".format(self.address, self.name)
+
+class _FakeCharacteristic:
+    """模擬 GATT キャラクタリスティック"""
+    def __init__(self, uuid: str):
+        self.uuid = uuid
+
+class _FakeService:
+    """模擬 GATT サービス"""
+    def get_characteristic(self, uuid: str)-> _FakeCharacteristic:
+        return _FakeCharacteristic(uuid)
+
+class _FakeServices:
+    """模擬 GATT サービス群"""
+    def get_service(self, uuid: str)-> _FakeService:
+        return _FakeService()
+
+class FakeBleakClient:
+    """模擬 BleakClient
+
+    接続した FakeBLEDevice のデータを、コマンドに応じて notify で送信する。
+    """
+    def __init__(self, backend: 'FakeBleakBackend', device):
+        if isinstance(device, str):
+            device = backend.get_device(device)
+        self._device = device
+        self._callback = None
+        self._char = _FakeCharacteristic("")
+        self._stream_task = None
+        self._point = 0
+        self._pack = []         # packed 形式で送信待ちのサンプル
+        self._pack_seq = 0      # packed 形式で、次に送るサンプルのシーケンス番号
+        self.is_connected = False
+        self.mtu_size = device.mtu if device is not None else 23
+        self.services = _FakeServices()
+
+    async def connect(self)-> bool:
+        await asyncio.sleep(0)
+        self.is_connected = self._device is not None
+        return self.is_connected
+
+    async def disconnect(self)-> bool:
+        await self._stop_stream()
+        self.is_connected = False
+        return True
+
+    async def start_notify(self, uuid: str, callback):
+        self._char = _FakeCharacteristic(uuid)
+        self._callback = callback
+
+    async def stop_notify(self, uuid: str):
+        self._callback = None
+
+    async def write_gatt_char(self, char, data, response: bool=False):
+        """コマンド受信 (imu_base と同じ1文字コマンド)"""
+        data = bytes(data)
+        pos = 0
+        while pos < len(data):
+            command = data[pos]
+            pos += 1
+            if command in b'qQ':
+                # 続く1byte は間引き数
+                decimation = data[pos] if pos < len(data) else 0
+                pos += 1
+                if self._stream_task is None:
+                    self._stream_task = asyncio.ensure_future(
+                        self._stream(chr(command), decimation or _ATTITUDE_DECIMATION))
+            elif command == ord('f'):
+                # 続く1byte は分周値 (模擬デバイスでは interval がサンプリング間隔なので使わない)
+                pos += 1
+                if self._stream_task is None:
+                    self._stream_task = asyncio.ensure_future(self._stream('f'))
+            elif command in b'btp':
+                if self._stream_task is None:
+                    self._stream_task = asyncio.ensure_future(self._stream(chr(command)))
+            elif command == ord('e'):
+                if self._stream_task is not None:
+                    await self._stop_stream()
+                    await self._flush_pack()
+                    await self._notify(_END_DATA)
+            elif command == ord('s'):
+                if self._stream_task is None:
+                    await self._notify(self._next_sample())
+
+    def _next_sample(self)-> bytes:
+        """次の1サンプル 12byte (データ末尾では先頭に戻る)"""
+        data = self._device.get_data()
+        sample = data[self._point % len(data)].tobytes()
+        self._point += 1
+        return sample
+
+    async def _notify(self, data: bytes):
+        if self._callback is None:
+            return
+        ret = self._callback(self._char, bytearray(data))
+        if inspect.isawaitable(ret):
+            await ret
+
+    async def _flush_pack(self):
+        """packed 形式で送信待ちのサンプルを、ヘッダを付けてまとめて送信"""
+        if len(self._pack) == 0:
+            return
+        header = struct.pack('<HBB', self._pack_seq, len(self._pack), 0)
+        self._pack_seq = (self._pack_seq + len(self._pack)) & 0xFFFF
+        pack, self._pack = self._pack, []
+        await self._notify(header + b''.join(pack))
+
+    async def _stream(self, command: str='b', decimation: int=_ATTITUDE_DECIMATION):
+        """interval 間隔でデータ送信。最後まで送ると終端データを送って停止
+
+        command='t' の場合は、シーケンス番号(0始まり) とタイムスタンプ [usec] を付ける。
+        command='p', 'f' の場合は、MTU に収まる K サンプル毎にまとめて送る。
+        command='q', 'Q' の場合は、decimation サンプル毎に姿勢を送る。
+        """
+        loop = asyncio.get_running_loop()
+        data = self._device.get_data()
+        interval = self._device.interval
+        start = loop.time()
+        first = self._point
+        stamped = command == 't'
+        packed = command in ('p', 'f')
+        limit = packed_samples(self.mtu_size)
+        self._pack = []
+        self._pack_seq = 0
+        attitude = None
+        if command in ('q', 'Q'):
+            attitude = streamAttitude(data[first:], _ATTITUDE_DT, decimation, _ATTITUDE_KP if command == 'Q' else 0.0)
+        for n in range(first, len(data)):
+            # 送信時刻は開始時刻基準で決め、待ち時間の誤差を蓄積させない
+            delay = start + (n - first) * interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif n % 64 == 0:
+                await asyncio.sleep(0)
+            if stamped:
+                seq = (n - first) & 0xFFFF
+                tick = int(round((n - first) * interval * 1e6)) & 0xFFFFFFFF
+                await self._notify(data[n].tobytes() + struct.pack('<HI', seq, tick))
+            elif packed:
+                self._pack.append(data[n].tobytes())
+                if len(self._pack) >= limit:
+                    await self._flush_pack()
+            elif attitude is not None:
+                if (n - first) % decimation == 0:
+                    seq = (n - first) // decimation
+                    await self._notify(attitude[seq].tobytes() + struct.pack('<H', seq & 0xFFFF))
+            else:
+                await self._notify(data[n].tobytes())
+        self._point = len(data)
+        self._stream_task = None
+        await self._flush_pack()
+        await self._notify(_END_DATA)
+
+    async def _stop_stream(self):
+        if self._stream_task is not None:
+            task = self._stream_task
+            self._stream_task = None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+class _FakeBleakScanner:
+    """模擬 BleakScanner"""
+    def __init__(self, backend: 'FakeBleakBackend'):
+        self._backend = backend
+
+    async def find_device_by_name(self, name: str, timeout: float=10.0):
+        await asyncio.sleep(0)
+        for device in self._backend.get_devices():
+            if device.name == name:
+                return device
+        return None
+
+    async def discover(self, timeout: float=5.0, **kwargs)-> list:
+        await asyncio.sleep(0)
+        return list(self._backend.get_devices())
+
+class FakeBleakBackend:
+    """bleak の模擬バックエンド
+
+    BleUartClient の backend 引数に渡す。
+    BleakClient, BleakScanner 属性は bleak ライブラリと同じ使い方ができる。
+    """
+    def __init__(self):
+        self._devices = {}
+        self.BleakScanner = _FakeBleakScanner(self)
+
+    def add_device(self, name: str, address: str, data, interval: float=0.01, mtu: int=247)-> FakeBLEDevice:
+        """模擬デバイス追加
+
+        Parameters
+        -----
+        name: str
+            BLEデバイス名
+        address: str
+            BLEアドレス
+        data: str or array like
+            送信する 6軸IMUデータ。.npy ファイル名、又は shape=(サンプル点数, 6) のアレイ
+        interval: float, default 0.01
+            連続送信の間隔 [sec]
+        mtu: int, default 247
+            接続の ATT MTU [byte]。"p" コマンドで 1回にまとめるサンプル数を決める
+
+        Returns
+        -----
+        FakeBLEDevice 追加したデバイス
+        """
+        device = FakeBLEDevice(name, address, data, interval, mtu)
+        self._devices[address] = device
+        return device
+
+    def get_device(self, address: str):
+        """BLEアドレスからデバイス取得 (無ければ None)"""
+        return self._devices.get(address)
+
+    def get_devices(self)-> list:
+        """全デバイスのリスト"""
+        return list(self._devices.values())
+
+    def BleakClient(self, device)-> FakeBleakClient:
+        """模擬 BleakClient 生成 (引数は BLEアドレス, 又は FakeBLEDevice)"""
+        return FakeBleakClient(self, device)
@@ -0,0 +1,186 @@
+""" 処理段階毎の遅れ(レイテンシ)測定ライブラリ(python版)
+
+Interface 2024年12月号付録
+
+============
+概要
+============
+BLE の notify でサンプルを受信した時刻を起点に、復号、姿勢計算、描画スレッドへの受け渡し、
+描画などの各段階に到達した時刻までの遅れをサンプル毎に記録し、パーセンタイルとヒストグラムを求めます。
+各段階の遅れは受信時刻からの累計なので、隣り合う段階の差がその段階で掛かった時間になります。
+
+LatencyRecorder
+    段階毎に遅れを事前確保したアレイに記録する (一杯になると古い記録から上書き)。
+    1つの段階には、1つのスレッドからだけ記録すること (段階が違えば別スレッドでも良い)。
+
+============
+使用例
+============
+from latency import LatencyRecorder
+
+recorder = LatencyRecorder(("receive", "update", "output", "draw"), target=0.02)
+# BleUartClient.get_samples(with_time=True) の受信時刻 (time.monotonic()) を起点に記録
+imu, stamps = await client.get_samples(with_time=True)
+recorder.add("receive", stamps)
+...
+recorder.add("update", stamps)
+print(recorder.report())
+recorder.save("latency.json")
+
+============
+免責
+============
+(1)プログラムやデータの使用により，使用者に損失が生じたとしても，著作権者とＣＱ出版(株)は，その責任を負いません．
+(2)プログラムやデータにバグや欠陥があったとしても，著作権者とＣＱ出版(株)は，修正や改良の義務を負いません．
+"""
+import json
+import time
+import numpy as np
+
+_PERCENTILES = (50, 90, 99, 99.9)
+
+class LatencyRecorder:
+    """受信時刻から各処理段階までの遅れの記録
+
+    提供メソッド
+    -----
+    add(stage, origin, now=None)
+        受信時刻 origin のサンプルが、段階 stage に到達したことを記録
+    summary()
+        段階毎の遅れの統計 (サンプル数、平均、最大、パーセンタイル、目標内の割合)
+    histogram(stage)
+        段階毎の遅れのヒストグラム
+    report()
+        統計の表示用文字列
+    save(path)
+        統計とヒストグラムを JSON ファイルに保存
+    """
+    def __init__(self, stages: tuple, target: float=0.02, capacity: int=1<<18,
+                 bin_width: float=0.001, max_latency: float=0.1):
+        """コンストラクタ
+
+        Parameters
+        -----
+        stages: tuple
+            処理段階の名前の並び (処理順)
+        target: float, default 0.02
+            目標とする遅れ [sec]。統計に、この遅れ以内のサンプルの割合を含める
+        capacity: int, default 1<<18
+            段階毎に記録するサンプル数の上限。超えた場合は古い記録から上書き
+        bin_width: float, default 0.001
+            ヒストグラムのビン幅 [sec]
+        max_latency: float, default 0.1
+            ヒストグラムの範囲 [sec]。これ以上の遅れは最後のビンに数える
+        """
+        self._stages = tuple(stages)
+        self._target = target
+        self._capacity = capacity
+        self._bin_width = bin_width
+        self._max_latency = max_latency
+        self._data = {stage: np.empty(capacity) for stage in self._stages}
+        self._count = {stage: 0 for stage in self._stages}
+
+    def add(self, stage: str, origin, now: float=None):
+        """受信時刻 origin のサンプルが、段階 stage に到達したことを記録
+
+        Parameters
+        -----
+        stage: str 処理段階の名前
+        origin: float or np.ndarray
+            サンプルの受信時刻 time.monotonic() [sec]。複数サンプル分は shape=(k,) のアレイ
+        now: float, default None
+            到達時刻 [sec]。None の場合は現在の time.monotonic()
+        """
+        if now is None:
+            now = time.monotonic()
+        data = self._data[stage]
+        if np.ndim(origin) == 0:
+            data[self._count[stage] % self._capacity] = now - origin
+            self._count[stage] += 1
+            return
+        k = len(origin)
+        if k > self._capacity:
+            origin = origin[k - self._capacity:]
+            self._count[stage] += k - self._capacity
+            k = self._capacity
+        pos = self._count[stage] % self._capacity
+        first = min(k, self._capacity - pos)
+        # 事前確保したアレイに直接書き込む (末尾で折り返す分は先頭へ)
+        np.subtract(now, origin[:first], out=data[pos:pos+first])
+        if first < k:
+            np.subtract(now, origin[first:], out=data[:k-first])
+        self._count[stage] += k
+
+    def _latencies(self, stage: str)-> np.ndarray:
+        """記録済みの遅れ [sec] (上書きされていない分)"""
+        return self._data[stage][:min(self._count[stage], self._capacity)]
+
+    def summary(self)-> dict:
+        """段階毎の遅れの統計
+
+        Returns
+        -----
+        dict
+            段階名をキーとし、次の値を持つ dict (時間は [msec])
+            count: 到達したサンプル数 (上書きした分を含む)
+            mean, max, p50, p90, p99, p99.9: 平均、最大、パーセンタイル
+            within_target: 遅れが target 以内のサンプルの割合 (0～1)
+            記録の無い段階は count だけ
+        """
+        result = {}
+        for stage in self._stages:
+            latency = self._latencies(stage)
+            result[stage] = {'count': self._count[stage]}
+            if len(latency) == 0:
+                continue
+            result[stage]['mean'] = float(latency.mean())*1000
+            result[stage]['max'] = float(latency.max())*1000
+            for p, value in zip(_PERCENTILES, np.percentile(latency, _PERCENTILES)):
+                result[stage]['p{:g}'.format(p)] = float(value)*1000
+            result[stage]['within_target'] = float(np.count_nonzero(latency <= self._target))/len(latency)
+        return result
+
+    def histogram(self, stage: str)-> tuple:
+        """段階毎の遅れのヒストグラム
+
+        Parameters
+        -----
+        stage: str 処理段階の名前
+
+        Returns
+        -----
+        (np.ndarray, np.ndarray)
+            第一要素は各ビンのサンプル数。最後のビンは max_latency 以上の遅れの数
+            第二要素はビンの下端 [sec]
+        """
+        edges = np.arange(0.0, self._max_latency, self._bin_width)
+        index = np.clip(np.floor(self._latencies(stage)/self._bin_width).astype(np.int64), 0, len(edges) - 1)
+        return (np.bincount(index, minlength=len(edges)), edges)
+
+    def report(self)-> str:
+        """統計の表示用文字列 (1段階1行、時間は [msec])"""
+        lines = ["latency from notify [ms] (target {:g} ms)".format(self._target*1000)]
+        for stage, stats in self.summary().items():
+            if 'mean' not in stats:
+                lines.append("{:<10s} count {:8d}".format(stage, stats['count']))
+                continue
+            lines.append("{:<10s} count {:8d}  mean {:7.2f}  ".format(stage, stats['count'], stats['mean'])
+                         + "  ".join("p{:g} {:7.2f}".format(p, stats['p{:g}'.format(p)]) for p in _PERCENTILES)
+                         + "  max {:7.2f}  within {:6.1%}".format(stats['max'], stats['within_target']))
+        return "\n".join(lines)
+
+    def save(self, path: str):
+        """統計とヒストグラムを JSON ファイルに保存
+
+        Parameters
+        -----
+        path: str 保存するファイル名
+        """
+        _, edges = self.histogram(self._stages[0])
+        report = {'target_ms': self._target*1000,
+                  'summary': self.summary(),
+                  'histogram': {'bin_ms': self._bin_width*1000,
+                                'edges_ms': (edges*1000).tolist(),
+                                'counts': {stage: self.histogram(stage)[0].tolist() for stage in self._stages}}}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
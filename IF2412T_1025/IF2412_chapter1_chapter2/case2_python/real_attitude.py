@@ -0,0 +1,65 @@
+import asyncio
+import threading
+from BleUart import BleUartClient
+# 最新の姿勢だけを描画スレッドに渡し、グラフの線を更新して表示する
+from attitude_view import LatestValue, AttitudeView
+# 本誌提供のクオータニオンライブラリ(cq_quaternion.py)
+from cq_quaternion import *
+
+
+""" マイコン上で積算した姿勢角をリアルタイムに表示 (姿勢ストリーミング版)
+
+プログラム実行すると、グラフ画面が現れ、リアルタイムに機体の姿勢を表示し続ける。
+終了させるには、M5Stack ATOM-S3 のディスプレイ部(のボタン) を長押しする。
+
+real_rotation.py, real_madgwick.py は 6軸IMUデータを受信して PC で姿勢を計算するが、
+本プログラムは imu_base の "q" / "Q" コマンドで、マイコン上で積算した姿勢クオータニオン (Q15) を受信する。
+送信は _DECIMATION サンプル毎の 10byte だけなので、PC の計算負荷と BLE の通信量が小さく、
+複数台の同時接続にも向く。
+起動時は静置状態とし、マイコンが最初のサンプルの加速度から初期姿勢を、角速度からオフセットを求める。
+"""
+
+data_queue = LatestValue()
+_DEVICE_NAME = "IMU_BASE"  # BLEデバイス名
+_ACC_CORRECTION = True     # True : "Q" (加速度補正付き), False : "q" (角速度の積算のみ)
+_DECIMATION = 10           # 姿勢の送信間隔 [サンプル] (10ms x 10 = 100ms 毎)
+
+async def imu_task():
+    client = BleUartClient(_DEVICE_NAME, ring_size=256, packet="quat")
+    await client.connect()
+    if not client.is_connected():
+        data_queue.close()
+        return
+    # 姿勢ストリーミング ON (コマンドの直後の 1byte が間引き数)
+    await client.write((b'Q' if _ACC_CORRECTION else b'q') + bytes([_DECIMATION]))
+    while True:
+        # 溜まっている (k, 4) のクオータニオン。終了時は k=0
+        quat = await client.get_quaternions()
+        if len(quat) == 0:
+            data_queue.close()
+            break   # exit while
+        # 最新の姿勢だけを描画する
+        q = Quaternion(*quat[-1])
+        # 回転行列の各列が、機体座標系の x, y, z 軸を基準座標系に変換したベクトル (x 軸赤, y 軸青, z 軸緑)
+        conv_x, conv_y, conv_z = q.toMatrix().T
+        data_queue.put((conv_x, conv_y, conv_z))
+    print(client.get_ring_status())
+    await client.disconnect()
+
+
+def imu_io():
+    asyncio.run(imu_task())
+
+
+if __name__ == '__main__':
+    print('Press the display button when finished.')
+    # グラフ描画準備
+    view = AttitudeView()
+    # マイコンとの通信は別スレッドで実施
+    # メインスレッドは、別スレッドから最新の姿勢を受けて描画を担う
+    sub_thread = threading.Thread(target=imu_io)
+    sub_thread.start()
+    # 機体座標系 x 軸赤, y 軸青, z 軸緑 を、基準座標系に変換してベクトル表示
+    # 別スレッドが close するまで表示を更新し続ける
+    view.run(data_queue)
+    sub_thread.join()
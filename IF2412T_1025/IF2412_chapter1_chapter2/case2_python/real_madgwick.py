@@ -1,13 +1,17 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from BleUart import BleUartClient
 import asyncio
 import threading
-from queue import Queue
+# 最新の姿勢だけを描画スレッドに渡し、グラフの線を更新して表示する
+from attitude_view import LatestValue, AttitudeView
 # 本誌提供のクオータニオンライブラリ(cq_quaternion.py)
+# Madgwick フィルタも同ライブラリのもの (ahrs ライブラリ https://github.com/Mayitzin/ahrs と同じ式)
 from cq_quaternion import *
-# Madgwick AHRSライブラリ https://github.com/Mayitzin/ahrs/tree/master
-import ahrs
+# 加速度センサの校正値 (acc_calibration/sample_one.py で BLEアドレス毎に保存したもの)
+from calibration import AccCalibration, CalibrationStore
+# 角速度バイアス推定値 (allan.py で長時間の静置データから求めたもの)
+from allan import load_bias
+from imu_packet import FIFO_BASE_RATE
 
 
 """ 回転する機体の姿勢角をリアルタイムに表示 (Madgwickフィルタ版)
@@ -17,18 +21,27 @@ import ahrs
 
 通常版と比べて、ドリフトが抑制されている。但しヨー角方向の回転の抑圧効果が
 無いので、z軸周りの回転には弱い。3軸磁気センサも加えると、さらに改善可能。
+
+_FIFO_DIVIDER に分周値を指定した場合は、センサの FIFO から 1kHz / (分周値+1) で読み出したデータ
+("f" コマンド) をリングバッファで受信し、まとめて受信した分を updateIMUArray で一括更新する。
 """
 
-data_queue = Queue()
+data_queue = LatestValue()
 _DEVICE_NAME = "IMU_BASE"  # BLEデバイス名
+_CALIBRATION_FILE = "calibration.json"  # 加速度センサの校正値ファイル (無ければ無校正)
+_BIAS_FILE = "gyro_bias.json"  # 角速度バイアス推定値ファイル (無ければ初回の角速度をオフセットとする)
+_FIFO_DIVIDER = None       # 0～255: センサ FIFO から 1kHz/(値+1) で受信 ("f" コマンド)。None は使わない
 
 async def imu_task():
     client = BleUartClient(_DEVICE_NAME)
     receive_queue = client.get_queue()
     await client.connect()
     if not client.is_connected():
-        data_queue.put(None)
+        data_queue.close()
         return
+    # 接続したデバイスの加速度センサ校正値 (未校正のデバイスは無変換)
+    calib = CalibrationStore(_CALIBRATION_FILE).load(client.get_address(), AccCalibration())
+    gyr_bias = load_bias(_BIAS_FILE)
     # IMUデータ連続送信 ON
     await client.write(b'b')
     point = -1
@@ -39,69 +52,94 @@ async def imu_task():
         raw_data = await receive_queue.get()
         # 終了時のデータは、加速度センサ値6byte は、b'\x00'*6
         if raw_data[:6] == b'\x00'*6:
-            data_queue.put(None)
+            data_queue.close()
             break   # exit while
         # (acc_x, acc_y, acc_z, gyr_x, gyr_y, gyr_z)
         imu_data  = np.frombuffer(raw_data, dtype=np.int16).astype('float64')
         # 初回は加速度データから姿勢推定
         if point < 0:
-            acc_data = imu_data[:3]
+            acc_data = calib.apply(imu_data[:3])
             # 初回は静置状態とし、加速度ベクトルから姿勢推定する
             # 基準座標は z軸が重力逆方向(上空)向きになる、人間視点の座標系
             rot_vec = outerProduct(acc_data, (0,0,1))  # 外積方向に
             rot_theta = crossAngle(acc_data, (0,0,1))  # ベクトル成す角
-            q.setRotate(rot_vec, rot_theta)  # 回転させたクオータニオン
-            q_arr = np.array(q.getValue())  # 時刻ゼロの回転クオータニオン
+            q.setRotate(rot_vec, rot_theta)  # 時刻ゼロの回転クオータニオン
             # Madgwick 更新周波数:100Hz, beta:0.1
             # beta = 角速度を重視(小) ---> 加速度を重視(大)  0～1
-            madgwick = ahrs.filters.Madgwick(None,None,None,frequency=100,beta=0.1)
-            # 静止時の初期角速度をオフセット補正
-            init_gyr = imu_data[3:]
+            madgwick = Madgwick(q, frequency=100, beta=0.1)
+            # 静止時の初期角速度をオフセット補正 (バイアス推定値があればそれを使う)
+            init_gyr = imu_data[3:] if gyr_bias is None else gyr_bias
             point += 1
         # 加速度、角速度からクオータニオン更新
         else:
             gyr_data = (imu_data[3:] - init_gyr)*gyr_scale
-            acc_data = imu_data[:3]     # 加速度は単位不問
-            q_arr = madgwick.updateIMU(q_arr, gyr_data, acc_data)
+            acc_data = calib.apply(imu_data[:3])     # 加速度は単位不問 (校正で軸間の干渉、オフセットを除く)
+            # 戻り値は madgwick 内部のクオータニオン (毎回同じオブジェクトが更新される)
+            q = madgwick.updateIMU(gyr_data, acc_data)
             point += 1
-        # 0.25sec 毎に描画更新 メインスレッドへ、キュー送信
+        # 0.25sec 毎に描画更新 メインスレッドへ、最新値として送信 (未描画の古い値は捨てられる)
         if point % 25 == 0:
-            now_q = Quaternion(*q_arr)
-            conv_x = now_q.rotation((1,0,0))  # 機体座標系のx軸を、基準座標系に変換
-            conv_y = now_q.rotation((0,1,0))  # 機体座標系のx軸を、基準座標系に変換
-            conv_z = now_q.rotation((0,0,1))  # 機体座標系のz軸を、基準座標系に変換
+            # 回転行列の各列が、機体座標系の x, y, z 軸を基準座標系に変換したベクトル (x 軸赤, y 軸青, z 軸緑)
+            conv_x, conv_y, conv_z = q.toMatrix().T
             data_queue.put((conv_x, conv_y, conv_z))
             point = 0
     await client.disconnect()
 
+async def imu_fifo_task():
+    """センサ FIFO 読み出し ("f" コマンド) の高レートデータで姿勢計算するタスク"""
+    client = BleUartClient(_DEVICE_NAME, ring_size=4096, packet="packed")
+    await client.connect()
+    if not client.is_connected():
+        data_queue.close()
+        return
+    calib = CalibrationStore(_CALIBRATION_FILE).load(client.get_address(), AccCalibration())
+    gyr_bias = load_bias(_BIAS_FILE)
+    # サンプリング周波数は、センサ内部の 1kHz の分周で決まる
+    rate = FIFO_BASE_RATE/(_FIFO_DIVIDER + 1)
+    await client.write(b'f' + bytes([_FIFO_DIVIDER]))
+    gyr_scale = 500/65536/180*math.pi
+    madgwick = None
+    while True:
+        # 溜まっている (k, 6) をまとめて取り出す。終了時は k=0
+        imu = await client.get_samples()
+        if len(imu) == 0:
+            data_queue.close()
+            break   # exit while
+        imu = imu.astype('float64')
+        if madgwick is None:
+            # 初回は静置状態とし、加速度ベクトルから姿勢推定する
+            acc_data = calib.apply(imu[0, :3])
+            q = Quaternion()
+            q.setRotate(outerProduct(acc_data, (0,0,1)), crossAngle(acc_data, (0,0,1)))
+            madgwick = Madgwick(q, frequency=rate, beta=0.1)
+            init_gyr = imu[0, 3:] if gyr_bias is None else gyr_bias
+            imu = imu[1:]
+            if len(imu) == 0:
+                continue
+        # まとめて受信した分を一括で更新 (updateIMU を順に呼ぶのと同じ)
+        madgwick.updateIMUArray((imu[:, 3:] - init_gyr)*gyr_scale, calib.apply(imu[:, :3]))
+        q = madgwick.getQuaternion()
+        # 受信毎に最新値として送信 (未描画の古い値は捨てられる)
+        # 回転行列の各列が、機体座標系の x, y, z 軸を基準座標系に変換したベクトル
+        data_queue.put(tuple(q.toMatrix().T))
+    print(client.get_ring_status())
+    await client.disconnect()
+
 
 def imu_io():
-    asyncio.run(imu_task())
+    asyncio.run(imu_task() if _FIFO_DIVIDER is None else imu_fifo_task())
 
 
 if __name__ == '__main__':
     print('Press the display button when finished.')
     # グラフ描画準備
-    fig = plt.figure()
-    ax = fig.add_subplot(111, projection='3d')
-    ax.grid()
-    o = np.array([0,0,0])   # 原点
+    view = AttitudeView()
     # マイコンとの通信と姿勢計算は別スレッドで実施
-    # メインスレッドは、別スレッドからのキューデータを受けて描画を担う
+    # メインスレッドは、別スレッドから最新の姿勢を受けて描画を担う
+    # 描画が間に合わない場合は古い姿勢を捨て、常に最新の姿勢を表示する
     sub_thread = threading.Thread(target=imu_io)
     sub_thread.start()
-    while True:
-        # サブスレッドからキューでデータ受信
-        xyz_axis = data_queue.get()
-        ax.clear()
-        if xyz_axis is None:
-            break   # exit while
-        # 機体座標系 x 軸を、基準座標系に変換してベクトル表示
-        ax.quiver(*o, *xyz_axis[0], color='r')  # x軸赤
-        # 機体座標系 y 軸を、基準座標系に変換してベクトル表示
-        ax.quiver(*o, *xyz_axis[1], color='b')  # y軸青
-        # 機体座標系 z 軸を、基準座標系に変換してベクトル表示
-        ax.quiver(*o, *xyz_axis[2], color='g')  # z軸緑
-        ax.set_xlim(-1,1);ax.set_ylim(-1,1);ax.set_zlim(-1,1)
-        plt.pause(.1)
+    # 機体座標系 x 軸赤, y 軸青, z 軸緑 を、基準座標系に変換してベクトル表示
+    # 別スレッドが close するまで表示を更新し続ける
+    view.run(data_queue)
     sub_thread.join()
@@ -1,21 +1,53 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from BleUart import BleUartClient
 import asyncio
 import threading
-from queue import Queue
+# 最新の姿勢だけを描画スレッドに渡し、グラフの線を更新して表示する
+from attitude_view import LatestValue, AttitudeView
 # 本誌提供のクオータニオンライブラリ(cq_quaternion.py)
 from cq_quaternion import *
+# 加速度センサの校正値 (acc_calibration/sample_one.py で BLEアドレス毎に保存したもの)
+from calibration import AccCalibration, CalibrationStore
+# 角速度バイアス推定値 (allan.py で長時間の静置データから求めたもの)
+from allan import load_bias
+from imu_packet import decode_stamped, StampTracker, FIFO_BASE_RATE
+# 受信から描画までの処理段階毎の遅れを測る
+from latency import LatencyRecorder
 
 """ 回転する機体の姿勢角をリアルタイムに表示
 
 プログラム実行すると、グラフ画面が現れ、リアルタイムに機体の姿勢を表示し続ける。
 終了させるには、M5Stack ATOM-S3 のディスプレイ部(のボタン) を長押しする。
+
+_STAMPED = True の場合は、シーケンス番号とタイムスタンプ付きのデータ("t" コマンド) を受信し、
+タイムスタンプから得た実際のサンプリング間隔で積算する。欠落したサンプル数は終了時に表示する。
+
+_LOW_LATENCY = True の場合は、リングバッファで受信し、notify 毎にまとめて受信した分を一括で積算して、
+毎回最新の姿勢を描画スレッドへ渡す (低遅延モード)。asyncio のループ内でサンプル毎の np.ndarray を作らない。
+_FIFO_DIVIDER に分周値を指定した場合は、センサの FIFO から 1kHz / (分周値+1) で読み出したデータ
+("f" コマンド) を、低遅延モードと同じ処理で受信する。
+これらのモードでは、notify の受信時刻からの各段階 (受信、積算、受け渡し、描画) までの遅れを
+サンプル毎に記録し、終了時にパーセンタイルを表示して、ヒストグラムと共に _LATENCY_FILE に保存する。
 """
 
-data_queue = Queue()
+data_queue = LatestValue()
 _DEVICE_NAME = "IMU_BASE"  # BLEデバイス名
 _INTERVAL = 0.01           # データサンプリング間隔 10msec
+_CALIBRATION_FILE = "calibration.json"  # 加速度センサの校正値ファイル (無ければ無校正)
+_BIAS_FILE = "gyro_bias.json"  # 角速度バイアス推定値ファイル (無ければ初回の角速度をオフセットとする)
+_STAMPED = False           # True: タイムスタンプ付きデータで、実際のサンプリング間隔を使う
+_FIFO_DIVIDER = None       # 0～255: センサ FIFO から 1kHz/(値+1) で受信 ("f" コマンド)。None は使わない
+_LOW_LATENCY = False       # True: リングバッファで受信し、notify 毎に一括積算する低遅延モード
+_RING_SIZE = 4096          # 低遅延モード、FIFO 読み出しのリングバッファの大きさ [サンプル]
+_LATENCY_FILE = "latency.json"  # 低遅延モード、FIFO 読み出しで各段階の遅れを保存するファイル。None は測定しない
+_TARGET_LATENCY = 0.02     # 受信から描画までの目標とする遅れ [sec]
+
+def _ring_mode()-> bool:
+    """リングバッファで受信し、notify 毎に一括積算するか (低遅延モード又は FIFO 読み出し)"""
+    return _LOW_LATENCY or _FIFO_DIVIDER is not None
+
+latency = LatencyRecorder(("receive", "update", "output", "draw"), target=_TARGET_LATENCY) \
+    if _ring_mode() and _LATENCY_FILE else None
 
 async def imu_task():
     """6軸慣性センサのデータサンプリングタスク"""
@@ -23,10 +55,15 @@ async def imu_task():
     receive_queue = client.get_queue()
     await client.connect()
     if not client.is_connected():
-        data_queue.put(None)
+        data_queue.close()
         return
+    # 接続したデバイスの加速度センサ校正値 (未校正のデバイスは無変換)
+    calib = CalibrationStore(_CALIBRATION_FILE).load(client.get_address(), AccCalibration())
+    gyr_bias = load_bias(_BIAS_FILE)
     # IMUデータ連続送信 ON
-    await client.write(b'b')
+    await client.write(b't' if _STAMPED else b'b')
+    # シーケンス番号とタイムスタンプから、サンプル毎の周期時間と欠落数を得る
+    tracker = StampTracker(_INTERVAL)
     point = -1
     q = Quaternion()
     # 角速度バイナリを rad/sec に変換するゲイン (+-250dps full scale)
@@ -38,69 +75,137 @@ async def imu_task():
         # M5Stack ATOM-S3 のディスプレイボタンを押すとIMUデータ送信終了
         # 終了時のデータは、b'\x00'*12が来るので、連続6バイトゼロで判断する。
         if raw_data[:6] == b'\x00'*6:
-            # キューに None 送ると、プログラム終了の通知
-            data_queue.put(None)
+            # close で、プログラム終了の通知
+            data_queue.close()
             break   # exit while
-        # バイナリデータ列は、符号付16bitリトルエンディアン形式なので、int16型に復元
-        imu_data  = np.frombuffer(raw_data, dtype=np.int16).astype('float64')
+        if _STAMPED:
+            # 18byte = IMUデータ12byte + シーケンス番号 + タイムスタンプ
+            imu_raw, seq, tick = decode_stamped(raw_data)
+            dt, missing = tracker.update(seq[0], tick[0])
+            if missing < 0:
+                continue    # 重複サンプルは捨てる
+            imu_data = imu_raw[0].astype('float64')
+        else:
+            # バイナリデータ列は、符号付16bitリトルエンディアン形式なので、int16型に復元
+            imu_data  = np.frombuffer(raw_data, dtype=np.int16).astype('float64')
+            dt = _INTERVAL
         # 初回は静置状態とし、加速度ベクトルから姿勢推定する
         # 基準座標は z軸が重力逆方向(上空)向きになる、人間視点の座標系
         if point < 0:
-            acc_data = imu_data[:3]
+            acc_data = calib.apply(imu_data[:3])
             # 基準座標z軸と重力方向の外積方向を中心軸として
             rot_vec = outerProduct(acc_data, (0,0,1))
             # 基準座標z軸と重力方向の成す角が
             rot_theta = crossAngle(acc_data, (0,0,1))
             # 初回の基準座標からの機体座標への回転クオータニオンになる
             q.setRotate(rot_vec, rot_theta)
-            # 静止時の初期角速度をオフセット値とする
-            init_gyr = imu_data[3:]
+            # 静止時の初期角速度をオフセット値とする (バイアス推定値があればそれを使う)
+            init_gyr = imu_data[3:] if gyr_bias is None else gyr_bias
             point += 1
         # 角速度からクオータニオン更新
         else:
             # 角速度バイナリ出力からオフセット減算し、rad/sec に変換するゲイン積算
             gyr_data = (imu_data[3:] - init_gyr)*gyr_scale
             # 角速度[rad/sec] から、式(15) で回転クオータニオン更新
-            q.integralAngleVelocity(gyr_data, _INTERVAL)
+            # 欠落があった場合は、dt が欠落分を含む間隔になる
+            q.integralAngleVelocity(gyr_data, dt)
             point += 1
-        # 0.25sec 毎に描画更新 メインスレッドへ、キュー送信
+        # 0.25sec 毎に描画更新 メインスレッドへ、最新値として送信 (未描画の古い値は捨てられる)
         if point % 25 == 0:
-            conv_x = q.rotation((1,0,0))  # 機体座標系のx軸を、基準座標系に変換
-            conv_y = q.rotation((0,1,0))  # 機体座標系のy軸を、基準座標系に変換
-            conv_z = q.rotation((0,0,1))  # 機体座標系のz軸を、基準座標系に変換
+            # 回転行列の各列が、機体座標系の x, y, z 軸を基準座標系に変換したベクトル (x 軸赤, y 軸青, z 軸緑)
+            conv_x, conv_y, conv_z = q.toMatrix().T
             data_queue.put((conv_x, conv_y, conv_z))
             point = 0
     await client.disconnect()
+    if _STAMPED:
+        print("missing samples : {}".format(tracker.get_missing()))
+
+async def imu_ring_task():
+    """リングバッファで受信し、notify 毎にまとめて姿勢計算する低遅延タスク ("b", "t", "f" コマンド)"""
+    if _FIFO_DIVIDER is not None:
+        # サンプリング間隔は、センサ内部の 1kHz の分周で決まる
+        packet, command, interval = "packed", b'f' + bytes([_FIFO_DIVIDER]), (_FIFO_DIVIDER + 1)/FIFO_BASE_RATE
+    elif _STAMPED:
+        packet, command, interval = "stamped", b't', _INTERVAL
+    else:
+        packet, command, interval = "raw", b'b', _INTERVAL
+    client = BleUartClient(_DEVICE_NAME, ring_size=_RING_SIZE, packet=packet)
+    await client.connect()
+    if not client.is_connected():
+        data_queue.close()
+        return
+    calib = CalibrationStore(_CALIBRATION_FILE).load(client.get_address(), AccCalibration())
+    gyr_bias = load_bias(_BIAS_FILE)
+    await client.write(command)
+    tracker = StampTracker(_INTERVAL)
+    gyr_scale = 2*250/65536/180*math.pi
+    # 1回に取り出す最大サンプル数 (リングバッファの大きさ) 分の角速度と周期時間を事前確保しておき、
+    # ループ内では受信した分のビューに書き込む
+    gyr_data = np.empty((_RING_SIZE, 3))
+    dt = np.full(_RING_SIZE, interval)
+    q = None
+    while True:
+        # 溜まっているサンプルと各サンプルの受信時刻をまとめて取り出す (リングバッファのビュー)。終了時は k=0
+        samples, stamps = await client.get_samples(with_time=True)
+        if len(samples) == 0:
+            data_queue.close()
+            break   # exit while
+        if latency is not None:
+            latency.add("receive", stamps)
+        if packet == "stamped":
+            imu = samples['imu']
+            # シーケンス番号とタイムスタンプから、サンプル毎の周期時間を得る
+            # 重複サンプルは dt=0 になり、回転増分が (1,0,0,0) で姿勢は変わらない
+            for n, (seq, tick) in enumerate(zip(samples['seq'].tolist(), samples['tick'].tolist())):
+                dt[n], _ = tracker.update(seq, tick)
+        else:
+            imu = samples
+        first = 0
+        if q is None:
+            # 初回は静置状態とし、加速度ベクトルから姿勢推定する
+            acc_data = calib.apply(imu[0, :3].astype('float64'))
+            q = Quaternion()
+            q.setRotate(outerProduct(acc_data, (0,0,1)), crossAngle(acc_data, (0,0,1)))
+            init_gyr = imu[0, 3:].astype('float64') if gyr_bias is None else gyr_bias
+            first = 1
+        k = len(imu) - first
+        if k > 0:
+            # まとめて受信した分を一括で積算 (integralAngleVelocity を順に呼ぶのと同じ1次近似)
+            np.subtract(imu[first:, 3:], init_gyr, out=gyr_data[:k])
+            gyr_data[:k] *= gyr_scale
+            track, _ = integralAngleVelocityArray(gyr_data[:k], dt[first:first+k], q0=q, method="euler")
+            q = Quaternion(*np.asarray(track)[-1])
+        if latency is not None:
+            latency.add("update", stamps)
+        # notify 毎に最新値として送信 (未描画の古い値は捨てられる)。時刻は最新サンプルの受信時刻
+        # 回転行列の各列が、機体座標系の x, y, z 軸を基準座標系に変換したベクトル
+        data_queue.put(tuple(q.toMatrix().T), float(stamps[-1]))
+        if latency is not None:
+            latency.add("output", stamps)
+    print(client.get_ring_status())
+    await client.disconnect()
+    if _STAMPED and _FIFO_DIVIDER is None:
+        print("missing samples : {}".format(tracker.get_missing()))
 
 
 def imu_io():
-    asyncio.run(imu_task())
+    asyncio.run(imu_ring_task() if _ring_mode() else imu_task())
 
 
 if __name__ == '__main__':
     print('Press the display button when finished.')
     # グラフ描画準備
-    fig = plt.figure()
-    ax = fig.add_subplot(111, projection='3d')
-    ax.grid()
-    o = np.array([0,0,0])   # 原点
+    view = AttitudeView()
     # マイコンとの通信と姿勢計算は別スレッドで実施
-    # メインスレッドは、別スレッドからのキューデータを受けて描画を担う
+    # メインスレッドは、別スレッドから最新の姿勢を受けて描画を担う
+    # 描画が間に合わない場合は古い姿勢を捨て、常に最新の姿勢を表示する
     sub_thread = threading.Thread(target=imu_io)
     sub_thread.start()
-    while True:
-        # サブスレッドからキューでデータ受信
-        xyz_axis = data_queue.get()
-        ax.clear()
-        if xyz_axis is None:
-            break   # exit while
-        # 機体座標系 x 軸を、基準座標系に変換してベクトル表示
-        ax.quiver(*o, *xyz_axis[0], color='r')  # x軸赤
-        # 機体座標系 y 軸を、基準座標系に変換してベクトル表示
-        ax.quiver(*o, *xyz_axis[1], color='b')  # y軸青
-        # 機体座標系 z 軸を、基準座標系に変換してベクトル表示
-        ax.quiver(*o, *xyz_axis[2], color='g')  # z軸緑
-        ax.set_xlim(-1,1);ax.set_ylim(-1,1);ax.set_zlim(-1,1)
-        plt.pause(.1)
+    # 機体座標系 x 軸赤, y 軸青, z 軸緑 を、基準座標系に変換してベクトル表示
+    # 別スレッドが close するまで表示を更新し続ける
+    view.run(data_queue, recorder=latency)
     # 別スレッドの終了を待つ
     sub_thread.join()
+    if latency is not None:
+        print(latency.report())
+        latency.save(_LATENCY_FILE)
@@ -0,0 +1,108 @@
+import asyncio
+import time
+import numpy as np
+from sim_uart import SimBleUartClient, synthesize_imu
+# 本誌提供のクオータニオンライブラリ(cq_quaternion.py)
+from cq_quaternion import *
+
+""" real_rotation.py と同じ受信・姿勢計算処理のスループット測定
+
+実機の代わりに SimBleUartClient から IMUデータを受信し、受信から姿勢計算までの
+処理能力 [サンプル/sec] を測る。グラフ描画は行わないので、画面の無い環境でも動く。
+
+"queue" : real_rotation.py と同じく、notify 毎にキューから取り出して Quaternion で逐次積算
+"ring"  : リングバッファ受信モードで溜まったサンプルを integralAngleVelocityArray で一括積算
+
+_RATE = 0 で待ち時間無しに送信すると、受信側の処理能力の上限が得られる。
+_RATE = 100 などの実レートでは、処理が間に合っているか(受信レート = 送信レート) を確認できる。
+"""
+
+_DATA = None               # 再生する .npy ファイル名。None の場合は _DURATION 秒分を合成
+_DURATION = 60.0           # 合成データの長さ [sec]
+_PROFILE = "wobble"        # 合成データの motion profile
+_RATE = 0                  # 送信レート [Hz] 0 以下は最速
+_INTERVAL = 0.01           # 積算に使うデータサンプリング間隔 10msec
+_RING_SIZE = 4096          # "ring" のリングバッファのサンプル数
+
+# 角速度バイナリを rad/sec に変換するゲイン (+-250dps full scale)
+_GYR_SCALE = 2*250/65536/180*math.pi
+
+def _initial_pose(imu_data)-> Quaternion:
+    """静置状態の加速度ベクトルから初期姿勢を得る (real_rotation.py と同じ)"""
+    acc_data = imu_data[:3]
+    q = Quaternion()
+    q.setRotate(outerProduct(acc_data, (0,0,1)), crossAngle(acc_data, (0,0,1)))
+    return q
+
+async def run_queue(client: SimBleUartClient)-> int:
+    """real_rotation.py と同じ逐次処理。処理したサンプル数を返す"""
+    receive_queue = client.get_queue()
+    await client.connect()
+    await client.write(b'b')
+    count = 0
+    point = -1
+    while True:
+        raw_data = await receive_queue.get()
+        if raw_data[:6] == b'\x00'*6:
+            break
+        imu_data = np.frombuffer(raw_data, dtype=np.int16).astype('float64')
+        count += 1
+        if point < 0:
+            q = _initial_pose(imu_data)
+            init_gyr = imu_data[3:]
+            point += 1
+        else:
+            gyr_data = (imu_data[3:] - init_gyr)*_GYR_SCALE
+            q.integralAngleVelocity(gyr_data, _INTERVAL)
+            point += 1
+        if point % 25 == 0:
+            q.toMatrix()
+            point = 0
+    await client.disconnect()
+    return count
+
+async def run_ring(client: SimBleUartClient)-> int:
+    """リングバッファと一括積算による処理。処理したサンプル数を返す"""
+    await client.connect()
+    await client.write(b'b')
+    count = 0
+    q = None
+    while True:
+        imu = await client.get_samples()
+        if len(imu) == 0:
+            break
+        imu = imu.astype('float64')
+        count += len(imu)
+        if q is None:
+            q = _initial_pose(imu[0])
+            init_gyr = imu[0, 3:]
+            imu = imu[1:]
+            if len(imu) == 0:
+                continue
+        track, _ = integralAngleVelocityArray((imu[:, 3:] - init_gyr)*_GYR_SCALE, _INTERVAL, q, method="euler")
+        q = track[-1]
+        q.toMatrix()
+    await client.disconnect()
+    return count
+
+def measure(mode: str)-> dict:
+    """1つの処理方式のスループットを測定"""
+    data = _DATA if _DATA is not None else synthesize_imu(_DURATION, 1.0/_INTERVAL, _PROFILE)
+    ring_size = _RING_SIZE if mode == "ring" else 0
+    client = SimBleUartClient("IMU_BASE", data, rate=_RATE, ring_size=ring_size)
+    start = time.perf_counter()
+    count = asyncio.run(run_queue(client) if mode == "queue" else run_ring(client))
+    elapsed = time.perf_counter() - start
+    result = {'mode': mode, 'samples': count, 'sent': len(client.get_sim_data()),
+              'elapsed': elapsed, 'rate': count/elapsed}
+    if mode == "ring":
+        result['drop'] = client.get_ring_status()['drop']
+    return result
+
+
+if __name__ == '__main__':
+    for mode in ("queue", "ring"):
+        result = measure(mode)
+        print("{mode:>5} : {samples} / {sent} samples, {elapsed:.3f} sec, {rate:.0f} samples/sec".format(**result))
+        if result.get('drop', 0) > 0:
+            print("        dropped samples : {}".format(result['drop']))
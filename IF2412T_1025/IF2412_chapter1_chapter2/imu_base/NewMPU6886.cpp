@@ -61,6 +61,9 @@
 #define MPU6886_FIFO_COUNTH       0x72
 #define MPU6886_FIFO_COUNTL       0x73
 #define MPU6886_FIFO_R_W          0x74
+#define MPU6886_FIFO_SIZE         1024      // FIFO buffer size [byte]
+#define MPU6886_FIFO_RECORD       14        // ACC 6byte + TEMP 2byte + GYR 6byte
+#define MPU6886_FIFO_BURST        9         // Records in one I2C read (within 128byte Wire buffer)
 
 #define MPU6886_CAL_AVG_TIMES     32
 
@@ -575,6 +578,54 @@ void NewMPU6886::stopFifo(void){
     xSemaphoreGive(_semaphore);
 }
 
+/**
+ * @brief FIFOに溜まったサンプルをまとめて取得
+ * @param[out] data (int16_t *) 6軸バイナリ値を取得する配列 (max_samples x 6 要素)
+ *   1サンプル毎に acc_x, acc_y, acc_z, gyr_x, gyr_y, gyr_z の順 (getAccelAdc, getGyroAdc と同じ値)
+ * @param[in] max_samples (uint16_t) 取得する最大サンプル数
+ * @param[out] is_full (bool *) FIFO が一杯だったか (以降のサンプルは FIFO に書かれず失われている)
+ *   不要なら nullptr デフォルト nullptr
+ * @return (uint16_t) 取得したサンプル数
+ * @note startFifo(true, true) で開始していること (1サンプル 14byte)。
+ *   I2C は 1回に MPU6886_FIFO_BURST サンプル分ずつ連続読み出しする。
+ *   途中までのサンプルは読まずに残すので、FIFO のデータ境界はずれない。
+ */
+uint16_t NewMPU6886::getFifoAdc(int16_t* data, uint16_t max_samples, bool* is_full){
+    uint8_t buf[MPU6886_FIFO_BURST * MPU6886_FIFO_RECORD];
+    uint8_t count[2];
+    xSemaphoreTake(_semaphore, portMAX_DELAY);
+    I2C_Read_NBytes(MPU6886_ADDRESS, MPU6886_FIFO_COUNTH, 2, count);
+    uint16_t size = (uint16_t)count[0] << 8 | count[1];
+    if(is_full != nullptr){
+        *is_full = size + MPU6886_FIFO_RECORD > MPU6886_FIFO_SIZE;
+    }
+    uint16_t samples = size / MPU6886_FIFO_RECORD;
+    if(samples > max_samples){
+        samples = max_samples;
+    }
+    for(uint16_t done = 0; done < samples; ){
+        uint16_t burst = samples - done;
+        if(burst > MPU6886_FIFO_BURST){
+            burst = MPU6886_FIFO_BURST;
+        }
+        I2C_Read_NBytes(MPU6886_ADDRESS, MPU6886_FIFO_R_W, burst * MPU6886_FIFO_RECORD, buf);
+        for(uint16_t n = 0; n < burst; ++n){
+            uint8_t *rec = buf + n * MPU6886_FIFO_RECORD;
+            int16_t *out = data + (done + n) * 6;
+            // big endian : ACC x,y,z (0-5), TEMP (6-7), GYR x,y,z (8-13)
+            out[0] = ((int16_t)rec[0] << 8) | rec[1];
+            out[1] = ((int16_t)rec[2] << 8) | rec[3];
+            out[2] = ((int16_t)rec[4] << 8) | rec[5];
+            out[3] = ((int16_t)rec[8] << 8) | rec[9];
+            out[4] = ((int16_t)rec[10] << 8) | rec[11];
+            out[5] = ((int16_t)rec[12] << 8) | rec[13];
+        }
+        done += burst;
+    }
+    xSemaphoreGive(_semaphore);
+    return samples;
+}
+
 /**
  * @brief x軸角速度の補正設定
  * @param[in] offset (int16_t) この値と、センサ生値が加算されて、getGyroData() からセンサ値取得出来るようになる。
@@ -82,6 +82,7 @@ class NewMPU6886{
         uint16_t getFifoSize(void);
         void getFifo(uint8_t *data, uint8_t size=1);
         void stopFifo(void);
+        uint16_t getFifoAdc(int16_t* data, uint16_t max_samples, bool* is_full=nullptr);
 
 
         void setGyroXoffset(int16_t offset);
@@ -25,6 +25,11 @@ LIBRARY MANAGER:
   STATE_IDLE     ... 待機状態
   STATE_ONESHOT  ... 1回だけの IMUデータを即時取得する、取得後自動的に待機状態に移行
   STATE_SAMPLING ... 10ms毎に連続して IMUデータを取得し続ける
+  STATE_STAMPED  ... STATE_SAMPLING と同様だが、シーケンス番号とタイムスタンプを付けて送る
+  STATE_PACKED   ... STATE_SAMPLING と同様だが、複数サンプルを1回の notify にまとめて送る
+  STATE_ATTITUDE ... 10ms毎に IMUデータを取得して姿勢を積算し、間引いてクオータニオンを送る
+  STATE_FIFO     ... センサの FIFO に最大 1kHz でサンプリングさせ、10ms毎にまとめて読み出して
+                     STATE_PACKED と同じ形式で送る
 
 <状態遷移>
   STATE_IDLE -> STATE_ONESHOT    : PCから "s" 受信
@@ -32,6 +37,14 @@ LIBRARY MANAGER:
 
   STATE_IDLE -> STATE_SAMPLING   : PCから "b" 受信、または、M5Stack Atom S3 のディスプレイを 200ms以上押し込んで離す
   STATE_SAMPLING -> STATE_IDLE   : PCから "e" 受信、または、M5Stack Atom S3 のディスプレイを 200ms以上押し込んで離す
+  STATE_IDLE -> STATE_STAMPED    : PCから "t" 受信
+  STATE_STAMPED -> STATE_IDLE    : PCから "e" 受信、または、M5Stack Atom S3 のディスプレイを 200ms以上押し込んで離す
+  STATE_IDLE -> STATE_PACKED     : PCから "p" 受信
+  STATE_PACKED -> STATE_IDLE     : PCから "e" 受信、または、M5Stack Atom S3 のディスプレイを 200ms以上押し込んで離す
+  STATE_IDLE -> STATE_ATTITUDE   : PCから "q" (角速度のみ) 又は "Q" (加速度補正付き) 受信
+  STATE_ATTITUDE -> STATE_IDLE   : PCから "e" 受信、または、M5Stack Atom S3 のディスプレイを 200ms以上押し込んで離す
+  STATE_IDLE -> STATE_FIFO       : PCから "f" 受信
+  STATE_FIFO -> STATE_IDLE       : PCから "e" 受信、または、M5Stack Atom S3 のディスプレイを 200ms以上押し込んで離す
 
 <IMUデータ受信フォーマット>
   M5Stack Atom S3 から PC に送られるデータは、notify データとして送られる。
@@ -39,6 +52,46 @@ LIBRARY MANAGER:
   12byte データは、バイナリ / signed 16bit / little endian 形式とする。12byte は順に以下の通り、
       acc_x(L) acc_x(H) acc_y(L) acc_y(H) acc_z(L) acc_z(H) gyr_x(L) gyr_x(H) gyr_y(L) gyr_y(H) gyr_z(L) gyr_z(H)
   STATE_SAMPLING で得られる IMUデータは、終端データ(12byte 全て0) によってデータ完了を判断する。
+
+<タイムスタンプ付き IMUデータ受信フォーマット (STATE_STAMPED)>
+  1回の notify データは 18byte とし、12byte の IMUデータの後に、以下の 6byte を付ける。
+      seq(L) seq(H) tick(0) tick(1) tick(2) tick(3)
+  seq  : unsigned 16bit little endian のシーケンス番号。"t" 受信時に 0 から始め、サンプル毎に +1 (65535 の次は 0)
+  tick : unsigned 32bit little endian の IMUデータ取得時刻 micros() [usec] (約71分で一周)
+  PC側は seq の飛びで欠落を検出し、tick の差分で実際のサンプリング間隔を得る。
+  終端データは STATE_SAMPLING と同じ 12byte 全て0 とする。
+
+<複数サンプルをまとめた IMUデータ受信フォーマット (STATE_PACKED)>
+  1回の notify データは、4byte のヘッダの後に、K サンプル分の 12byte IMUデータを続けた 4+12K byte とする。
+      seq(L) seq(H) K reserved(0) [IMUデータ 12byte] x K
+  seq : 先頭サンプルのシーケンス番号 (unsigned 16bit little endian)。"p" 受信時に 0 から始め、サンプル毎に +1
+  K   : "p" 受信時の接続 MTU から、MTU-3 byte に収まる最大数 (1～PACKED_MAX) とする
+  K サンプル溜まる毎に送るので、送信は 10ms x K 毎になる。
+  停止時は、溜まっている分(K 未満) を送ってから、終端データ(12byte 全て0) を送る。
+
+<FIFO 読み出しの IMUデータ受信フォーマット (STATE_FIFO)>
+  "f" の直後(同じ書き込み) の 1byte を分周値 div (無しなら 0) とし、センサ内部で 1kHz / (div+1) 毎に
+  サンプリングして FIFO (1024byte = 73サンプル) に溜める。サンプリング周期は vTaskDelayUntil の
+  タイミングに依らず、センサのクロックで決まる。10ms 毎に FIFO に溜まった分をまとめて読み出す。
+  送信は STATE_PACKED と同じ 4+12K byte で、seq も "f" 受信時に 0 から始め、サンプル毎に +1 とする。
+  reserved は flags とし、bit0 (PACKED_FLAG_FIFO_FULL) が 1 の場合は、その notify の前に FIFO が一杯に
+  なり、センサ側でサンプルが失われた (seq には現れない) ことを示す。
+  1kHz では 12kbyte/sec になるので、MTU 247 (K=20, 50 notify/sec) 程度での接続を前提とする。
+  停止時は、溜まっている分を送ってから、終端データ(12byte 全て0) を送る。
+
+<姿勢ストリーミングのデータ受信フォーマット (STATE_ATTITUDE)>
+  "q" 又は "Q" の直後(同じ書き込み) の 1byte を間引き数 D (1～255、無し又は 0 なら 10) とする。
+  "q"/"Q" 受信後の最初のサンプルを静置状態とし、加速度から初期姿勢を、角速度をオフセットとする。
+  以降 10ms 毎に、式(15) の1次近似で姿勢クオータニオンを積算し、単位化する。
+  "Q" の場合は、Mahony フィルタの比例項 (k_P = ATT_KP) と同じく、加速度と推定した重力方向の外積で
+  角速度を補正してから積算する (加速度センサの校正値は使わない)。
+  積算は全て整数演算で、クオータニオンは Q30 (1.0 = 2^30) の int32、途中の積は int64 とする。
+  PC 側の case1_python/cq_quaternion_fixed.py の streamAttitude と、ビット単位で同じ計算をしている。
+  最初のサンプルを含めて D サンプル毎に、1回の notify データ 10byte を送る。
+      q_r(L) q_r(H) q_i(L) q_i(H) q_j(L) q_j(H) q_k(L) q_k(H) seq(L) seq(H)
+  q_r～q_k : signed 16bit little endian の Q15 (32768 = 1.0、32767 で飽和) のクオータニオン
+  seq      : unsigned 16bit little endian の出力番号。"q"/"Q" 受信時に 0 から始め、出力毎に +1
+  停止時は終端データ(12byte 全て0) を送る。
 */
 
 
@@ -53,12 +106,54 @@ static constexpr uint8_t STATE_IDLE     = 0;
 static constexpr uint8_t STATE_SAMPLING = 1;
 static constexpr uint8_t STATE_ONESHOT  = 2;
 static constexpr uint8_t STATE_GET_LOG  = 3;
+static constexpr uint8_t STATE_STAMPED  = 4;
+static constexpr uint8_t STATE_PACKED   = 5;
+static constexpr uint8_t STATE_ATTITUDE = 6;
+static constexpr uint8_t STATE_FIFO     = 7;
 static constexpr uint8_t STATE_LOGGING  = 8;
 static uint8_t now_state = STATE_IDLE;
 
 const  int16_t end_data[6] = {0,0,0,0,0,0};  // Terminate data for end of STATE_SAMPLING
+static uint16_t sample_seq = 0;               // Sequence number for STATE_STAMPED / STATE_PACKED
+
+static constexpr uint16_t PACKED_HEADER = 4;  // seq 2byte + K 1byte + flags 1byte
+static constexpr uint8_t  PACKED_MAX = 20;    // Max samples in one notify (MTU 247)
+static uint8_t packed_data[PACKED_HEADER + PACKED_MAX*12];
+static uint8_t packed_count = 0;              // Samples in packed_data
+static uint8_t packed_limit = 1;              // K for STATE_PACKED / STATE_FIFO
+static uint8_t packed_flags = 0;              // Header flags (reserved byte) of next notify
+static constexpr uint8_t PACKED_FLAG_FIFO_FULL = 0x01;  // Sensor FIFO was full (samples lost)
+static constexpr uint16_t FIFO_READ_MAX = 73;           // Sensor FIFO 1024byte / 14byte
+static int16_t fifo_data[FIFO_READ_MAX*6];
+
+// Fixed-point attitude integration for STATE_ATTITUDE (same as cq_quaternion_fixed.py)
+static constexpr int ATT_QF = 30;                               // Quaternion fraction bits (Q30)
+static constexpr int ATT_GAIN_BITS = 16;                        // Extra fraction bits of ATT_GYR_GAIN
+static constexpr int ATT_KP_BITS = 30;                          // Fraction bits of ATT_KP_GAIN
+static constexpr double ATT_DT = 0.01;                          // Sampling period [sec]
+static constexpr double ATT_GYR_SCALE = 2*250/65536.0/180*PI;   // Gyro LSB -> rad/sec (+-250dps)
+static constexpr double ATT_KP = 1.0;                           // Proportional gain of "Q" command
+static constexpr int64_t ATT_GYR_GAIN = (int64_t)(0.5*ATT_GYR_SCALE*ATT_DT*(double)(1LL << (ATT_QF + ATT_GAIN_BITS)) + 0.5);
+static constexpr int64_t ATT_KP_GAIN = (int64_t)(0.5*ATT_KP*ATT_DT*(double)(1LL << ATT_KP_BITS) + 0.5);
+static constexpr uint8_t ATT_DECIMATION = 10;                   // Default decimation
+static int64_t att_q[4];                      // Quaternion r, i, j, k (Q30)
+static int16_t att_offset[3];                 // Gyro offset
+static bool att_acc = false;                  // Accelerometer correction ("Q")
+static bool att_first = true;                 // Next sample is the first one
+static uint8_t att_decimation = ATT_DECIMATION;
+static uint8_t att_count = 0;                 // Samples since last output
 
 static uint8_t checkButton(uint8_t is_push, uint8_t state);
+static bool isStreaming(uint8_t state);
+static void stopStreaming(uint8_t state);
+static uint8_t getPackedLimit(void);
+static void flushPacked(void);
+static int64_t shiftRound(int64_t x, int bits);
+static int64_t isqrt64(int64_t x);
+static void attitudeNormalize(int64_t *q);
+static void attitudeInit(const int16_t *imu_data);
+static void attitudeStep(const int16_t *imu_data);
+static void attitudeSend(void);
 
 void setup(){
     imu.init(I2C_SDA_PIN, I2C_SCL_PIN, 0);
@@ -72,6 +167,7 @@ void setup(){
     //   |-- RX characteristic UUID (write) : 6E400002-B5A3-F393-E0A9-E50E24DCCA9E
     //   |-- TX characteristic UUID (notify): 6E400003-B5A3-F393-E0A9-E50E24DCCA9E
     NimBLEDevice::init("IMU_BASE");  // Device name
+    NimBLEDevice::setMTU(PACKED_HEADER + PACKED_MAX*12 + 3);  // Preferred MTU for STATE_PACKED
     NuSerial.begin(115200);
 }
 
@@ -79,6 +175,8 @@ void loop(){
     TickType_t xLastWakeTime;
     static uint32_t write_point = 0;
     int16_t log_data[6];
+    uint8_t stamped_data[18];
+    uint32_t tick;
 
     xLastWakeTime = xTaskGetTickCount();
 
@@ -94,11 +192,55 @@ void loop(){
                     now_state = STATE_SAMPLING;
                     break;
                 case 'e':
-                    if(now_state == STATE_SAMPLING){
-                        NuSerial.write((uint8_t *)end_data, 6*2);
+                    if(isStreaming(now_state)){
+                        stopStreaming(now_state);
                     }
                     now_state = STATE_IDLE;
                     break;
+                case 't':
+                    if(now_state == STATE_IDLE){
+                        sample_seq = 0;
+                        now_state = STATE_STAMPED;
+                    }
+                    break;
+                case 'p':
+                    if(now_state == STATE_IDLE){
+                        sample_seq = 0;
+                        packed_count = 0;
+                        packed_limit = getPackedLimit();
+                        now_state = STATE_PACKED;
+                    }
+                    break;
+                case 'q':
+                case 'Q':
+                    {
+                        // Optional decimation byte in the same write
+                        uint8_t decimation = NuSerial.available() ? (uint8_t)NuSerial.read() : 0;
+                        if(now_state == STATE_IDLE){
+                            sample_seq = 0;
+                            att_acc = command == 'Q';
+                            att_first = true;
+                            att_count = 0;
+                            att_decimation = decimation ? decimation : ATT_DECIMATION;
+                            now_state = STATE_ATTITUDE;
+                        }
+                    }
+                    break;
+                case 'f':
+                    {
+                        // Optional sample divider byte in the same write : 1kHz / (div+1)
+                        uint8_t divider = NuSerial.available() ? (uint8_t)NuSerial.read() : 0;
+                        if(now_state == STATE_IDLE){
+                            sample_seq = 0;
+                            packed_count = 0;
+                            packed_flags = 0;
+                            packed_limit = getPackedLimit();
+                            imu.setSampleDivider(divider);
+                            imu.startFifo(true, true);
+                            now_state = STATE_FIFO;
+                        }
+                    }
+                    break;
                 case 's':
                     if(now_state == STATE_IDLE){
                         now_state = STATE_ONESHOT;
@@ -122,6 +264,58 @@ void loop(){
             now_state = STATE_IDLE;
         }
     }
+    else if(now_state == STATE_STAMPED){
+        tick = micros();
+        imu.getAccelAdc(log_data, log_data+1, log_data+2);
+        imu.getGyroAdc(log_data+3, log_data+4, log_data+5);
+        // IMU data 12byte + seq 2byte + tick 4byte ==> little endian 18byte binary
+        memcpy(stamped_data, log_data, 6*2);
+        memcpy(stamped_data+12, &sample_seq, 2);
+        memcpy(stamped_data+14, &tick, 4);
+        NuSerial.write(stamped_data, 18);
+        ++sample_seq;
+    }
+    else if(now_state == STATE_PACKED){
+        imu.getAccelAdc(log_data, log_data+1, log_data+2);
+        imu.getGyroAdc(log_data+3, log_data+4, log_data+5);
+        memcpy(packed_data + PACKED_HEADER + packed_count*12, log_data, 6*2);
+        ++packed_count;
+        if(packed_count >= packed_limit){
+            flushPacked();
+        }
+    }
+    else if(now_state == STATE_FIFO){
+        // Burst read of all samples in the sensor FIFO
+        bool is_full = false;
+        uint16_t samples = imu.getFifoAdc(fifo_data, FIFO_READ_MAX, &is_full);
+        if(is_full){
+            packed_flags |= PACKED_FLAG_FIFO_FULL;
+        }
+        for(uint16_t n = 0; n < samples; ++n){
+            memcpy(packed_data + PACKED_HEADER + packed_count*12, fifo_data + n*6, 6*2);
+            ++packed_count;
+            if(packed_count >= packed_limit){
+                flushPacked();
+            }
+        }
+    }
+    else if(now_state == STATE_ATTITUDE){
+        imu.getAccelAdc(log_data, log_data+1, log_data+2);
+        imu.getGyroAdc(log_data+3, log_data+4, log_data+5);
+        if(att_first){
+            attitudeInit(log_data);
+            att_first = false;
+        }
+        else{
+            attitudeStep(log_data);
+        }
+        if(att_count == 0){
+            attitudeSend();
+        }
+        if(++att_count >= att_decimation){
+            att_count = 0;
+        }
+    }
 
     vTaskDelayUntil(&xLastWakeTime, xPERIOD);
 }
@@ -146,8 +340,8 @@ uint8_t checkButton(uint8_t is_push, uint8_t state){
                 delay(1500);
                 return STATE_SAMPLING;
             }
-            else if(state == STATE_SAMPLING){
-                NuSerial.write((uint8_t *)end_data, 6*2);
+            else if(isStreaming(state)){
+                stopStreaming(state);
                 return STATE_IDLE;
             }
         }
@@ -157,3 +351,151 @@ uint8_t checkButton(uint8_t is_push, uint8_t state){
     }
     return state;
 }
+
+bool isStreaming(uint8_t state){
+    return state == STATE_SAMPLING || state == STATE_STAMPED || state == STATE_PACKED || state == STATE_ATTITUDE
+        || state == STATE_FIFO;
+}
+
+void stopStreaming(uint8_t state){
+    // Send remaining packed samples, then terminate data
+    if(state == STATE_FIFO){
+        imu.stopFifo();
+        imu.setSampleDivider(0);
+    }
+    if(state == STATE_PACKED || state == STATE_FIFO){
+        flushPacked();
+    }
+    NuSerial.write((uint8_t *)end_data, 6*2);
+}
+
+uint8_t getPackedLimit(void){
+    // Number of samples that fit in (MTU - 3) byte of the first connected peer
+    uint16_t payload = 23 - 3;
+    NimBLEServer *server = NimBLEDevice::getServer();
+    if(server != nullptr && server->getConnectedCount() > 0){
+        payload = server->getPeerMTU(server->getPeerDevices()[0]) - 3;
+    }
+    uint16_t limit = (payload - PACKED_HEADER) / 12;
+    if(limit < 1){
+        limit = 1;
+    }
+    if(limit > PACKED_MAX){
+        limit = PACKED_MAX;
+    }
+    return (uint8_t)limit;
+}
+
+void flushPacked(void){
+    // Header : seq of first sample (little endian), K, flags
+    if(packed_count == 0){
+        return;
+    }
+    memcpy(packed_data, &sample_seq, 2);
+    packed_data[2] = packed_count;
+    packed_data[3] = packed_flags;
+    NuSerial.write(packed_data, PACKED_HEADER + packed_count*12);
+    sample_seq += packed_count;
+    packed_count = 0;
+    packed_flags = 0;
+}
+
+int64_t shiftRound(int64_t x, int bits){
+    // Arithmetic right shift with rounding
+    return (x + ((int64_t)1 << (bits - 1))) >> bits;
+}
+
+int64_t isqrt64(int64_t x){
+    // Integer square root (floor) of x >= 0
+    uint64_t v = (uint64_t)x;
+    uint64_t root = 0;
+    uint64_t bit = (uint64_t)1 << 62;
+    while(bit > v){
+        bit >>= 2;
+    }
+    while(bit != 0){
+        if(v >= root + bit){
+            v -= root + bit;
+            root = (root >> 1) + bit;
+        }
+        else{
+            root >>= 1;
+        }
+        bit >>= 2;
+    }
+    return (int64_t)root;
+}
+
+void attitudeNormalize(int64_t *q){
+    // One Newton step of 1/sqrt(x) around x = 1
+    int64_t norm2 = shiftRound(q[0]*q[0] + q[1]*q[1] + q[2]*q[2] + q[3]*q[3], ATT_QF);
+    int64_t inv = ((3LL << ATT_QF) - norm2) >> 1;
+    for(int n = 0; n < 4; ++n){
+        q[n] = shiftRound(q[n]*inv, ATT_QF);
+    }
+}
+
+void attitudeInit(const int16_t *imu_data){
+    // Rotation of the acceleration vector to the z axis : normalize(|a| + a_z, a_y, -a_x, 0)
+    int64_t ax = imu_data[0], ay = imu_data[1], az = imu_data[2];
+    int64_t r = isqrt64(ax*ax + ay*ay + az*az) + az;
+    int64_t n = isqrt64(r*r + ay*ay + ax*ax);
+    if(n == 0){
+        att_q[0] = 0; att_q[1] = 1LL << ATT_QF; att_q[2] = 0; att_q[3] = 0;
+    }
+    else{
+        att_q[0] = r * (1LL << ATT_QF) / n;
+        att_q[1] = ay * (1LL << ATT_QF) / n;
+        att_q[2] = -ax * (1LL << ATT_QF) / n;
+        att_q[3] = 0;
+        attitudeNormalize(att_q);
+    }
+    memcpy(att_offset, imu_data + 3, 3*2);
+}
+
+void attitudeStep(const int16_t *imu_data){
+    int64_t *q = att_q;
+    // Half rotation angle h (Q30)
+    int64_t hx = shiftRound((int64_t)(imu_data[3] - att_offset[0]) * ATT_GYR_GAIN, ATT_GAIN_BITS);
+    int64_t hy = shiftRound((int64_t)(imu_data[4] - att_offset[1]) * ATT_GYR_GAIN, ATT_GAIN_BITS);
+    int64_t hz = shiftRound((int64_t)(imu_data[5] - att_offset[2]) * ATT_GYR_GAIN, ATT_GAIN_BITS);
+    if(att_acc){
+        // Unit acceleration u (u = 0 when acceleration is 0)
+        int64_t ax = imu_data[0], ay = imu_data[1], az = imu_data[2];
+        int64_t n = isqrt64(ax*ax + ay*ay + az*az);
+        if(n < 1){
+            n = 1;
+        }
+        int64_t ux = ax * (1LL << ATT_QF) / n;
+        int64_t uy = ay * (1LL << ATT_QF) / n;
+        int64_t uz = az * (1LL << ATT_QF) / n;
+        // Estimated gravity direction v
+        int64_t vx = shiftRound(2*(q[1]*q[3] - q[0]*q[2]), ATT_QF);
+        int64_t vy = shiftRound(2*(q[0]*q[1] + q[2]*q[3]), ATT_QF);
+        int64_t vz = shiftRound(q[0]*q[0] - q[1]*q[1] - q[2]*q[2] + q[3]*q[3], ATT_QF);
+        // h += (k_P dt / 2) (u x v)
+        hx += shiftRound(shiftRound(uy*vz - uz*vy, ATT_QF) * ATT_KP_GAIN, ATT_KP_BITS);
+        hy += shiftRound(shiftRound(uz*vx - ux*vz, ATT_QF) * ATT_KP_GAIN, ATT_KP_BITS);
+        hz += shiftRound(shiftRound(ux*vy - uy*vx, ATT_QF) * ATT_KP_GAIN, ATT_KP_BITS);
+    }
+    // q <- q + q * (0, h)
+    int64_t r = q[0] + shiftRound(          - hx*q[1] - hy*q[2] - hz*q[3], ATT_QF);
+    int64_t i = q[1] + shiftRound( hx*q[0]            + hz*q[2] - hy*q[3], ATT_QF);
+    int64_t j = q[2] + shiftRound( hy*q[0] - hz*q[1]            + hx*q[3], ATT_QF);
+    int64_t k = q[3] + shiftRound( hz*q[0] + hy*q[1] - hx*q[2], ATT_QF);
+    q[0] = r; q[1] = i; q[2] = j; q[3] = k;
+    attitudeNormalize(q);
+}
+
+void attitudeSend(void){
+    // Q30 -> Q15 (saturated) 8byte + seq 2byte
+    uint8_t attitude_data[10];
+    for(int n = 0; n < 4; ++n){
+        int64_t v = shiftRound(att_q[n], ATT_QF - 15);
+        int16_t q15 = (int16_t)(v > 32767 ? 32767 : (v < -32768 ? -32768 : v));
+        memcpy(attitude_data + n*2, &q15, 2);
+    }
+    memcpy(attitude_data + 8, &sample_seq, 2);
+    NuSerial.write(attitude_data, 10);
+    ++sample_seq;
+}
@@ -1,6 +1,10 @@
 import json
+import os
+import re
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.multiprocessing as mp
 from torch.nn import functional as F
 
 # hyperparameters
@@ -11,32 +15,120 @@ eval_interval = 100
 learning_rate = 1e-3
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 eval_iters = 200
+eval_seed = 1337 # seed of the fixed evaluation batches (drawn once, reused by every evaluation)
+eval_async = False # True: evaluate a snapshot of the weights in a separate process while training continues
+max_summary_tokens = 2000 # generation limit of the test summary (stops earlier at <EOS>)
+summary_window_shift = 100 # cache re-fill interval of the test summary past block_size (1: same output as uncached, but no faster)
 n_embd = 64
 n_head = 4
 n_layer = 4
 dropout = 0.0
+# preprocessed corpus: uint16 token files and vocabulary (rebuilt when a JSONL file is newer)
+train_bin = 'japanese_train.bin'
+val_bin = 'japanese_val.bin'
+vocab_path = 'vocab.json'
 # ------------
 
 torch.manual_seed(1337)
 
-def read_data(file_path):
-    # 学習データセットを保持するリスト
-    texts = []
-    summaries = []
-
-    # JSONLファイルから text と summary を抽出
+def iter_records(file_path):
+    # JSONLファイルから text と summary を1行ずつ抽出 (ファイル全体をメモリに置かない)
     with open(file_path, 'r', encoding='utf-8') as file:
         for line in file:
             json_data = json.loads(line)
             text = json_data.get("text")
             summary = json_data.get("summary")
             if text and summary:
-                texts.append(text)
-                summaries.append(summary)
+                yield text, summary
+
+def read_data(file_path):
+    # 学習データセットを保持するリスト
+    texts = []
+    summaries = []
+    for text, summary in iter_records(file_path):
+        texts.append(text)
+        summaries.append(summary)
     return texts, summaries
 
+def record_text(text, summary):
+    # 1件分の学習テキスト
+    return "<BOS>" + text + "<SUMMARY>" + summary + "<EOS>"
+
+def code_points(text):
+    # 文字列を Unicode コードポイントの配列に変換 (1文字 = 1要素)
+    return np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+
+def prepare_data(train_path, val_path, train_out, val_out, vocab_out):
+    """
+    Stream the JSONL corpora once and write them as uint16 token files plus the vocabulary.
+
+    The vocabulary is the same as Tokenizer.create_vocab over the concatenated training text
+    (sorted characters, then the special tokens). Training ids are assigned in order of first
+    appearance while streaming and renumbered to the sorted order afterwards, so the corpus is read once.
+
+    Args:
+        train_path (str): Training JSONL file.
+        val_path (str): Validation JSONL file (characters not in the training vocab become "<unk>").
+        train_out (str): Output token file for the training data.
+        val_out (str): Output token file for the validation data.
+        vocab_out (str): Output vocabulary JSON file.
+
+    Returns:
+        Tokenizer: Tokenizer with the new vocabulary.
+    """
+    # while streaming, the special tokens use ids 0..S-1 and characters follow in order of first appearance
+    specials = Tokenizer.special_tokens
+    first_seen = {} # code point -> id
+    with open(train_out, 'wb') as out:
+        for text, summary in iter_records(train_path):
+            ids = []
+            for n, segment in enumerate(Tokenizer.split_special(record_text(text, summary))):
+                if n % 2:
+                    ids.append([specials.index(segment)])
+                elif segment:
+                    uniq, inverse = np.unique(code_points(segment), return_inverse=True)
+                    ids.append(np.array([first_seen.setdefault(c, len(specials) + len(first_seen))
+                                         for c in uniq.tolist()])[inverse])
+            if len(specials) + len(first_seen) > 1 << 16:
+                raise ValueError("vocabulary does not fit in uint16 tokens")
+            np.concatenate(ids).astype(np.uint16).tofile(out)
+    if not first_seen:
+        raise ValueError(f"no records in {train_path}")
+    # joined in sorted order, so the characters cannot spell a special token ('>' sorts before the letters)
+    tokenizer = Tokenizer(Tokenizer.create_vocab("".join(sorted(chr(c) for c in first_seen))))
+    rank = np.empty(len(specials) + len(first_seen), dtype=np.uint16)
+    rank[:len(specials)] = [tokenizer.vocab_encode[token] for token in specials]
+    rank[list(first_seen.values())] = tokenizer.lut[list(first_seen)]
+    tokens = np.memmap(train_out, dtype=np.uint16, mode='r+')
+    for start in range(0, len(tokens), 1 << 24):
+        tokens[start:start + (1 << 24)] = rank[tokens[start:start + (1 << 24)]]
+    tokens.flush()
+    del tokens
+
+    with open(val_out, 'wb') as out:
+        for text, summary in iter_records(val_path):
+            tokenizer.encode(record_text(text, summary)).astype(np.uint16).tofile(out)
+    tokenizer.save(vocab_out)
+    return tokenizer
+
 # Tokenizerクラスの実装
 class Tokenizer:
+    # markers that are single tokens instead of being split into characters ("<unk>": unknown character)
+    special_tokens = ("<unk>", "<BOS>", "<SUMMARY>", "<EOS>")
+    _special_split = re.compile("(" + "|".join(re.escape(token) for token in special_tokens) + ")")
+
+    @staticmethod
+    def split_special(text):
+        """
+        Split a text at the special tokens.
+
+        Args:
+            text (str): Input text.
+
+        Returns:
+            List[str]: Plain text segments at even positions (possibly empty) and special tokens at odd positions.
+        """
+        return Tokenizer._special_split.split(text)
 
     @staticmethod
     def create_vocab(dataset):
@@ -45,20 +137,39 @@ class Tokenizer:
 
         Args:
             dataset (str): Text dataset to be used to create the character vocab.
+                Special tokens in the text are not split into characters.
 
         Returns:
-            Dict[str, int]: Character vocabulary.
+            Dict[str, int]: Character vocabulary followed by the special tokens.
         """
+        chars = set()
+        for segment in Tokenizer.split_special(dataset)[::2]:
+            chars.update(segment)
         vocab = {
             token: index
-            for index, token in enumerate(sorted(list(set(dataset))))
+            for index, token in enumerate(sorted(chars))
         }
 
-        # Adding unknown token
-        vocab["<unk>"] = len(vocab)
+        # Adding the special tokens (unknown token first)
+        for token in Tokenizer.special_tokens:
+            vocab[token] = len(vocab)
 
         return vocab
 
+    @classmethod
+    def load(cls, path):
+        """
+        Load a tokenizer from a vocabulary file written by save.
+
+        Args:
+            path (str): Vocabulary JSON file.
+
+        Returns:
+            Tokenizer: The tokenizer.
+        """
+        with open(path, 'r', encoding='utf-8') as file:
+            return cls(json.load(file))
+
     def __init__(self, vocab):
         """
         Initialize the tokenizer.
@@ -68,118 +179,243 @@ class Tokenizer:
         """
         self.vocab_encode = {str(k): int(v) for k, v in vocab.items()}
         self.vocab_decode = {v: k for k, v in self.vocab_encode.items()}
+        self.unk = self.vocab_encode["<unk>"]
+        # code point -> token id for single characters; the last entry catches code points above the table
+        chars = {ord(k): v for k, v in self.vocab_encode.items() if len(k) == 1}
+        self.lut = np.full(max(chars, default=0) + 2, self.unk, dtype=np.int64)
+        self.lut[list(chars)] = list(chars.values())
+        # token id -> string; the last entry catches ids outside the vocabulary
+        self.table = np.array([self.vocab_decode.get(idx, "<unk>") for idx in range(max(self.vocab_decode) + 2)],
+                              dtype=object)
+
+    def save(self, path):
+        """
+        Save the vocabulary so that training and inference can skip rebuilding it.
+
+        Args:
+            path (str): Vocabulary JSON file.
+        """
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.vocab_encode, file, ensure_ascii=False)
 
     def encode(self, text):
         """
-        Encode a text in level character.
+        Encode a text in level character, keeping the special tokens atomic.
 
         Args:
             text (str): Input text to be encoded.
 
         Returns:
-            List[int]: List with token indices.
+            np.ndarray: int64 array with token indices.
         """
-        return [self.vocab_encode.get(char, self.vocab_encode["<unk>"]) for char in text]
+        # table lookup over the code points of the whole text
+        ids = self.lut[np.minimum(code_points(text), len(self.lut) - 1)]
+        matches = list(self._special_split.finditer(text))
+        if not matches:
+            return ids
+        # each special token becomes one id at its first character; the rest of its characters are dropped
+        starts = np.array([match.start() for match in matches])
+        ends = np.array([match.end() for match in matches])
+        ids[starts] = [self.vocab_encode.get(match.group(), self.unk) for match in matches]
+        inside = np.zeros(len(ids) + 1, dtype=np.int64)
+        inside[starts + 1] += 1
+        inside[ends] -= 1
+        return ids[np.cumsum(inside[:-1]) == 0]
 
     def decode(self, indices):
         """
-        Decode a list of token indices.
+        Decode token indices.
 
         Args:
-            indices (List[int]): List of token indices.
+            indices (List[int] or np.ndarray or torch.Tensor): Token indices (T,), or a batch of them (B, T).
 
         Returns:
-            str: The decoded text.
+            str: The decoded text, or List[str] for a batch.
         """
-        return "".join([self.vocab_decode.get(idx, "<unk>") for idx in indices])
+        if torch.is_tensor(indices):
+            indices = indices.cpu().numpy()
+        ids = np.minimum(np.asarray(indices, dtype=np.int64), len(self.table) - 1)
+        strings = self.table[ids].tolist()
+        if ids.ndim == 1:
+            return "".join(strings)
+        return ["".join(row) for row in strings]
 
 
 # データの読み込みが正しく行われているか確認
 file_path_train = 'japanese_train.jsonl'
 file_path_val = 'japanese_val.jsonl'
 
-# 自動要約AIを作成するためのデータ読み込み (学習用データ)
-texts, summaries = read_data(file_path_train)
-train_data = ""
-for text, summary in zip(texts, summaries):
-    train_data = train_data + "<BOS>" + text + "<SUMMARY>" + summary + "<EOS>"
-vocab = Tokenizer.create_vocab(train_data)
-tokenizer = Tokenizer(vocab)
-vocab_size = len(vocab)
-
-# 自動要約AIを作成するためのデータ読み込み (評価・開発用データ)
-texts, summaries = read_data(file_path_val)
-val_data = ""
-for text, summary in zip(texts, summaries):
-    val_data = val_data + "<BOS>" + text + "<SUMMARY>" + summary + "<EOS>"
-
-train_data = torch.tensor(tokenizer.encode(train_data), dtype=torch.long)
-val_data = torch.tensor(tokenizer.encode(val_data), dtype=torch.long)
+# 自動要約AIを作成するためのデータ読み込み (学習用データ、評価・開発用データ)
+# 初回 (又は JSONL ファイルの更新後) に、トークン列ファイルと語彙ファイルを作成する
+sources = [file_path_train, file_path_val]
+outputs = [train_bin, val_bin, vocab_path]
+rebuild = not all(os.path.exists(path) for path in outputs) or \
+    max(os.path.getmtime(path) for path in sources) > min(os.path.getmtime(path) for path in outputs)
+if not rebuild:
+    tokenizer = Tokenizer.load(vocab_path)
+    # 特殊トークンを持たない古い語彙で作ったファイルは作り直す
+    rebuild = any(token not in tokenizer.vocab_encode for token in Tokenizer.special_tokens)
+if rebuild:
+    tokenizer = prepare_data(file_path_train, file_path_val, train_bin, val_bin, vocab_path)
+vocab_size = len(tokenizer.vocab_encode)
+
+# トークン列はメモリマップで参照し、get_batch で必要な窓だけを読み出す
+train_data = np.memmap(train_bin, dtype=np.uint16, mode='r')
+val_data = np.memmap(val_bin, dtype=np.uint16, mode='r')
 
 # data loading
+def windows(data, ix):
+    # read every window (block_size+1 tokens) starting at ix with one fancy-indexing gather from the memory map
+    return data[np.asarray(ix)[..., None] + np.arange(block_size + 1)]
+
+def to_batch(window):
+    # split (B, block_size+1) windows into inputs x and targets y
+    window = torch.from_numpy(window.astype(np.int64))
+    x = window[:, :-1].contiguous()
+    y = window[:, 1:].contiguous()
+    x, y = x.to(device), y.to(device)
+    return x, y
+
 def get_batch(split):
     # generate a small batch of data of inputs x and targets y
     data = train_data if split == 'train' else val_data
-    # print(len(data))
     ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([data[i:i+block_size] for i in ix])
-    y = torch.stack([data[i+1:i+block_size+1] for i in ix])
-    # print(x[0])
-    # print(y[0])
-    x, y = x.to(device), y.to(device)
-    return x, y
+    return to_batch(windows(data, ix.numpy()))
+
+# 評価用のバッチは起動時に一度だけ選び (学習の乱数列とは別の生成器)、毎回の評価で同じものを使う
+eval_generator = torch.Generator().manual_seed(eval_seed)
+eval_batches = {
+    split: windows(data, torch.randint(len(data) - block_size, (eval_iters, batch_size), generator=eval_generator).numpy())
+    for split, data in (('train', train_data), ('val', val_data))
+} # (eval_iters, batch_size, block_size+1) uint16
+
+# 要約を生成させる評価用の入力 (評価・開発用データの先頭) も一度だけ作る
+val_text, _ = next(iter_records(file_path_val))
+val_input_text = "<BOS>" + val_text + "<SUMMARY>" # <SUMMARY>の続きを生成させる
+val_context = torch.tensor(tokenizer.encode(val_input_text)).unsqueeze(0)
 
 @torch.no_grad()
-def estimate_loss():
+def estimate_loss(model):
     out = {}
     model.eval()
     for split in ['train', 'val']:
         losses = torch.zeros(eval_iters)
         for k in range(eval_iters):
-            X, Y = get_batch(split)
+            X, Y = to_batch(eval_batches[split][k])
             logits, loss = model(X, Y)
             losses[k] = loss.item()
         out[split] = losses.mean()
     model.train()
     return out
 
-class Head(nn.Module):
-    """ one head of self-attention """
-
-    def __init__(self, head_size):
-        super().__init__()
-        self.key = nn.Linear(n_embd, head_size, bias=False)
-        self.query = nn.Linear(n_embd, head_size, bias=False)
-        self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)))
-
-        self.dropout = nn.Dropout(dropout)
-
-    def forward(self, x):
-        B,T,C = x.shape
-        k = self.key(x)   # (B,T,C)
-        q = self.query(x) # (B,T,C)
-        # compute attention scores ("affinities")
-        wei = q @ k.transpose(-2,-1) * C**-0.5 # (B, T, C) @ (B, C, T) -> (B, T, T)
-        wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf')) # (B, T, T)
-        wei = F.softmax(wei, dim=-1) # (B, T, T)
-        wei = self.dropout(wei)
-        # perform the weighted aggregation of the values
-        v = self.value(x) # (B,T,C)
-        out = wei @ v # (B, T, T) @ (B, T, C) -> (B, T, C)
-        return out
+def evaluate(model, step):
+    # loss on the fixed evaluation batches and a test summary of the validation prompt
+    losses = estimate_loss(model)
+    print(f"step {step}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+
+    # test generation (stops at the first <EOS>)
+    eos = tokenizer.vocab_encode["<EOS>"]
+    context = val_context.to(device)
+    out = model.generate(context, max_new_tokens=max_summary_tokens, window_shift=summary_window_shift,
+                         stop_token=eos)[0].tolist()
+    # the summary is the generated part up to the first <EOS> token
+    summary = out[context.shape[1]:]
+    if eos in summary:
+        summary = summary[:summary.index(eos)]
+    print("Context: ", tokenizer.decode(out[:context.shape[1]]))
+    print("Generated Summary: ", tokenizer.decode(summary))
+
+def eval_worker(jobs):
+    # evaluation process (eval_async=True): evaluates (step, state_dict) snapshots until it receives None
+    model = BigramLanguageModel().to(device)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        step, state = job
+        model.load_state_dict(state)
+        evaluate(model, step)
 
 class MultiHeadAttention(nn.Module):
-    """ multiple heads of self-attention in parallel """
+    """ multiple heads of self-attention in parallel (one fused QKV projection, batched heads) """
 
     def __init__(self, num_heads, head_size):
         super().__init__()
-        self.heads = nn.ModuleList([Head(head_size) for _ in range(num_heads)])
+        self.num_heads = num_heads
+        self.head_size = head_size
+        # query, key and value of all heads in one projection: [q_0 .. q_n | k_0 .. k_n | v_0 .. v_n]
+        self.qkv = nn.Linear(n_embd, 3 * num_heads * head_size, bias=False)
+        self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)), persistent=False)
+        self.attn_dropout = nn.Dropout(dropout)
         self.proj = nn.Linear(n_embd, n_embd)
         self.dropout = nn.Dropout(dropout)
+        # key/value cache for incremental decoding (None when disabled)
+        self.cache_k = None # (B, num_heads, block_size, head_size)
+        self.cache_v = None # (B, num_heads, block_size, head_size)
+        self.cache_len = 0  # number of cached positions
+        # checkpoints saved with one Head module per head are converted when loaded
+        self._register_load_state_dict_pre_hook(self._convert_heads)
+
+    def _convert_heads(self, state_dict, prefix, *args):
+        # heads.<n>.query/key/value.weight (head_size, n_embd) -> qkv.weight (3 * num_heads * head_size, n_embd)
+        if prefix + 'heads.0.query.weight' not in state_dict:
+            return
+        weights = []
+        for name in ('query', 'key', 'value'):
+            weights += [state_dict.pop(f'{prefix}heads.{n}.{name}.weight') for n in range(self.num_heads)]
+        for n in range(self.num_heads):
+            state_dict.pop(f'{prefix}heads.{n}.tril', None)
+        state_dict[prefix + 'qkv.weight'] = torch.cat(weights, dim=0)
+
+    def reset_cache(self, batch):
+        # enable the key/value cache for `batch` sequences and empty it
+        shape = (batch, self.num_heads, block_size, self.head_size)
+        if self.cache_k is None or self.cache_k.shape != shape:
+            self.cache_k = torch.zeros(shape, device=self.qkv.weight.device)
+            self.cache_v = torch.zeros(shape, device=self.qkv.weight.device)
+        self.cache_len = 0
+
+    def clear_cache(self):
+        # disable the key/value cache and release its memory
+        self.cache_k = None
+        self.cache_v = None
+        self.cache_len = 0
 
     def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
+        B,T,C = x.shape
+        q, k, v = self.qkv(x).split(self.num_heads * self.head_size, dim=2)
+        q = q.view(B, T, self.num_heads, self.head_size).transpose(1, 2) # (B, nh, T, hs)
+        k = k.view(B, T, self.num_heads, self.head_size).transpose(1, 2) # (B, nh, T, hs)
+        v = v.view(B, T, self.num_heads, self.head_size).transpose(1, 2) # (B, nh, T, hs)
+        start = 0
+        if self.cache_k is not None:
+            # append the new positions and attend over everything cached so far
+            start = self.cache_len
+            self.cache_k[:, :, start:start+T] = k
+            self.cache_v[:, :, start:start+T] = v
+            self.cache_len = start + T
+            k = self.cache_k[:, :, :self.cache_len]
+            v = self.cache_v[:, :, :self.cache_len]
+        L = k.shape[2]
+        # scores are scaled by C**-0.5 (n_embd, not head_size) as in the per-head layout
+        if hasattr(F, 'scaled_dot_product_attention'):
+            if start == 0:
+                mask, causal = None, True   # T == L
+            elif T == 1:
+                mask, causal = None, False  # the newest token sees every cached position
+            else:
+                mask, causal = self.tril[start:start+T, :L].bool(), False
+            # SDPA scales by head_size**-0.5 (torch 2.0 has no scale argument), so fold the rest into q
+            q = q * (self.head_size**0.5 * C**-0.5)
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, is_causal=causal,
+                                                 dropout_p=dropout if self.training else 0.0) # (B, nh, T, hs)
+        else:
+            wei = q @ k.transpose(-2,-1) * C**-0.5 # (B, nh, T, hs) @ (B, nh, hs, L) -> (B, nh, T, L)
+            wei = wei.masked_fill(self.tril[start:start+T, :L] == 0, float('-inf'))
+            wei = F.softmax(wei, dim=-1)
+            wei = self.attn_dropout(wei)
+            out = wei @ v # (B, nh, T, L) @ (B, nh, L, hs) -> (B, nh, T, hs)
+        out = out.transpose(1, 2).reshape(B, T, self.num_heads * self.head_size) # heads side by side
         out = self.dropout(self.proj(out))
         return out
 
@@ -227,12 +463,13 @@ class BigramLanguageModel(nn.Module):
         self.ln_f = nn.LayerNorm(n_embd) # final layer norm
         self.lm_head = nn.Linear(n_embd, vocab_size)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, start_pos=0):
         B, T = idx.shape # idx: batch, token_length
+        # start_pos: absolute position of idx[:, 0] (number of tokens already in the key/value cache)
 
         # idx and targets are both (B,T) tensor of integers
         tok_emb = self.token_embedding_table(idx) # (B,T,C)
-        pos_emb = self.position_embedding_table(torch.arange(T, device=device)) # (T,C)
+        pos_emb = self.position_embedding_table(torch.arange(start_pos, start_pos + T, device=device)) # (T,C)
         x = tok_emb + pos_emb # (B,T,C)
         x = self.blocks(x) # (B,T,C)
         x = self.ln_f(x) # (B,T,C)
@@ -248,50 +485,108 @@ class BigramLanguageModel(nn.Module):
 
         return logits, loss
 
-    def generate(self, idx, max_new_tokens):
+    def attentions(self):
+        # attention modules of all blocks
+        return [block.sa for block in self.blocks]
+
+    def prefill(self, idx):
+        # empty the key/value caches and fill them with the context idx (B, T<=block_size)
+        for sa in self.attentions():
+            sa.reset_cache(idx.shape[0])
+        logits, loss = self(idx)
+        return logits
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, use_cache=True, window_shift=1, stop_token=None):
         # idx is (B, T) array of indices in the current context
-        for _ in range(max_new_tokens):
-            # crop idx to the last block_size tokens
+        # stop_token: stop once every sequence has generated this token (e.g. <EOS>)
+        # use_cache=True: keep per-layer key/value caches and feed only the newest token each step.
+        #   While the context fits in block_size, the result matches use_cache=False for the same seed.
+        #   Once it is full, the window slides and every position changes, so the caches are re-filled
+        #   from the last block_size - window_shift + 1 tokens. window_shift=1 re-fills every step
+        #   (identical to use_cache=False); a larger value re-fills only every window_shift steps
+        #   at the cost of a shorter context just after each re-fill.
+        done = torch.zeros(idx.shape[0], dtype=torch.bool, device=idx.device)
+        if not use_cache:
+            for _ in range(max_new_tokens):
+                # crop idx to the last block_size tokens
+                idx_cond = idx[:, -block_size:]
+                # get the predictions
+                logits, loss = self(idx_cond)
+                # focus only on the last time step
+                logits = logits[:, -1, :] # becomes (B, C)
+                # apply softmax to get probabilities
+                probs = F.softmax(logits, dim=-1) # (B, C)
+                # sample from the distribution
+                idx_next = torch.multinomial(probs, num_samples=1) # (B, 1)
+                # append sampled index to the running sequence
+                idx = torch.cat((idx, idx_next), dim=1) # (B, T+1)
+                if stop_token is not None:
+                    done |= idx_next[:, 0] == stop_token
+                    if done.all():
+                        break
+            return idx
+        try:
             idx_cond = idx[:, -block_size:]
-            # get the predictions
-            logits, loss = self(idx_cond)
-            # focus only on the last time step
-            logits = logits[:, -1, :] # becomes (B, C)
-            # apply softmax to get probabilities
-            probs = F.softmax(logits, dim=-1) # (B, C)
-            # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1) # (B, 1)
-            # append sampled index to the running sequence
-            idx = torch.cat((idx, idx_next), dim=1) # (B, T+1)
+            logits = self.prefill(idx_cond)
+            pos = idx_cond.shape[1] # number of cached positions
+            for n in range(max_new_tokens):
+                # sample from the distribution of the last time step
+                probs = F.softmax(logits[:, -1, :], dim=-1) # (B, C)
+                idx_next = torch.multinomial(probs, num_samples=1) # (B, 1)
+                idx = torch.cat((idx, idx_next), dim=1) # (B, T+1)
+                if stop_token is not None:
+                    done |= idx_next[:, 0] == stop_token
+                if n == max_new_tokens - 1 or done.all():
+                    break
+                if pos < block_size:
+                    # only the newest token goes through the model, at its absolute position
+                    logits, loss = self(idx_next, start_pos=pos)
+                    pos += 1
+                else:
+                    # the window is full: re-fill the caches from the newest tokens
+                    idx_cond = idx[:, -(block_size - window_shift + 1):]
+                    logits = self.prefill(idx_cond)
+                    pos = idx_cond.shape[1]
+        finally:
+            for sa in self.attentions():
+                sa.clear_cache()
         return idx
 
-model = BigramLanguageModel()
-m = model.to(device)
-# print the number of parameters in the model
-print(sum(p.numel() for p in m.parameters())/1e6, 'M parameters')
-
-# create a PyTorch optimizer
-optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
-
-for iter in range(max_iters):
-    # sample a batch of data
-    xb, yb = get_batch('train')
-
-    # evaluate the loss
-    logits, loss = model(xb, yb)
-    optimizer.zero_grad(set_to_none=True)
-    loss.backward()
-    optimizer.step()
-
-    # every once in a while evaluate the loss on train and val sets
-    if iter % eval_interval == 0 or iter == max_iters - 1:
-        losses = estimate_loss()
-        print(f"step {iter}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
-
-        # test generation
-        texts, _ = read_data(file_path_val)
-        val_input_text = "<BOS>" + texts[0] + "<SUMMARY>" # <SUMMARY>の続きを生成させる
-        context = torch.tensor(tokenizer.encode(val_input_text)).unsqueeze(0)
-        out_text = tokenizer.decode(m.generate(context, max_new_tokens=2000)[0].tolist())
-        print("Context: ", out_text.split("<SUMMARY>")[0])
-        print("Generated Summary: ", out_text.split("<SUMMARY>")[1].split("<EOS>")[0])
+if __name__ == '__main__':
+    model = BigramLanguageModel()
+    m = model.to(device)
+    # print the number of parameters in the model
+    print(sum(p.numel() for p in m.parameters())/1e6, 'M parameters')
+
+    # create a PyTorch optimizer
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+
+    if eval_async:
+        # the evaluation process re-imports this file (spawn), so everything above runs there too
+        ctx = mp.get_context('spawn')
+        eval_jobs = ctx.Queue(maxsize=1)
+        eval_process = ctx.Process(target=eval_worker, args=(eval_jobs,))
+        eval_process.start()
+
+    for iter in range(max_iters):
+        # sample a batch of data
+        xb, yb = get_batch('train')
+
+        # evaluate the loss
+        logits, loss = model(xb, yb)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+
+        # every once in a while evaluate the loss on train and val sets
+        if iter % eval_interval == 0 or iter == max_iters - 1:
+            if not eval_async:
+                evaluate(model, iter)
+            elif eval_jobs.empty():
+                # snapshot of the weights; skipped while the previous evaluation is still waiting
+                eval_jobs.put((iter, {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}))
+
+    if eval_async:
+        eval_jobs.put(None)
+        eval_process.join()